@@ -6,52 +6,3592 @@ Cross-platform Python implementation for Linux/Flatpak compatibility
 Based on the original AutoIt version by RattletraPM
 """
 
+import io
+import copy
 import socket
 import threading
+import time
 import json
 import os
 import sys
+import mmap
+import queue
+import struct
+import zlib
+import bisect
+import random
+import argparse
+import functools
+import select
+import selectors
+from array import array
+from collections import deque
 
-# Check for tkinter availability
+# tkinter and ImageTk are only imported once a window is opened (see import_gui),
+# so the command line modes start quickly and work without a display
+tk = ttk = messagebox = filedialog = ImageTk = None
+TKINTER_AVAILABLE = False
+
+# Check for Pillow availability
 try:
-    import tkinter as tk
-    from tkinter import ttk, messagebox, filedialog
-    TKINTER_AVAILABLE = True
+    from PIL import Image
+    PILLOW_AVAILABLE = True
 except ImportError:
-    TKINTER_AVAILABLE = False
-    print("Error: tkinter not available. This is required for the GUI.")
-    sys.exit(1)
+    PILLOW_AVAILABLE = False
+
+
+def import_gui():
+    """Imports tkinter and ImageTk, returns False if tkinter isn't available"""
+    global tk, ttk, messagebox, filedialog, ImageTk, TKINTER_AVAILABLE
+    try:
+        import tkinter as tk
+        from tkinter import ttk, messagebox, filedialog
+        TKINTER_AVAILABLE = True
+    except ImportError:
+        return False
+    if PILLOW_AVAILABLE:
+        from PIL import ImageTk
+    else:
+        print("Warning: Pillow not available, some image features may be limited")
+    return True
+
+
+CONFIG_PATH = os.path.expanduser("~/.snickerstream_config.json")
+
+DEFAULT_CONFIG = {
+    "ip": "192.168.1.100",
+    "port": 8000,
+    "streaming_app": "NTR CFW",
+    "quality": 90,
+    "layout": "Vertical",
+    "interpolation": "Linear",
+    "auto_connect": False,
+    "priority_screen": "Top",
+    "priority_factor": 5,
+    "qos": 20,
+    "top_scaling": 1.0,
+    "bottom_scaling": 1.0,
+    "stream_port": 8001,
+    "sessions": [],
+    "grid_scaling": 0.5,
+    "recording_dir": "~/Snickerstream",
+    "telemetry_log": "",
+    "metrics_port": 0,
+    "adaptive_quality": False,
+    "min_quality": 30,
+    "target_fps": 30,
+    "target_latency_ms": 0,
+    "presentation": "Lowest latency",
+    "frame_limit": 0,
+    "secondary_frame_limit": 0,
+    "refresh_rate": 60,
+    "mjpeg_port": 0,
+    "auto_reconnect": True,
+    "stall_timeout_ms": 2000,
+    "multiprocess": False,
+    "replay_seconds": 30,
+    "replay_megabytes": 64,
+    "replay_format": "Clip",
+    "screenshot_format": "PNG"
+}
+
+# Screen IDs as sent by NTR in the low nibble of the packet header's second byte
+SCREEN_TOP = 1
+SCREEN_BOTTOM = 0
+SCREEN_NAMES = {SCREEN_TOP: "top", SCREEN_BOTTOM: "bottom"}
+
+# NTR always expects the remoteplay command on TCP port 8000 and streams to UDP port 8001
+NTR_PORT = 8000
+NTR_STREAM_PORT = 8001
+NTR_HEADER_SIZE = 4
+NTR_PAYLOAD_SIZE = 1444
+NTR_MAX_PACKET_SIZE = 2048
+
+# HzMod listens on TCP port 6464 and sends length-prefixed packets: a type byte followed by a 24-bit
+# little endian payload size. Image payloads start with 8 more bytes before the actual image data.
+HZMOD_PORT = 6464
+HZMOD_HEADER_SIZE = 4
+HZMOD_IMAGE_HEADER_SIZE = 8
+HZMOD_PACKET_MODE = 0x02
+HZMOD_PACKET_TARGA = 0x03
+HZMOD_PACKET_JPEG = 0x04
+HZMOD_PACKET_DEBUG = 0xFF
+HZMOD_COMMAND_START = 0x00
+HZMOD_COMMAND_QUALITY = 0x03
+HZMOD_COMMAND_CPU_LIMIT = 0xFF
+
+# Frame logs start with a magic and the wall clock time the segment was opened at. Each record is a
+# header (wall clock timestamp, screen, kind, flags, length) followed by the frame exactly as received.
+FRAMELOG_MAGIC = b"SNKFLOG1"
+FRAMELOG_HEADER = struct.Struct("<8sd")
+FRAMELOG_RECORD = struct.Struct("<dBBHI")
+# Record flag: no data follows, the frame repeats the previous one of its screen in the segment
+FRAMELOG_REPEAT = 0x0001
+FRAMELOG_EXTENSION = ".sfl"
+# Index files sit next to their segment and hold the segment's size (to detect stale indexes), the frame
+# count and then one array each of record offsets, lengths, timestamps, screens and kinds
+FRAMELOG_INDEX_MAGIC = b"SNKFIDX1"
+FRAMELOG_INDEX_HEADER = struct.Struct("<8sQQ")
+FRAMELOG_INDEX_EXTENSION = ".sfi"
+
+# Native size of each screen once the frame has been rotated upright
+SCREEN_SIZES = {SCREEN_TOP: (400, 240), SCREEN_BOTTOM: (320, 240)}
+
+# Compression of a Frame's data
+FRAME_JPEG = 0
+FRAME_TARGA = 1
+FRAME_COMPRESSION = 0x1F
+# Flags or'ed into a Frame's kind: the data holds several strips (HzMod, see FRAME_STRIP_HEADER),
+# byte-identical to the previous frame of its screen, and red and blue are swapped (HzMod)
+FRAME_STRIPS = 0x20
+FRAME_REPEAT = 0x40
+FRAME_SWAP_RB = 0x80
+# HzMod can split the top screen into strips along its 400 pixels side. A frame made of strips
+# holds each of them in order, as a little endian size followed by the image.
+FRAME_STRIP_HEADER = struct.Struct("<I")
+
+# Shared memory frame ring slots hold the largest frame either receiver accepts
+FRAME_RING_SLOT_SIZE = 512 * 1024
+
+
+class Frame:
+    """A complete compressed frame as received from the 3DS.
+
+    When produced by a receiver, data is a memoryview into one of the receiver's
+    ring slots and is only valid until the ring wraps around. Consumers that
+    need to keep the frame for longer must copy it (bytes(frame.data)).
+    """
+    __slots__ = ("screen", "data", "frame_id", "kind", "timestamp")
+
+    def __init__(self, screen, data, frame_id=0, kind=FRAME_JPEG, timestamp=None):
+        self.screen = screen
+        self.data = data
+        self.frame_id = frame_id
+        self.kind = kind
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+
+
+class ReceiverStats:
+    """Plain counters updated by the receiving thread only.
+
+    late counts packets that arrived for a frame that was already emitted or given up on,
+    reordered counts frames that were completed even though their packets arrived out of order.
+    """
+    __slots__ = ("packets", "frames", "bytes", "dropped", "incomplete", "invalid", "late", "reordered")
+
+    def __init__(self):
+        self.packets = 0
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.incomplete = 0
+        self.invalid = 0
+        self.late = 0
+        self.reordered = 0
+
+
+def ntr_init_remoteplay(ip, priority_mode=1, priority_factor=5, quality=90, qos=20,
+                        port=NTR_PORT, wait=3.0, timeout=5.0, ready=None, interval=0.25):
+    """Connects to a (New) 3DS running NTR CFW and sends the remoteplay() command.
+
+    priority_mode uses the raw NTR value (1 = top screen, 0 = bottom screen).
+    Mirrors _NTRInitRemoteplay in include/ntr.au3: NTR expects a disconnect and,
+    once remoteplay has started, a reconnect before it streams any frame.
+
+    Without ready that's a fixed wait before reconnecting, like the AutoIt client.
+    With ready (a function waiting up to a timeout for the stream, like
+    NTRReceiver.wait_ready), the reconnect is instead tried every interval
+    seconds until the first packet shows up, with the last try at wait.
+    """
+    if priority_mode not in (0, 1) or not (0 <= priority_factor <= 255) or not (1 <= quality <= 100):
+        raise ValueError("Invalid remoteplay parameters")
+    # NTR disables QoS for any value above 100, and expects the value to be doubled
+    if qos > 100:
+        qos = 105
+    packet = bytearray(84)
+    packet[0:16] = bytes.fromhex("78563412B80B00000000000085030000")
+    packet[0x10] = priority_factor
+    packet[0x11] = priority_mode
+    packet[0x14] = quality
+    packet[0x1A] = qos * 2
+
+    with socket.create_connection((ip, port), timeout=timeout) as sock:
+        sock.sendall(packet)
+    # NTR expects us to disconnect, wait for remoteplay to start and reconnect
+    if ready is None:
+        time.sleep(wait)
+        with socket.create_connection((ip, port), timeout=timeout):
+            pass
+        return
+    started = time.monotonic()
+    while True:
+        last = time.monotonic() - started >= wait
+        try:
+            with socket.create_connection((ip, port), timeout=timeout):
+                pass
+        except OSError:
+            if last:
+                raise
+            time.sleep(interval)
+            continue
+        # No frame yet means remoteplay hadn't started when we reconnected
+        if last or ready(interval):
+            return
+
+
+def ntr_packets(frame_id, screen, data):
+    """Splits a frame into NTR remoteplay UDP packets, the inverse of what NTRReceiver does"""
+    count = (len(data) + NTR_PAYLOAD_SIZE - 1) // NTR_PAYLOAD_SIZE
+    for number in range(count):
+        flags = screen | (0x10 if number == count - 1 else 0)
+        chunk = data[number * NTR_PAYLOAD_SIZE:(number + 1) * NTR_PAYLOAD_SIZE]
+        yield bytes((frame_id, flags, 2, number)) + chunk
+
+
+def ntr_port_usable(port):
+    """NTR can't be patched to stream on ports where (port - 1) is a multiple of 255"""
+    return (port - 1) % 255 != 0
+
+
+def next_stream_port(used):
+    """The first port from NTR_STREAM_PORT on that isn't in used and that NTR can be patched to"""
+    port = NTR_STREAM_PORT
+    while port in used or not ntr_port_usable(port):
+        port += 1
+    return port
+
+
+class _NTRFrameSlot:
+    """Reassembly state of one in-flight NTR frame"""
+    __slots__ = ("view", "frame_id", "screen", "received", "next_number", "last_number", "length",
+                 "reordered", "marks")
+
+    def __init__(self, size):
+        self.view = memoryview(bytearray(size))
+        self.marks = bytearray(256)
+        self.frame_id = 0
+        self.screen = 0
+        self.received = 0
+        self.next_number = 0
+        self.last_number = -1
+        self.length = 0
+        self.reordered = False
+
+
+class NTRReceiver:
+    """Reassembles NTR remoteplay JPEGs from UDP packets.
+
+    Every datagram is read with recv_into into a preallocated packet buffer and its
+    payload is copied straight to its final position inside a ring of preallocated
+    frame slots, so no memory is allocated per packet. A packet looks like this:
+
+    0x00: Frame ID
+    0x01: High nibble set to 1 on the last packet of a JPEG, low nibble is the screen
+    0x02: Image format
+    0x03: Packet number in JPEG stream
+    0x04 to 0x0n: JPEG data
+
+    Unlike _NTRRemoteplayReadJPEG, a single reordered packet doesn't cost the whole
+    frame: up to window frames per screen are kept in flight, packets are placed at
+    packet number * payload size and a frame is emitted as soon as all of its
+    packets are in. Frames of a screen are always emitted in order, so an older
+    in-flight frame is dropped once a newer one of the same screen completes.
+    """
+
+    app = "NTR CFW"
+
+    def __init__(self, port=NTR_STREAM_PORT, bind_ip="", window=3, ring_size=12, slot_size=256 * 1024):
+        if ring_size <= 2 * window:
+            raise ValueError("ring_size must be larger than both screens' reorder windows")
+        self.port = port
+        self.bind_ip = bind_ip
+        self.window = window
+        self.stats = ReceiverStats()
+        self._sock = None
+        self._packet = bytearray(NTR_MAX_PACKET_SIZE)
+        self._packet_view = memoryview(self._packet)
+        self._no_marks = bytes(256)
+        self._slots = [_NTRFrameSlot(slot_size) for _ in range(ring_size)]
+        self._slot = 0
+        self._pending = []
+        self._payload_size = NTR_PAYLOAD_SIZE
+        self._closed = {SCREEN_TOP: deque(maxlen=16), SCREEN_BOTTOM: deque(maxlen=16)}
+        self._last_emitted = {}
+        self._late_run = 0
+
+    def open(self, timeout=0.5):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        except OSError:
+            pass  # Keep the system default if the buffer size can't be raised
+        self._sock.bind((self.bind_ip, self.port))
+        self._sock.settimeout(timeout)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def wait_ready(self, timeout):
+        """Waits up to timeout seconds for the first packet, which is left queued. Returns whether one came"""
+        return bool(select.select([self._sock], [], [], timeout)[0])
+
+    def reset(self):
+        """Forgets every in-flight frame, e.g. after NTR has restarted its frame counter"""
+        self._pending.clear()
+        for closed in self._closed.values():
+            closed.clear()
+        self._last_emitted.clear()
+        self._late_run = 0
+
+    def receive(self):
+        """Reads one datagram, returns a Frame if it completed a JPEG or None otherwise"""
+        nbytes = self._sock.recv_into(self._packet_view)
+        return self.handle_packet(nbytes)
+
+    def drain(self, on_frame):
+        """Processes every datagram queued on a non-blocking socket, calling on_frame for each complete JPEG"""
+        while True:
+            try:
+                nbytes = self._sock.recv_into(self._packet_view)
+            except (BlockingIOError, InterruptedError):
+                return
+            frame = self.handle_packet(nbytes)
+            if frame is not None:
+                on_frame(frame)
+
+    def handle_packet(self, nbytes):
+        """Processes the datagram currently held in the packet buffer"""
+        stats = self.stats
+        stats.packets += 1
+        if nbytes < NTR_HEADER_SIZE:
+            stats.invalid += 1
+            return None
+
+        packet = self._packet
+        frame_id = packet[0]
+        screen = packet[1] & 0x0F
+        last = packet[1] >> 4 == 1
+        number = packet[3]
+        if screen not in self._closed:
+            stats.invalid += 1
+            return None
+        size = nbytes - NTR_HEADER_SIZE
+        if not last:
+            self._payload_size = size  # Every packet but the last one carries the same amount of data
+
+        slot = None
+        for index in self._pending:
+            candidate = self._slots[index]
+            if candidate.frame_id == frame_id and candidate.screen == screen:
+                slot = candidate
+                break
+        if slot is None:
+            if self._is_late(frame_id, screen):
+                stats.late += 1
+                self._late_run += 1
+                if self._late_run > 64:
+                    self.reset()  # NTR most likely restarted its frame counter
+                return None
+            slot = self._open_slot(frame_id, screen)
+        self._late_run = 0
+
+        if slot.marks[number]:
+            stats.invalid += 1  # Duplicated datagram
+            return None
+        offset = number * self._payload_size
+        end = offset + size
+        if end > len(slot.view) or (slot.last_number >= 0 and number > slot.last_number):
+            stats.invalid += 1
+            self._drop_slot(slot)
+            return None
+        slot.view[offset:end] = self._packet_view[NTR_HEADER_SIZE:nbytes]
+        slot.marks[number] = 1
+        slot.received += 1
+        if number != slot.next_number:
+            slot.reordered = True
+        slot.next_number = number + 1
+        if last:
+            slot.last_number = number
+            slot.length = end
+            # Packets numbered past the last one aren't part of the frame, only count the ones up to it
+            slot.received = slot.marks.count(1, 0, number + 1)
+        if slot.last_number < 0 or slot.received <= slot.last_number:
+            return None
+        return self._complete_slot(slot)
+
+    def _is_late(self, frame_id, screen):
+        if frame_id in self._closed[screen]:
+            return True
+        last_emitted = self._last_emitted.get(screen)
+        # Frame IDs wrap around at 256, anything up to half the range behind the last emitted frame is old
+        return last_emitted is not None and (frame_id - last_emitted) & 0xFF >= 128
+
+    def _open_slot(self, frame_id, screen):
+        in_flight = [index for index in self._pending if self._slots[index].screen == screen]
+        if len(in_flight) >= self.window:
+            self._drop_slot(self._slots[in_flight[0]])
+
+        # Skip the slots that are still being assembled, emitted frames are overwritten in ring order
+        index = (self._slot + 1) % len(self._slots)
+        while index in self._pending:
+            index = (index + 1) % len(self._slots)
+        self._slot = index
+        self._pending.append(index)
+
+        slot = self._slots[index]
+        slot.frame_id = frame_id
+        slot.screen = screen
+        slot.received = 0
+        slot.next_number = 0
+        slot.last_number = -1
+        slot.length = 0
+        slot.reordered = False
+        slot.marks[:] = self._no_marks
+        return slot
+
+    def _remove_slot(self, slot):
+        for position, index in enumerate(self._pending):
+            if self._slots[index] is slot:
+                del self._pending[position]
+                break
+        self._closed[slot.screen].append(slot.frame_id)
+
+    def _drop_slot(self, slot):
+        self.stats.dropped += 1
+        self._remove_slot(slot)
+
+    def _complete_slot(self, slot):
+        stats = self.stats
+        # Frames are emitted in order, so whatever is older than this one for the same screen is dropped
+        while True:
+            older = [index for index in self._pending if self._slots[index].screen == slot.screen]
+            if not older or self._slots[older[0]] is slot:
+                break
+            self._drop_slot(self._slots[older[0]])
+        self._remove_slot(slot)
+
+        end = slot.length
+        view = slot.view
+        # If the JPEG doesn't end with FFD9 it means that it's incomplete
+        if end < 2 or view[end - 2] != 0xFF or view[end - 1] != 0xD9:
+            stats.incomplete += 1
+            return None
+        self._last_emitted[slot.screen] = slot.frame_id
+        stats.frames += 1
+        stats.bytes += end
+        if slot.reordered:
+            stats.reordered += 1
+        return Frame(slot.screen, view[:end], slot.frame_id)
+
+
+def hzmod_command(command, value):
+    """Builds a HzMod command packet, see include/HzMod.au3"""
+    return bytes((0x7E, 0x05, 0x00, 0x00, command, 0x00, 0x00, 0x00, value & 0xFF))
+
+
+def image_height(data, kind):
+    """Height of a JPEG or TARGA image read from its header, None if it can't be found"""
+    if kind & FRAME_COMPRESSION == FRAME_TARGA:
+        return data[14] | data[15] << 8 if len(data) >= 18 else None
+    # Walk the JPEG markers up to the start of frame one, which holds the size
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return data[offset + 5] << 8 | data[offset + 6]
+        offset += 2 + (data[offset + 2] << 8 | data[offset + 3])
+    return None
+
+
+class HzModReceiver:
+    """Incremental parser for HzMod's TCP stream.
+
+    The socket is read with recv_into into a single receive buffer and complete
+    packets are sliced out of it using their size field, so image data is never
+    concatenated or copied. Mode and debug packets (0x02/0xFF) are skipped by size
+    and TARGA (0x03) images are emitted the same way as JPEG (0x04) ones.
+
+    HzMod may send each frame as several strips along the top screen's 400 pixels
+    side, one image each. Like the AutoIt client, the number of strips comes from
+    the strip size (400 / strip height, still sideways) and the strips of a frame
+    are collected in order before it's emitted as a FRAME_STRIPS frame.
+
+    The data of a returned Frame is a memoryview into the receive buffer and is only
+    valid until the next call to receive(). Frames made of strips are copies.
+    """
+    app = "HzMod"
+
+    def __init__(self, ip, port=HZMOD_PORT, buffer_size=512 * 1024):
+        self.ip = ip
+        self.port = port
+        self.stats = ReceiverStats()
+        self._sock = None
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._frame_id = 0
+        self._strips = []
+        self._strip_height = None
+
+    def open(self, quality=90, cpu_limit=0, timeout=0.5):
+        """Connects to HzMod and starts the stream, mirrors _HzModInit"""
+        self._sock = socket.create_connection((self.ip, self.port), timeout=5.0)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if cpu_limit > 0:
+            self._sock.sendall(hzmod_command(HZMOD_COMMAND_CPU_LIMIT, min(cpu_limit, 255)))
+        self.set_quality(quality)
+        self._sock.sendall(hzmod_command(HZMOD_COMMAND_START, 1))
+        self._sock.settimeout(timeout)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def set_quality(self, quality):
+        """Changes the JPEG quality mid-stream, mirrors _HzModChangeQuality"""
+        self._sock.sendall(hzmod_command(HZMOD_COMMAND_QUALITY, max(1, min(quality, 100))))
+
+    def receive(self):
+        """Returns the next complete image, reading from the socket only when the buffer runs dry"""
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            self.fill()
+
+    def drain(self, on_frame):
+        """Parses everything a non-blocking socket has to offer, calling on_frame for each image"""
+        while True:
+            frame = self.next_frame()
+            while frame is not None:
+                on_frame(frame)
+                frame = self.next_frame()
+            try:
+                self.fill()
+            except (BlockingIOError, InterruptedError):
+                return
+
+    def fill(self):
+        """Appends whatever the socket has to the receive buffer"""
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buffer) - self._end < len(self._buffer) // 4:
+            # Move the partial packet to the front instead of growing the buffer
+            remaining = self._end - self._start
+            self._view[0:remaining] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = remaining
+        nbytes = self._sock.recv_into(self._view[self._end:])
+        if nbytes == 0:
+            raise ConnectionError("HzMod closed the connection")
+        self._end += nbytes
+
+    def next_frame(self):
+        """Parses the packets already in the buffer, returns a Frame or None if more data is needed"""
+        buf = self._buffer
+        stats = self.stats
+        while self._end - self._start >= HZMOD_HEADER_SIZE:
+            start = self._start
+            packet_type = buf[start]
+            size = buf[start + 1] | buf[start + 2] << 8 | buf[start + 3] << 16
+            end = start + HZMOD_HEADER_SIZE + size
+            if end > self._end:
+                if HZMOD_HEADER_SIZE + size > len(buf):
+                    self._grow(HZMOD_HEADER_SIZE + size)
+                return None
+            self._start = end
+            stats.packets += 1
+
+            if packet_type == HZMOD_PACKET_JPEG or packet_type == HZMOD_PACKET_TARGA:
+                data = self._view[start + HZMOD_HEADER_SIZE + HZMOD_IMAGE_HEADER_SIZE:end]
+                # HzMod sends red and blue swapped
+                if packet_type == HZMOD_PACKET_JPEG:
+                    kind = FRAME_JPEG | FRAME_SWAP_RB
+                    # Sanity check, a JPEG always starts with FFD8 and ends with FFD9
+                    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8 or data[-2] != 0xFF or data[-1] != 0xD9:
+                        stats.incomplete += 1
+                        continue
+                else:
+                    kind = FRAME_TARGA | FRAME_SWAP_RB
+                stats.bytes += len(data)
+                height = image_height(data, kind)
+                if height is not None and height < SCREEN_SIZES[SCREEN_TOP][0]:
+                    data = self._add_strip(data, height)
+                    if data is None:
+                        continue
+                    kind |= FRAME_STRIPS
+                elif self._strips:
+                    # A full frame in the middle of a strip sequence, what came before it is lost
+                    stats.incomplete += 1
+                    self._strips = []
+                self._frame_id = (self._frame_id + 1) & 0xFF
+                stats.frames += 1
+                # HzMod only streams the top screen
+                return Frame(SCREEN_TOP, data, self._frame_id, kind)
+            if packet_type != HZMOD_PACKET_MODE and packet_type != HZMOD_PACKET_DEBUG:
+                stats.invalid += 1
+        return None
+
+    def _add_strip(self, data, height):
+        """Buffers a strip, returns the frame's data once all of its strips are in, None until then"""
+        if height != self._strip_height:
+            # The strip size changed (quality or resolution change), the strips so far don't fit
+            if self._strips:
+                self.stats.incomplete += 1
+                self._strips = []
+            self._strip_height = height
+        self._strips.append(FRAME_STRIP_HEADER.pack(len(data)))
+        self._strips.append(bytes(data))
+        if len(self._strips) // 2 < -(-SCREEN_SIZES[SCREEN_TOP][0] // height):
+            return None
+        data = b"".join(self._strips)
+        self._strips = []
+        return data
+
+    def _grow(self, size):
+        # A new buffer is allocated rather than resizing, frames handed out earlier may still reference the old one
+        remaining = self._end - self._start
+        buffer = bytearray(max(size * 2, len(self._buffer)))
+        buffer[0:remaining] = self._view[self._start:self._end]
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._start = 0
+        self._end = remaining
+
+
+def read_config(path=CONFIG_PATH):
+    """Returns DEFAULT_CONFIG updated with the settings saved at path"""
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    try:
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                config.update(json.load(f))
+    except Exception:
+        pass  # Use defaults if config loading fails
+    return config
+
+
+def open_receiver(config, timeout=0.5):
+    """Starts the stream on the 3DS described by config and returns the matching receiver"""
+    if config["streaming_app"] == "HzMod":
+        # The default port is NTR's, HzMod always listens on its own
+        port = config["port"] if config["port"] != NTR_PORT else HZMOD_PORT
+        receiver = HzModReceiver(config["ip"], port)
+        receiver.open(quality=config["quality"], timeout=timeout)
+        return receiver
+
+    # Bind before sending remoteplay so the first frames aren't lost
+    receiver = NTRReceiver(port=config["stream_port"])
+    receiver.open(timeout=timeout)
+    try:
+        ntr_init_remoteplay(config["ip"],
+                            priority_mode=1 if config["priority_screen"] == "Top" else 0,
+                            priority_factor=config["priority_factor"],
+                            quality=config["quality"],
+                            qos=config["qos"],
+                            port=config["port"],
+                            ready=receiver.wait_ready)
+    except Exception:
+        receiver.close()
+        raise
+    return receiver
+
+
+class DecodedFrame:
+    """A decoded, upright image ready to be presented"""
+    __slots__ = ("screen", "image", "frame_id", "received_at", "decode_started", "decoded_at")
+
+    def __init__(self, screen, image, frame_id, received_at, decode_started, decoded_at):
+        self.screen = screen
+        self.image = image
+        self.frame_id = frame_id
+        self.received_at = received_at
+        self.decode_started = decode_started
+        self.decoded_at = decoded_at
+
+
+class LatestFrameMailbox:
+    """Single-slot handoff: putting a new item replaces the one that hasn't been taken yet"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._item = None
+        self.replaced = 0
+
+    def put(self, item):
+        with self._lock:
+            if self._item is not None:
+                self.replaced += 1
+            self._item = item
+
+    def take(self):
+        with self._lock:
+            item = self._item
+            self._item = None
+            return item
+
+
+class _ScreenSchedule:
+    """Jitter buffer and arrival statistics of one screen"""
+    __slots__ = ("queue", "arrivals", "jitter", "next_present", "last_present", "started", "starved")
+
+    def __init__(self):
+        self.queue = deque()
+        self.arrivals = deque(maxlen=32)
+        self.jitter = 0.0
+        self.next_present = 0.0
+        self.last_present = float("-inf")
+        self.started = False
+        self.starved = False
+
+    @property
+    def interval(self):
+        """Average time between frames over the last arrivals, None until there are two"""
+        if len(self.arrivals) < 2:
+            return None
+        return (self.arrivals[-1] - self.arrivals[0]) / (len(self.arrivals) - 1)
+
+
+class FrameScheduler:
+    """Decides when decoded frames are painted.
+
+    "Lowest latency" paints every frame as soon as it's decoded. "Smooth" keeps
+    a small jitter buffer per screen, deep enough to cover how irregularly frames
+    have been arriving, and paints from it at the average frame interval with
+    every paint moved onto a display refresh tick. Frames that arrive in a
+    Wi-Fi burst are then shown evenly instead of in a burst too. The pace is
+    nudged by a few percent when the buffer runs fuller or emptier than it
+    should, so the buffer neither drains nor builds up delay. refresh_rate is
+    the display's, set in the Presentation settings as Tk can't tell it.
+    limits caps the frame rate of each screen, like the Framelimit setting of the
+    AutoIt client, so the other screen doesn't take paint time from the
+    priority one. Frames held back by a cap are replaced by newer ones.
+    """
+    MODES = ("Lowest latency", "Smooth")
+    MAX_DEPTH = 4
+    # Shortest wait next_poll returns, in seconds
+    MIN_POLL = 0.002
+
+    def __init__(self, mode="Lowest latency", limits=None, priority_screen=SCREEN_TOP, refresh_rate=60):
+        self.smooth = mode == "Smooth"
+        self.limits = {screen: limit for screen, limit in (limits or {}).items() if limit}
+        self.order = (priority_screen, SCREEN_BOTTOM if priority_screen == SCREEN_TOP else SCREEN_TOP)
+        self.refresh = 1.0 / max(1, refresh_rate)
+        self.screens = {SCREEN_TOP: _ScreenSchedule(), SCREEN_BOTTOM: _ScreenSchedule()}
+        self.dropped = 0
+        self.underruns = 0
+
+    def add(self, decoded):
+        state = self.screens[decoded.screen]
+        interval = state.interval
+        if interval is not None:
+            # Mean deviation from the average interval, like RFC 3550 estimates jitter
+            delta = decoded.decoded_at - state.arrivals[-1]
+            state.jitter += (abs(delta - interval) - state.jitter) / 16
+        state.arrivals.append(decoded.decoded_at)
+        state.queue.append(decoded)
+        if len(state.queue) > (self.MAX_DEPTH + 1 if self.smooth else 1):
+            state.queue.popleft()
+            self.dropped += 1
+
+    def depth(self, screen):
+        """Number of frames the smooth mode buffers for a screen before painting"""
+        state = self.screens[screen]
+        interval = state.interval
+        if not self.smooth or not interval:
+            return 1
+        return min(self.MAX_DEPTH, 1 + int(2 * state.jitter / interval + 0.999))
+
+    def due(self, now):
+        """Returns the frames to paint now, priority screen first"""
+        frames = []
+        for screen in self.order:
+            state = self.screens[screen]
+            limit = self.limits.get(screen)
+            if limit and now - state.last_present < 1.0 / limit:
+                continue
+            if self.smooth:
+                depth = self.depth(screen)
+                if not state.started:
+                    if len(state.queue) < depth:
+                        continue
+                    state.started = True
+                    state.next_present = now
+                tick = self._tick(state)
+                if now < tick:
+                    continue
+                if not state.queue:
+                    # Ran dry, the next frame is painted as soon as it's decoded
+                    state.starved = True
+                    continue
+                if state.starved:
+                    if now - tick >= self.refresh:
+                        self.underruns += 1  # It was late enough to miss a refresh
+                    state.next_present = now  # Carry on from the late frame
+                    state.starved = False
+                # More frames than a capped screen can show, or than the nudging below can catch up with
+                while len(state.queue) > depth + 1:
+                    state.queue.popleft()
+                    self.dropped += 1
+                interval = state.interval or self.refresh
+                if limit:
+                    interval = max(interval, 1.0 / limit)
+                if len(state.queue) > depth:
+                    interval *= 0.9
+                elif len(state.queue) == 1:
+                    interval *= 1.1
+                state.next_present = max(state.next_present + interval, now + interval / 2)
+            elif not state.queue:
+                continue
+            state.last_present = now
+            frames.append(state.queue.popleft())
+        return frames
+
+    def _tick(self, state):
+        """Paints go on the first refresh tick at or after the screen's next slot"""
+        return self.refresh * int(state.next_present / self.refresh + 0.999)
+
+    def next_poll(self, now):
+        """Seconds until due() should be called again.
+
+        Buffered smooth frames wait for their refresh tick and capped screens
+        for their cap. Otherwise frames are painted as soon as they're decoded,
+        so the mailboxes are checked four times per frame interval, and once per
+        refresh until a screen's first frame.
+        """
+        wait = None
+        for screen, state in self.screens.items():
+            if not state.arrivals:
+                continue  # HzMod never sends the bottom screen
+            if self.smooth and state.started and state.queue and not state.starved:
+                at = self._tick(state)
+            else:
+                at = now + (state.interval or self.refresh) / 4
+            limit = self.limits.get(screen)
+            if limit:
+                at = max(at, state.last_present + 1.0 / limit)
+            wait = at - now if wait is None else min(wait, at - now)
+        if wait is None:
+            return self.refresh
+        return max(self.MIN_POLL, wait)
+
+
+def layout_geometry(layout, top_scaling=1.0, bottom_scaling=1.0, display_size=(1920, 1080)):
+    """Works out where each screen is painted for a layout, like the $ix1BMP1/$iy2BMP2 math in Snickerstream.au3.
+
+    Returns (window_sizes, screens): window_sizes has the (width, height) of each
+    window used, screens maps each screen to (window, x, y, width, height), or to
+    None when the layout doesn't show it. Window 0 is the main window, only
+    "Separate Windows" uses a second one. Stacked screens are centered like
+    CenterScreens() does.
+    """
+    top = (round(400 * top_scaling), round(240 * top_scaling))
+    bottom = (round(320 * bottom_scaling), round(240 * bottom_scaling))
+    screens = {SCREEN_TOP: None, SCREEN_BOTTOM: None}
+    if layout == "Horizontal":
+        height = max(top[1], bottom[1])
+        screens[SCREEN_TOP] = (0, 0, (height - top[1]) // 2) + top
+        screens[SCREEN_BOTTOM] = (0, top[0], (height - bottom[1]) // 2) + bottom
+        return [(top[0] + bottom[0], height)], screens
+    if layout == "Top Only":
+        screens[SCREEN_TOP] = (0, 0, 0) + top
+        return [top], screens
+    if layout == "Bottom Only":
+        screens[SCREEN_BOTTOM] = (0, 0, 0) + bottom
+        return [bottom], screens
+    if layout in ("Fullscreen Top", "Fullscreen Bottom"):
+        screen = SCREEN_TOP if layout == "Fullscreen Top" else SCREEN_BOTTOM
+        width, height = SCREEN_SIZES[screen]
+        factor = min(display_size[0] / width, display_size[1] / height)
+        width, height = round(width * factor), round(height * factor)
+        screens[screen] = (0, (display_size[0] - width) // 2, (display_size[1] - height) // 2, width, height)
+        return [tuple(display_size)], screens
+    if layout == "Separate Windows":
+        screens[SCREEN_TOP] = (0, 0, 0) + top
+        screens[SCREEN_BOTTOM] = (1, 0, 0) + bottom
+        return [top, bottom], screens
+    # Vertical
+    width = max(top[0], bottom[0])
+    screens[SCREEN_TOP] = (0, (width - top[0]) // 2, 0) + top
+    screens[SCREEN_BOTTOM] = (0, (width - bottom[0]) // 2, top[1]) + bottom
+    return [(width, top[1] + bottom[1])], screens
+
+
+def screen_targets(layout, top_scaling=1.0, bottom_scaling=1.0, display_size=(1920, 1080)):
+    """Returns the size each screen is displayed at for a layout, or None for hidden screens"""
+    screens = layout_geometry(layout, top_scaling, bottom_scaling, display_size)[1]
+    return {screen: rect[3:] if rect is not None else None for screen, rect in screens.items()}
+
+
+def rotate_swap_rb(image):
+    """Rotates a sideways HzMod frame upright and swaps its red and blue channels back.
+
+    The AutoIt client does this on the GPU ($structSwapRBMatrix). Here the swap
+    is a split and merge of the bands, which costs a lot less than a color
+    matrix convert() and than a NumPy strided copy.
+    """
+    return Image.merge("RGB", image.transpose(Image.ROTATE_90).split()[::-1])
+
+
+def split_strips(data):
+    """Returns the images of a FRAME_STRIPS frame's data, in order"""
+    strips = []
+    offset = 0
+    while offset + FRAME_STRIP_HEADER.size <= len(data):
+        size, = FRAME_STRIP_HEADER.unpack_from(data, offset)
+        offset += FRAME_STRIP_HEADER.size
+        strips.append(data[offset:offset + size])
+        offset += size
+    return strips
+
+
+def decode_strips(data, sideways=None):
+    """Decodes the strips of a frame and pastes them one below the other, still sideways"""
+    strips = split_strips(data)
+    image = None
+    for i, strip in enumerate(strips):
+        part = Image.open(io.BytesIO(strip))
+        if sideways is not None:
+            part.draft("RGB", (sideways[0], -(-sideways[1] // len(strips))))
+        part.load()
+        if image is None:
+            image = Image.new(part.mode, (part.width, part.height * len(strips)))
+        image.paste(part, (0, part.height * i))
+    return image
+
+
+def decode_frame(frame, size=None, resample=None):
+    """Decodes a compressed frame, rotates it upright and scales it to size.
+
+    Both NTR and HzMod send their frames sideways, which the AutoIt client
+    undoes with a -90 degrees render target transform. When the target is
+    smaller than the frame, the JPEG decoder is asked to scale it down by up to
+    8 times while decoding (Image.draft), which is a lot cheaper than decoding at
+    full size and resizing afterwards. Frames are scaled while still sideways,
+    and the ones with FRAME_SWAP_RB set also get their colors fixed. Frames made
+    of strips are decoded strip by strip and put back together first.
+    """
+    # The frame is still sideways, so the requested size is too
+    sideways = (size[1], size[0]) if size is not None else None
+    if frame.kind & FRAME_STRIPS:
+        image = decode_strips(frame.data, sideways)
+    else:
+        image = Image.open(io.BytesIO(frame.data))
+        if sideways is not None:
+            image.draft("RGB", sideways)
+        image.load()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if sideways is not None and image.size != sideways:
+        image = image.resize(sideways, Image.BILINEAR if resample is None else resample)
+    if frame.kind & FRAME_SWAP_RB:
+        return rotate_swap_rb(image)
+    return image.transpose(Image.ROTATE_90)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram in milliseconds.
+
+    Updating it is a bisect and a list increment, so it's cheap enough to leave
+    on for every frame. Each histogram must only be updated from one thread.
+    """
+    BOUNDS = (1, 2, 4, 8, 16, 33, 66, 133, 266, 533, 1000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, milliseconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, milliseconds)] += 1
+        self.count += 1
+        self.sum += milliseconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples, None without samples"""
+        counts = list(self.counts)
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = fraction * total
+        seen = 0
+        for bound, count in zip(self.BOUNDS + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class ScreenTelemetry:
+    """Per-screen frame counters and stage latencies"""
+    STAGES = ("received", "repeated", "decoded", "presented")
+    LATENCIES = ("decode", "present", "total")
+
+    def __init__(self):
+        self.received = 0
+        self.repeated = 0
+        self.decoded = 0
+        self.presented = 0
+        self.latency = {name: LatencyHistogram() for name in self.LATENCIES}
+
+
+class StreamTelemetry:
+    """Frame counters and latency histograms for every stage of a StreamPipeline.
+
+    Each counter has a single writer (the receive thread, the screen's decoder or
+    the presenter), so no locks are taken for them. Rates are worked out when a
+    snapshot is taken, from the counters as they were about a second earlier;
+    snapshots are taken by the presenter, the telemetry logger and the metrics
+    server alike, so those earlier samples are kept under a lock. Repeated
+    frames are received frames that were identical to the previous one.
+    decode latency runs from a frame being received to it being decoded, present
+    from decoded to painted and total from received to painted.
+    """
+
+    def __init__(self):
+        self.screens = {SCREEN_TOP: ScreenTelemetry(), SCREEN_BOTTOM: ScreenTelemetry()}
+        self._samples = deque(maxlen=8)
+        self._lock = threading.Lock()
+
+    def record_received(self, frame):
+        screen = self.screens[frame.screen]
+        screen.received += 1
+        if frame.kind & FRAME_REPEAT:
+            screen.repeated += 1
+
+    def record_decoded(self, decoded):
+        screen = self.screens[decoded.screen]
+        screen.decoded += 1
+        screen.latency["decode"].add((decoded.decoded_at - decoded.received_at) * 1000)
+
+    def record_presented(self, decoded, presented_at=None):
+        presented_at = time.monotonic() if presented_at is None else presented_at
+        screen = self.screens[decoded.screen]
+        screen.presented += 1
+        screen.latency["present"].add((presented_at - decoded.decoded_at) * 1000)
+        screen.latency["total"].add((presented_at - decoded.received_at) * 1000)
+
+    def _rates(self, now, counts):
+        with self._lock:
+            if not self._samples or now - self._samples[-1][0] >= 0.25:
+                self._samples.append((now, counts))
+            base_time, base_counts = self._samples[0]
+            for sample_time, sample_counts in self._samples:
+                if now - sample_time < 1.0:
+                    break
+                base_time, base_counts = sample_time, sample_counts
+            elapsed = now - base_time
+            return {key: (value - base_counts[key]) / elapsed if elapsed > 0 else 0.0 for key, value in counts.items()}
+
+    def snapshot(self, stats=None, **extra):
+        """Returns the current values as a dict, stats being the receiver's ReceiverStats"""
+        now = time.monotonic()
+        counts = {(screen, stage): getattr(telemetry, stage)
+                  for screen, telemetry in self.screens.items() for stage in ScreenTelemetry.STAGES}
+        rates = self._rates(now, counts)
+        snapshot = {"time": round(time.time(), 3), "screens": {}}
+        for screen, telemetry in self.screens.items():
+            values = {}
+            for stage in ScreenTelemetry.STAGES:
+                values[stage] = counts[(screen, stage)]
+                values[stage + "_fps"] = round(rates[(screen, stage)], 1)
+            for name, histogram in telemetry.latency.items():
+                values[name + "_ms"] = {"p50": histogram.percentile(0.5), "p95": histogram.percentile(0.95),
+                                        "p99": histogram.percentile(0.99), "count": histogram.count,
+                                        "sum": round(histogram.sum, 3),
+                                        "buckets": list(histogram.counts)}
+            snapshot["screens"][SCREEN_NAMES[screen]] = values
+        if stats is not None:
+            snapshot["receiver"] = {name: getattr(stats, name) for name in ReceiverStats.__slots__}
+        snapshot.update(extra)
+        return snapshot
+
+
+# Snapshot values that count up for as long as the pipeline runs
+PIPELINE_COUNTERS = ("skipped", "hidden", "repeated", "decode_errors", "reconnects", "stalls")
+
+
+def telemetry_to_prometheus(snapshot):
+    """Formats a telemetry snapshot in the Prometheus text exposition format.
+
+    The samples of a metric family must all follow its TYPE line, so each family
+    is collected first and written in one go, and families without samples are
+    left out. The pipeline's own counters get a _total name, its other numbers
+    are gauges.
+    """
+    screens = snapshot["screens"]
+    families = []
+    samples = []
+    for screen, values in screens.items():
+        for stage in ScreenTelemetry.STAGES:
+            samples.append('snickerstream_frames_total{screen="%s",stage="%s"} %d' % (screen, stage, values[stage]))
+    families.append(("snickerstream_frames_total", "counter", samples))
+    samples = []
+    for screen, values in screens.items():
+        for stage in ScreenTelemetry.STAGES:
+            samples.append('snickerstream_fps{screen="%s",stage="%s"} %s' % (screen, stage, values[stage + "_fps"]))
+    families.append(("snickerstream_fps", "gauge", samples))
+    samples = []
+    for screen, values in screens.items():
+        for name in ScreenTelemetry.LATENCIES:
+            histogram = values[name + "_ms"]
+            cumulative = 0
+            for bound, count in zip(LatencyHistogram.BOUNDS + ("+Inf",), histogram["buckets"]):
+                cumulative += count
+                samples.append('snickerstream_latency_ms_bucket{screen="%s",stage="%s",le="%s"} %d'
+                               % (screen, name, bound, cumulative))
+            samples.append('snickerstream_latency_ms_sum{screen="%s",stage="%s"} %s' % (screen, name, histogram["sum"]))
+            samples.append('snickerstream_latency_ms_count{screen="%s",stage="%s"} %d'
+                           % (screen, name, histogram["count"]))
+    families.append(("snickerstream_latency_ms", "histogram", samples))
+    samples = ['snickerstream_receiver_total{counter="%s"} %d' % (name, value)
+               for name, value in snapshot.get("receiver", {}).items()]
+    families.append(("snickerstream_receiver_total", "counter", samples))
+    for name, value in snapshot.items():
+        if isinstance(value, (int, float)) and name != "time":
+            if name in PIPELINE_COUNTERS:
+                metric, kind = "snickerstream_%s_total" % name, "counter"
+            else:
+                metric, kind = "snickerstream_%s" % name, "gauge"
+            families.append((metric, kind, ["%s %s" % (metric, int(value) if isinstance(value, bool) else value)]))
+    lines = []
+    for metric, kind, samples in families:
+        if samples:
+            lines.append("# TYPE %s %s" % (metric, kind))
+            lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class TelemetryLogger:
+    """Appends a telemetry snapshot as a JSON line to a file every interval seconds"""
+
+    def __init__(self, path, source, interval=1.0):
+        self.path = os.path.expanduser(path)
+        self.source = source
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="telemetry-log", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        with open(self.path, "a") as f:
+            while not self._stop.wait(self.interval):
+                snapshot = self.source()
+                if snapshot is not None:
+                    f.write(json.dumps(snapshot) + "\n")
+                    f.flush()
+
+
+class MetricsServer:
+    """Serves telemetry on localhost: /metrics in Prometheus text format, /stats as JSON"""
+
+    def __init__(self, source, port, host="127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.source = source
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                snapshot = source()
+                if handler.path == "/metrics" and snapshot is not None:
+                    body = telemetry_to_prometheus(snapshot).encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif handler.path == "/stats" and snapshot is not None:
+                    body = json.dumps(snapshot).encode()
+                    content_type = "application/json"
+                else:
+                    handler.send_error(404)
+                    return
+                handler.send_response(200)
+                handler.send_header("Content-Type", content_type)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass  # Don't print every scrape
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# EXIF APP1 segment with Orientation = 8, it tells viewers to turn a sideways 3DS frame upright
+MJPEG_EXIF_UPRIGHT = (b"\xff\xe1\x00\x22Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08"
+                      b"\x00\x01\x01\x12\x00\x03\x00\x00\x00\x01\x00\x08\x00\x00\x00\x00\x00\x00")
+MJPEG_BOUNDARY = "snickerstream-frame"
+
+
+class MJPEGClient:
+    """A viewer of an MJPEGServer stream: its bounded frame queue and throughput counters"""
+
+    def __init__(self, address, screen, max_pending):
+        self.address = address
+        self.screen = screen
+        self.queue = deque(maxlen=max_pending)
+        self.ready = threading.Event()
+        self.connected_at = time.monotonic()
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def put(self, part):
+        # A full deque drops its oldest item, so a slow viewer only ever falls behind by max_pending frames
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(part)
+        self.ready.set()
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.connected_at, 1e-6)
+        return {"address": "%s:%d" % self.address[:2], "screen": SCREEN_NAMES[self.screen],
+                "seconds": round(elapsed, 1), "frames": self.frames, "bytes": self.bytes, "dropped": self.dropped,
+                "queued": len(self.queue), "fps": round(self.frames / elapsed, 1),
+                "kbps": round(self.bytes * 8 / 1000 / elapsed, 1)}
+
+
+class MJPEGServer:
+    """Re-streams received frames to any number of local viewers as MJPEG over HTTP.
+
+    add() is a StreamPipeline listener. JPEGs are forwarded exactly as received,
+    only an EXIF orientation tag is inserted so viewers that honor it (browsers,
+    OBS browser sources) show them upright; HzMod's swapped colors can't be fixed
+    without re-encoding and are left as they are. Every viewer has its own
+    bounded queue and sending thread, a slow one loses its oldest frames without
+    holding up the receiver or anyone else.
+
+    /top.mjpg and /bottom.mjpg are the streams, /stats lists the viewers and /
+    is a page showing both screens.
+    """
+
+    def __init__(self, port, host="127.0.0.1", max_pending=4):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.clients = []
+        self.max_pending = max_pending
+        self.running = True
+        self._lock = threading.Lock()
+        self._last = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                screens = {"/top.mjpg": SCREEN_TOP, "/bottom.mjpg": SCREEN_BOTTOM}
+                if handler.path in screens:
+                    server._stream(handler, screens[handler.path])
+                    return
+                if handler.path == "/stats":
+                    body = json.dumps(server.stats()).encode()
+                    content_type = "application/json"
+                elif handler.path == "/":
+                    body = (b"<html><body style='background:#303030;text-align:center'>"
+                            b"<img src='/top.mjpg'><br><img src='/bottom.mjpg'></body></html>")
+                    content_type = "text/html"
+                else:
+                    handler.send_error(404)
+                    return
+                handler.send_response(200)
+                handler.send_header("Content-Type", content_type)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="mjpeg", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        with self._lock:
+            for client in self.clients:
+                client.ready.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return [client.stats() for client in self.clients]
+
+    def add(self, frame):
+        """Queues a frame for the viewers of its screen, never blocks"""
+        if frame.kind & (FRAME_COMPRESSION | FRAME_STRIPS) != FRAME_JPEG or not self.clients:
+            return
+        last = self._last.get(frame.screen)
+        if last is not None and last[0] is frame.data:
+            part = last[1]  # A repeated frame, its part has already been built
+        else:
+            data = frame.data
+            part = b"".join((b"--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+                             % (MJPEG_BOUNDARY.encode(), len(data) + len(MJPEG_EXIF_UPRIGHT)),
+                             data[:2], MJPEG_EXIF_UPRIGHT, data[2:], b"\r\n"))
+            self._last[frame.screen] = (data, part)
+        with self._lock:
+            for client in self.clients:
+                if client.screen == frame.screen:
+                    client.put(part)
+
+    def _stream(self, handler, screen):
+        client = MJPEGClient(handler.client_address, screen, self.max_pending)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "multipart/x-mixed-replace; boundary=" + MJPEG_BOUNDARY)
+        handler.send_header("Cache-Control", "no-cache")
+        handler.end_headers()
+        with self._lock:
+            self.clients.append(client)
+        try:
+            while self.running:
+                if not client.ready.wait(1.0):
+                    continue
+                client.ready.clear()
+                while client.queue:
+                    part = client.queue.popleft()
+                    handler.wfile.write(part)
+                    client.frames += 1
+                    client.bytes += len(part)
+                handler.wfile.flush()
+        except OSError:
+            pass  # The viewer went away
+        finally:
+            with self._lock:
+                self.clients.remove(client)
+
+
+class Backoff:
+    """Exponential backoff with jitter: base, then twice as long every attempt up to limit, each scaled by 50-100%"""
+
+    def __init__(self, base=0.5, limit=30.0):
+        self.base = base
+        self.limit = limit
+        self.attempts = 0
+
+    def delay(self):
+        delay = min(self.limit, self.base * 2 ** self.attempts)
+        self.attempts += 1
+        return delay * random.uniform(0.5, 1.0)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class StreamPipeline:
+    """Receive thread -> JPEG decoder pool -> per-screen latest-frame-wins mailboxes.
+
+    The receive thread never waits on decoding: each screen has at most one frame
+    being decoded and one waiting for a decoder, and a newer frame simply replaces
+    the waiting one. Decoded frames end up in a per-screen mailbox that the
+    presenter empties, so a slow presenter skips stale frames instead of queueing
+    them. Pillow releases the GIL while decoding, so the pool scales across cores.
+
+    With reconnect set, a connection error or a stall (no complete frame for
+    stall_timeout seconds) doesn't end the pipeline: the connection is opened again
+    after an exponential backoff, keeping the decoded frames, listeners and
+    telemetry. on_reconnecting is then called with the reason and the delay.
+
+    on_connected, on_error, on_reconnecting and the frame listeners are called from
+    the receive thread. Pipelines can share one decoder pool (executor), max_decodes
+    then caps how many of its workers a single pipeline may keep busy.
+    """
+
+    def __init__(self, open_receiver=None, decode_workers=2, on_connected=None, on_error=None, on_frame=None,
+                 executor=None, max_decodes=2, reconnect=False, stall_timeout=None):
+        self.open_receiver = open_receiver
+        self.on_connected = on_connected
+        self.on_error = on_error
+        self.on_reconnecting = None
+        self.reconnect = reconnect
+        self.stall_timeout = stall_timeout
+        # Called with every received frame (already copied) before it's decoded. The tuple is
+        # replaced rather than changed, so the receive thread can go through it without a lock.
+        self.listeners = (on_frame,) if on_frame is not None else ()
+        self.receiver = None
+        self.running = False
+        self.decoded = {SCREEN_TOP: LatestFrameMailbox(), SCREEN_BOTTOM: LatestFrameMailbox()}
+        self.telemetry = StreamTelemetry()
+        self.targets = {SCREEN_TOP: SCREEN_SIZES[SCREEN_TOP], SCREEN_BOTTOM: SCREEN_SIZES[SCREEN_BOTTOM]}
+        self.resample = None
+        self.skipped = 0
+        self.hidden = 0
+        self.repeated = 0
+        self.decode_errors = 0
+        self._lock = threading.Lock()
+        self._last = {}
+        self._waiting = {}
+        self._busy = set()
+        self._decode_workers = decode_workers
+        self._executor = executor
+        self._owns_executor = executor is None
+        self.max_decodes = max_decodes
+        self._thread = None
+        # Connection timings in seconds, None until the first frame arrived
+        self.time_to_first_frame = None
+        self.last_reconnect_time = None
+        self.reconnects = 0
+        self.stalls = 0
+        self.last_frame_at = None
+        # No stall is detected before this (monotonic) time, for expected pauses like an NTR restart
+        self.quiet_until = 0.0
+        self._awaiting_since = None
+        self._backoff = Backoff()
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Starts decoding, and receiving too unless open_receiver is None (the receiver is then fed externally)"""
+        self.running = True
+        self._stopped.clear()
+        if self._owns_executor:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self._decode_workers, thread_name_prefix="decode")
+        if self.open_receiver is not None:
+            self._thread = threading.Thread(target=self._receive_loop, name="receive", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._stopped.set()
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def snapshot(self):
+        """Returns the pipeline's telemetry, see StreamTelemetry.snapshot"""
+        timings = [round(seconds * 1000) if seconds is not None else None
+                   for seconds in (self.time_to_first_frame, self.last_reconnect_time)]
+        return self.telemetry.snapshot(self.receiver.stats if self.receiver is not None else None,
+                                       skipped=self.skipped, hidden=self.hidden, repeated=self.repeated,
+                                       decode_errors=self.decode_errors,
+                                       replaced={SCREEN_NAMES[screen]: mailbox.replaced
+                                                 for screen, mailbox in self.decoded.items()},
+                                       time_to_first_frame_ms=timings[0], last_reconnect_ms=timings[1],
+                                       reconnects=self.reconnects, stalls=self.stalls)
+
+    def awaiting_frames(self):
+        """Starts timing a (re)connection, the next frame submitted ends it"""
+        self._awaiting_since = time.monotonic()
+
+    @property
+    def reconnecting(self):
+        """Whether frames had arrived and the pipeline is now waiting for them to come back"""
+        return self._awaiting_since is not None and self.time_to_first_frame is not None
+
+    def set_targets(self, targets, resample=None):
+        """Sets the size each screen is decoded at, screens mapped to None aren't decoded at all"""
+        self.targets = dict(targets)
+        self.resample = resample
+        # The frame on screen was decoded for the old size, don't skip the next one as a repeat
+        self._last = {}
+
+    def _receive_loop(self):
+        if self._awaiting_since is None:
+            self.awaiting_frames()
+        try:
+            while self.running:
+                error = None
+                try:
+                    stats = self.receiver.stats if self.receiver is not None else None
+                    self.receiver = self.open_receiver()
+                    if stats is not None:
+                        self.receiver.stats = stats  # Keep counting across reconnects
+                    self.last_frame_at = time.monotonic()
+                    if self.on_connected is not None:
+                        self.on_connected()
+                    error = self._receive()
+                except Exception as e:
+                    error = str(e)
+                finally:
+                    if self.receiver is not None:
+                        self.receiver.close()
+                if error is None or not self.running:
+                    return
+                if not self.reconnect:
+                    if self.on_error is not None:
+                        self.on_error(error)
+                    return
+                self.awaiting_frames()
+                delay = self._backoff.delay()
+                if self.on_reconnecting is not None:
+                    self.on_reconnecting(error, delay)
+                self._stopped.wait(delay)
+        finally:
+            self.running = False
+
+    def _receive(self):
+        """Receives until the pipeline stops (returns None) or the stream stalls (returns why)"""
+        receiver = self.receiver
+        stall_timeout = self.stall_timeout
+        if stall_timeout:
+            # A receive blocking longer than the stall timeout would delay noticing the stall
+            receiver.settimeout(stall_timeout / 4)
+        while self.running:
+            try:
+                frame = receiver.receive()
+            except socket.timeout:
+                frame = None
+            if frame is not None:
+                self.submit(frame)
+            elif stall_timeout:
+                now = time.monotonic()
+                if now - self.last_frame_at > stall_timeout and now > self.quiet_until:
+                    self.stalls += 1
+                    return "No frame received for %d ms" % (stall_timeout * 1000)
+        return None
+
+    def add_listener(self, listener):
+        """Calls listener with every received frame from now on, from the receive thread"""
+        with self._lock:
+            self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener):
+        """Stops calling listener, it may still get a frame that was being handed out"""
+        with self._lock:
+            self.listeners = tuple(other for other in self.listeners if other != listener)
+
+    def submit(self, frame):
+        """Hands a received frame over to the decoder pool.
+
+        Frames byte-identical to the previous one of their screen (menus, pause
+        screens, an idle bottom screen...) are flagged FRAME_REPEAT, share the
+        previous frame's data and aren't decoded or painted again.
+        """
+        fingerprint = (len(frame.data), zlib.crc32(frame.data))
+        last = self._last.get(frame.screen)
+        kind = frame.kind & ~FRAME_REPEAT
+        if last is not None and last[0] == fingerprint:
+            frame = Frame(frame.screen, last[1], frame.frame_id, kind | FRAME_REPEAT, frame.timestamp)
+        else:
+            # The receiver reuses its buffers, this is the only copy of the frame that's made
+            frame = Frame(frame.screen, bytes(frame.data), frame.frame_id, kind, frame.timestamp)
+            self._last[frame.screen] = (fingerprint, frame.data)
+        self._arrived()
+        self.telemetry.record_received(frame)
+        for listener in self.listeners:
+            listener(frame)
+        if frame.kind & FRAME_REPEAT:
+            self.repeated += 1
+            return
+        if self.targets.get(frame.screen) is None:
+            self.hidden += 1  # The current layout doesn't show this screen
+            return
+        with self._lock:
+            if frame.screen in self._waiting:
+                self.skipped += 1
+            self._waiting[frame.screen] = frame
+            if frame.screen in self._busy or len(self._busy) >= self.max_decodes:
+                return
+            self._busy.add(frame.screen)
+        try:
+            self._executor.submit(self._decode_screen, frame.screen)
+        except RuntimeError:
+            pass  # The pool has been shut down
+
+    def _arrived(self):
+        """Notes that a frame arrived, ending the (re)connection being timed if any"""
+        self.last_frame_at = time.monotonic()
+        if self._awaiting_since is not None:
+            elapsed = self.last_frame_at - self._awaiting_since
+            if self.time_to_first_frame is None:
+                self.time_to_first_frame = elapsed
+            else:
+                self.last_reconnect_time = elapsed
+                self.reconnects += 1
+            self._awaiting_since = None
+            self._backoff.reset()
+
+    def _decode_screen(self, screen):
+        while self.running:
+            with self._lock:
+                frame = self._waiting.pop(screen, None)
+                if frame is None:
+                    self._busy.discard(screen)
+                    # Take over a screen that couldn't get a worker because of max_decodes
+                    idle = [other for other in self._waiting if other not in self._busy]
+                    if not idle:
+                        return
+                    screen = idle[0]
+                    self._busy.add(screen)
+                    continue
+            decode_started = time.monotonic()
+            try:
+                image = decode_frame(frame, self.targets.get(screen), self.resample)
+            except Exception:
+                self.decode_errors += 1
+                continue
+            decoded = DecodedFrame(screen, image, frame.frame_id, frame.timestamp, decode_started, time.monotonic())
+            self.telemetry.record_decoded(decoded)
+            self.decoded[screen].put(decoded)
+        with self._lock:
+            self._busy.discard(screen)
+
+
+class FrameRing:
+    """Fixed-size frame slots in shared memory, to hand frames to other processes without pickling them.
+
+    Each slot starts with the sequence number of the frame in it, which the writer
+    clears while rewriting the slot and sets once the slot is complete. A frame
+    returned by read() is a view into the slot, readers check valid() once they
+    are done with it to know whether it was overwritten in the meantime. write()
+    puts frame seq in slot seq % slots, so the oldest frame is the one
+    overwritten; put() lets the caller pick the slot instead. The header also
+    holds a copy of the writer's ReceiverStats.
+
+    Pass a name to attach to a ring created by another process.
+    """
+    HEADER = struct.Struct("<QII")
+    SLOT = struct.Struct("<QBBBxId")
+    HEADER_SIZE = 128
+    SLOT_HEADER_SIZE = 32
+
+    def __init__(self, name=None, slots=16, slot_size=FRAME_RING_SLOT_SIZE):
+        from multiprocessing import shared_memory
+        if name is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=self.HEADER_SIZE + slots * (self.SLOT_HEADER_SIZE + slot_size))
+            self.HEADER.pack_into(self._shm.buf, 0, 0, slots, slot_size)
+        else:
+            self._shm = shared_memory.SharedMemory(name)
+        self.owner = name is None
+        self.name = self._shm.name
+        self._buf = self._shm.buf
+        self.written, self.slots, self.slot_size = self.HEADER.unpack_from(self._buf, 0)
+        self._stride = self.SLOT_HEADER_SIZE + self.slot_size
+        self._stats = struct.Struct("<%dQ" % len(ReceiverStats.__slots__))
+
+    def _offset(self, slot):
+        return self.HEADER_SIZE + slot * self._stride
+
+    def write(self, frame):
+        """Appends a frame, returns its sequence number or None if it doesn't fit in a slot"""
+        seq = self.written + 1
+        if not self.put(seq % self.slots, seq, frame.screen, frame.data, frame.frame_id, frame.kind,
+                        frame.timestamp):
+            return None
+        self.written = seq
+        self.HEADER.pack_into(self._buf, 0, seq, self.slots, self.slot_size)
+        return seq
+
+    def put(self, slot, seq, screen, data, frame_id=0, kind=FRAME_JPEG, timestamp=0.0):
+        """Writes data to a slot as frame seq (which must not be 0), returns False if it doesn't fit"""
+        length = len(data)
+        if length > self.slot_size:
+            return False
+        offset = self._offset(slot)
+        self.SLOT.pack_into(self._buf, offset, 0, screen, kind, frame_id, length, timestamp)
+        start = offset + self.SLOT_HEADER_SIZE
+        self._buf[start:start + length] = data
+        struct.pack_into("<Q", self._buf, offset, seq)
+        return True
+
+    def read(self, seq, slot=None):
+        """Returns frame seq with its data viewing the slot, or None if the slot holds another frame by now"""
+        offset = self._offset(seq % self.slots if slot is None else slot)
+        found, screen, kind, frame_id, length, timestamp = self.SLOT.unpack_from(self._buf, offset)
+        if found != seq:
+            return None
+        start = offset + self.SLOT_HEADER_SIZE
+        return Frame(screen, self._buf[start:start + length], frame_id, kind, timestamp)
+
+    def valid(self, seq, slot=None):
+        """Whether frame seq is still in its slot, i.e. a view of it returned by read() wasn't overwritten"""
+        offset = self._offset(seq % self.slots if slot is None else slot)
+        return struct.unpack_from("<Q", self._buf, offset)[0] == seq
+
+    def set_stats(self, stats):
+        self._stats.pack_into(self._buf, self.HEADER.size,
+                              *(getattr(stats, name) for name in ReceiverStats.__slots__))
+
+    def get_stats(self):
+        stats = ReceiverStats()
+        for name, value in zip(ReceiverStats.__slots__, self._stats.unpack_from(self._buf, self.HEADER.size)):
+            setattr(stats, name, value)
+        return stats
+
+    def close(self):
+        self._buf = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass  # A frame view is still around, the mapping goes away with it
+        if self.owner:
+            self._shm.unlink()
+
+
+class RemoteReceiver:
+    """Stands in for the receiver of a ProcessPipeline, which lives in the receiver process"""
+
+    def __init__(self, ring, control, app=None):
+        self.app = app
+        self._ring = ring
+        self._control = control
+        self._stats = None
+
+    @property
+    def stats(self):
+        return self._stats if self._stats is not None else self._ring.get_stats()
+
+    def set_quality(self, quality):
+        self._control.put(("quality", quality))
+
+    def close(self):
+        """Keeps the last stats, the ring is about to go away"""
+        self._stats = self._ring.get_stats()
+
+
+def _ignore_interrupts():
+    # Ctrl+C reaches the whole process group, only the main process handles it
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _receive_process(open_receiver, ring_name, events, control, reconnect, stall_timeout):
+    """Receiver process of a ProcessPipeline: a StreamPipeline that puts every frame in the ring.
+
+    Frames are reported on events by sequence number, connection events as they
+    happen. Commands (quality, quiet, stop) arrive on control.
+    """
+    _ignore_interrupts()
+    ring = FrameRing(ring_name)
+    pipeline = StreamPipeline(open_receiver, decode_workers=1, reconnect=reconnect, stall_timeout=stall_timeout)
+    pipeline.set_targets({SCREEN_TOP: None, SCREEN_BOTTOM: None})
+    pipeline.on_connected = lambda: events.put(("connected",))
+    pipeline.on_error = lambda message: events.put(("error", message))
+    pipeline.on_reconnecting = lambda reason, delay: events.put(("reconnecting", reason, delay, pipeline.stalls))
+
+    def publish(frame):
+        seq = ring.write(frame)
+        ring.set_stats(pipeline.receiver.stats)
+        if seq is not None:
+            events.put(("frame", seq))
+
+    pipeline.add_listener(publish)
+    pipeline.start()
+    try:
+        while pipeline.running:
+            try:
+                command, value = control.get(timeout=0.25)
+            except queue.Empty:
+                if pipeline.receiver is not None:
+                    ring.set_stats(pipeline.receiver.stats)  # Drops keep being counted during a stall
+                continue
+            if command == "stop":
+                break
+            if command == "quiet":
+                pipeline.quiet_until = value
+            elif command == "quality" and pipeline.receiver is not None:
+                try:
+                    pipeline.receiver.set_quality(value)
+                except OSError:
+                    pass  # The receive loop reports connection errors
+    finally:
+        pipeline.stop()
+        ring.close()
+
+
+def _decode_process(frame_ring_name, image_ring_name, jobs, results):
+    """Decoder process of a ProcessPipeline: decodes frames straight from the frame ring into the image ring.
+
+    Jobs are (frame seq, image slot, size, resample), results (image slot, image
+    size, decode started, decoded at), (image slot, None) when the frame couldn't
+    be decoded or (image slot, None, True) when the receiver overwrote it before
+    it was decoded. Images too large for a slot are sent along with the result.
+    """
+    _ignore_interrupts()
+    frames = FrameRing(frame_ring_name)
+    images = FrameRing(image_ring_name)
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            seq, slot, size, resample = job
+            decode_started = time.monotonic()
+            frame = frames.read(seq)
+            if frame is None:
+                results.put((slot, None, True))
+                continue
+            image = None
+            try:
+                image = decode_frame(frame, size, resample)
+            except Exception:
+                pass
+            screen = frame.screen
+            frame = None  # Let go of the view into the ring
+            # The receiver may have lapped the ring while the frame was being decoded
+            if not frames.valid(seq):
+                results.put((slot, None, True))
+                continue
+            if image is None:
+                results.put((slot, None))
+                continue
+            data = image.tobytes()
+            if images.put(slot, seq, screen, data):
+                results.put((slot, image.size, decode_started, time.monotonic()))
+            else:
+                results.put((slot, image.size, decode_started, time.monotonic(), data))
+    finally:
+        frames.close()
+        images.close()
+
+
+class ProcessPipeline(StreamPipeline):
+    """StreamPipeline that receives and decodes in separate processes, so this one only presents.
+
+    A receiver process owns the socket and runs a plain StreamPipeline (repeat
+    detection and reconnects included) that writes every frame into a FrameRing
+    in shared memory. Decodes are scheduled here just like StreamPipeline does,
+    per-screen latest-frame-wins, but run in decoder processes that decode
+    straight from the ring into a second ring of image slots, from which the
+    image is copied once into the mailbox. Only sequence numbers and other small
+    tuples go through the process queues, frame bytes are never pickled;
+    listeners get a copy of each frame, made only if there are any listeners.
+
+    open_receiver must be picklable (a module level function or a functools.partial
+    of one) as the processes are spawned. receiver is a RemoteReceiver, app tells
+    the QualityController which protocol it talks to. Images up to max_image_size
+    go through shared memory, larger ones are pickled.
+    """
+
+    def __init__(self, open_receiver, decode_workers=2, on_connected=None, on_error=None, on_frame=None,
+                 max_decodes=2, reconnect=False, stall_timeout=None, app=None, ring_slots=16,
+                 max_image_size=(1920, 1080)):
+        self._control = None
+        super().__init__(open_receiver, decode_workers, on_connected, on_error, on_frame,
+                         max_decodes=max_decodes, reconnect=reconnect, stall_timeout=stall_timeout)
+        self.app = app
+        self.ring_slots = ring_slots
+        self.max_image_size = max_image_size
+        self._redecode = set()
+        self._copies = {}
+        self._decoding = {}
+        self._free_slots = []
+        self._processes = []
+        self._threads = []
+
+    @property
+    def quiet_until(self):
+        return self._quiet_until
+
+    @quiet_until.setter
+    def quiet_until(self, value):
+        # Stalls are detected by the receiver process
+        self._quiet_until = value
+        if self._control is not None:
+            self._control.put(("quiet", value))
+
+    def start(self):
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        self.running = True
+        self._stopped.clear()
+        self.awaiting_frames()
+        self._copies = {}
+        self._frames = FrameRing(slots=self.ring_slots)
+        width, height = self.max_image_size
+        self._images = FrameRing(slots=self.max_decodes, slot_size=width * height * 3)
+        self._free_slots = list(range(self.max_decodes))
+        self._events, self._control, self._jobs, self._results = (context.Queue() for _ in range(4))
+        self.receiver = RemoteReceiver(self._frames, self._control, self.app)
+        self._processes = [context.Process(target=_receive_process, name="receive", daemon=True,
+                                           args=(self.open_receiver, self._frames.name, self._events,
+                                                 self._control, self.reconnect, self.stall_timeout))]
+        self._processes += [context.Process(target=_decode_process, name="decode", daemon=True,
+                                            args=(self._frames.name, self._images.name, self._jobs, self._results))
+                            for _ in range(self._decode_workers)]
+        for process in self._processes:
+            process.start()
+        self._threads = [threading.Thread(target=self._event_loop, name="receive-events", daemon=True),
+                         threading.Thread(target=self._result_loop, name="decode-results", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        if not self._processes:
+            self.running = False
+            return
+        self.running = False
+        self._stopped.set()
+        self._control.put(("stop", None))
+        for _ in self._processes[1:]:
+            self._jobs.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        for process in self._processes:
+            process.join(timeout=2.0)
+            if process.is_alive():
+                process.terminate()
+        self._processes = []
+        for channel in (self._events, self._control, self._jobs, self._results):
+            channel.close()
+            channel.cancel_join_thread()
+        self.receiver.close()
+        self._frames.close()
+        self._images.close()
+
+    def set_targets(self, targets, resample=None):
+        super().set_targets(targets, resample)
+        # Repeats aren't decoded, the next frame of every screen has to be for the new size
+        self._redecode = set(self.targets)
+
+    def _event_loop(self):
+        while self.running:
+            try:
+                event = self._events.get(timeout=0.25)
+            except queue.Empty:
+                if not self._processes[0].is_alive():
+                    self._failed("The receiver process exited")
+                continue
+            if event[0] == "frame":
+                self._frame_ready(event[1])
+            elif event[0] == "connected":
+                if self.on_connected is not None:
+                    self.on_connected()
+            elif event[0] == "reconnecting":
+                self.stalls = event[3]
+                self.awaiting_frames()
+                if self.on_reconnecting is not None:
+                    self.on_reconnecting(event[1], event[2])
+            elif event[0] == "error":
+                self._failed(event[1])
+
+    def _failed(self, message):
+        if self.running and self.on_error is not None:
+            self.on_error(message)
+        self.running = False
+
+    def _frame_ready(self, seq):
+        frame = self._frames.read(seq)
+        if frame is None:
+            return  # Overwritten already, this process is falling far behind
+        self._arrived()
+        self.telemetry.record_received(frame)
+        screen, kind = frame.screen, frame.kind
+        listeners = self.listeners
+        if listeners:
+            # Repeats share the previous copy of their screen, like StreamPipeline.submit's frames
+            data = self._copies.get(screen) if kind & FRAME_REPEAT else None
+            if data is None:
+                data = bytes(frame.data)
+            if self._frames.valid(seq):
+                self._copies[screen] = data
+                copied = Frame(screen, data, frame.frame_id, kind, frame.timestamp)
+                for listener in listeners:
+                    listener(copied)
+        waiting = (seq, frame.frame_id, frame.timestamp)
+        frame = None
+        if kind & FRAME_REPEAT and screen not in self._redecode:
+            self.repeated += 1
+            return
+        if self.targets.get(screen) is None:
+            self.hidden += 1
+            return
+        with self._lock:
+            if screen in self._waiting:
+                self.skipped += 1
+            self._waiting[screen] = waiting
+            if screen in self._busy or len(self._busy) >= self.max_decodes:
+                return
+            self._busy.add(screen)
+        self._decode_next(screen)
+
+    def _decode_next(self, screen):
+        """Sends the frame waiting for a busy screen to a decoder, freeing the screen if there's none"""
+        with self._lock:
+            waiting = self._waiting.pop(screen, None)
+            if waiting is None:
+                self._busy.discard(screen)
+                # Take over a screen that couldn't get a decoder because of max_decodes
+                idle = [other for other in self._waiting if other not in self._busy]
+                if not idle or len(self._busy) >= self.max_decodes:
+                    return
+                screen = idle[0]
+                self._busy.add(screen)
+                waiting = self._waiting.pop(screen)
+            slot = self._free_slots.pop()
+            self._decoding[slot] = (screen,) + waiting
+        self._redecode.discard(screen)
+        self._jobs.put((waiting[0], slot, self.targets.get(screen), self.resample))
+
+    def _result_loop(self):
+        while self.running:
+            try:
+                result = self._results.get(timeout=0.25)
+            except queue.Empty:
+                continue
+            slot, size = result[0], result[1]
+            screen, seq, frame_id, received_at = self._decoding.pop(slot)
+            if size is None:
+                # Frames the receiver overwrote before they were decoded were skipped, not broken
+                if len(result) > 2:
+                    self.skipped += 1
+                else:
+                    self.decode_errors += 1
+            else:
+                if len(result) > 4:
+                    data = result[4]
+                else:
+                    stored = self._images.read(seq, slot)
+                    data = stored.data if stored is not None else None
+                    stored = None
+                if data is None:
+                    # The image slot was reused before the image could be copied out of it
+                    self.skipped += 1
+                else:
+                    image = Image.frombytes("RGB", size, data)
+                    data = None
+                    decoded = DecodedFrame(screen, image, frame_id, received_at, result[2], result[3])
+                    self.telemetry.record_decoded(decoded)
+                    self.decoded[screen].put(decoded)
+            with self._lock:
+                self._free_slots.append(slot)
+            self._decode_next(screen)
+
+
+class QualityController:
+    """Adjusts stream quality to what the connection and the decoders can keep up with.
+
+    Every interval seconds it compares the pipeline's counters with the previous
+    tick. target_fps applies to the screen the 3DS favours: the top screen for
+    HzMod, which only streams that one, and NTR's priority screen (NTR sends the
+    other one priority_factor times less often). Lost or incomplete frames, that
+    screen's frame rate falling below target_fps or a decode time
+    above target_latency_ms (0 = don't care) count as congestion; quality is lowered
+    after down_after congested ticks in a row and raised again only after up_after
+    clean ones, so it doesn't oscillate around the limit. Quality never goes above
+    the configured one.
+
+    HzMod quality is changed mid-stream. NTR has to be sent remoteplay again,
+    which stalls the stream for a few seconds, so NTR changes use bigger steps,
+    a cooldown and, once quality is already at min_quality, a lower QoS.
+    """
+    NTR_COOLDOWN = 20.0
+    NTR_MIN_QOS = 5
+    LOSS_HIGH = 0.05
+    LOSS_LOW = 0.01
+
+    def __init__(self, pipeline, config, interval=1.0, down_after=2, up_after=8):
+        self.pipeline = pipeline
+        self.config = dict(config)
+        self.interval = interval
+        self.down_after = down_after
+        self.up_after = up_after
+        self.max_quality = config["quality"]
+        self.min_quality = min(config["min_quality"], self.max_quality)
+        self.max_qos = config["qos"]
+        self.quality = self.max_quality
+        self.qos = self.max_qos
+        self.target_fps = config["target_fps"]
+        self.target_latency_ms = config["target_latency_ms"]
+        if config["streaming_app"] == "HzMod" or config["priority_screen"] == "Top":
+            self.paced_screen = SCREEN_TOP
+        else:
+            self.paced_screen = SCREEN_BOTTOM
+        self.changes = 0
+        self.bytes_per_frame = 0
+        self.last_reason = ""
+        self._congested = 0
+        self._clean = 0
+        self._last_change = time.monotonic()
+        self._previous = None
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="quality", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick()
+            except OSError:
+                pass  # The receive loop reports connection errors
+
+    def _sample(self):
+        receiver = self.pipeline.receiver
+        if receiver is None:
+            return None
+        stats = receiver.stats
+        screens = self.pipeline.telemetry.screens
+        decode = [telemetry.latency["decode"] for telemetry in screens.values()]
+        return (time.monotonic(), stats.frames, stats.dropped + stats.incomplete, stats.bytes,
+                sum(histogram.count for histogram in decode), sum(histogram.sum for histogram in decode),
+                screens[self.paced_screen].received)
+
+    def tick(self):
+        sample = self._sample()
+        previous, self._previous = self._previous, sample
+        if sample is None or previous is None:
+            return
+        elapsed = sample[0] - previous[0]
+        frames, lost, received_bytes, decodes, decode_ms, paced = (
+            now - then for now, then in zip(sample[1:], previous[1:]))
+        if elapsed <= 0 or frames + lost == 0:
+            return
+        loss = lost / (frames + lost)
+        fps = paced / elapsed
+        decode_time = decode_ms / decodes if decodes else 0.0
+        self.bytes_per_frame = received_bytes / frames
+
+        reasons = []
+        if loss > self.LOSS_HIGH:
+            reasons.append("%.0f%% lost" % (loss * 100))
+        if self.target_fps and fps < self.target_fps * 0.9:
+            reasons.append("%.0f fps" % fps)
+        if self.target_latency_ms and decode_time > self.target_latency_ms:
+            reasons.append("%.1f ms decode" % decode_time)
+        clean = (loss < self.LOSS_LOW
+                 and (not self.target_fps or fps >= self.target_fps * 0.98)
+                 and (not self.target_latency_ms or decode_time < self.target_latency_ms * 0.7))
+
+        if reasons:
+            self._congested += 1
+            self._clean = 0
+        elif clean:
+            self._clean += 1
+            self._congested = 0
+        else:
+            self._congested = self._clean = 0  # In between, hold
+        if self._congested >= self.down_after:
+            self._congested = 0
+            self._change(-1, ", ".join(reasons))
+        elif self._clean >= self.up_after:
+            self._clean = 0
+            self._change(1, "clean")
+
+    def _change(self, direction, reason):
+        receiver = self.pipeline.receiver
+        app = getattr(receiver, "app", None)  # Replays have none
+        if app == "HzMod":
+            quality = max(self.min_quality, min(self.quality + direction * (10 if direction < 0 else 5),
+                                                self.max_quality))
+            if quality != self.quality:
+                receiver.set_quality(quality)
+                self._applied(quality, self.qos, reason)
+            return
+
+        if app != "NTR CFW" or time.monotonic() - self._last_change < self.NTR_COOLDOWN:
+            return
+        quality, qos = self.quality, self.qos
+        if direction < 0:
+            if quality > self.min_quality:
+                quality = max(self.min_quality, quality - 15)
+            else:
+                qos = max(self.NTR_MIN_QOS, qos - 5)
+        elif qos < self.max_qos:
+            qos = min(self.max_qos, qos + 5)
+        else:
+            quality = min(self.max_quality, quality + 10)
+        if (quality, qos) == (self.quality, self.qos):
+            return
+        # remoteplay pauses the stream, that's not a stall to reconnect from
+        self.pipeline.quiet_until = time.monotonic() + 10.0
+        ntr_init_remoteplay(self.config["ip"],
+                            priority_mode=1 if self.config["priority_screen"] == "Top" else 0,
+                            priority_factor=self.config["priority_factor"],
+                            quality=quality, qos=qos, port=self.config["port"])
+        self._applied(quality, qos, reason)
+        # Don't count the stall caused by the restart as congestion
+        self._previous = self._sample()
+
+    def _applied(self, quality, qos, reason):
+        self.quality, self.qos = quality, qos
+        self.changes += 1
+        self.last_reason = reason
+        self._last_change = time.monotonic()
+
+
+class FrameLogIndex:
+    """Array-backed index of a frame log segment: data offset, length, timestamp, screen and kind per frame.
+
+    Repeated frames get the offset and length of the frame they repeat, so
+    readers never have to know about them.
+    """
+
+    def __init__(self):
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        self.timestamps = array("d")
+        self.screens = array("B")
+        self.kinds = array("B")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _arrays(self):
+        return (self.offsets, self.lengths, self.timestamps, self.screens, self.kinds)
+
+    def append(self, offset, length, timestamp, screen, kind):
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.timestamps.append(timestamp)
+        self.screens.append(screen)
+        self.kinds.append(kind)
+
+    def save(self, path, segment_size):
+        with open(path, "wb") as f:
+            f.write(FRAMELOG_INDEX_HEADER.pack(FRAMELOG_INDEX_MAGIC, segment_size, len(self)))
+            for values in self._arrays():
+                values.tofile(f)
+
+    @classmethod
+    def load(cls, path, segment_size):
+        """Returns the index stored at path, or None if it's missing or doesn't match the segment"""
+        index = cls()
+        try:
+            with open(path, "rb") as f:
+                magic, size, count = FRAMELOG_INDEX_HEADER.unpack(f.read(FRAMELOG_INDEX_HEADER.size))
+                if magic != FRAMELOG_INDEX_MAGIC or size != segment_size:
+                    return None
+                for values in index._arrays():
+                    values.fromfile(f, count)
+        except (OSError, EOFError, struct.error):
+            return None
+        return index
+
+    @classmethod
+    def scan(cls, view):
+        """Builds the index of a segment by walking its record headers"""
+        index = cls()
+        offset = FRAMELOG_HEADER.size
+        end = len(view)
+        last = {}
+        while offset + FRAMELOG_RECORD.size <= end:
+            timestamp, screen, kind, flags, length = FRAMELOG_RECORD.unpack_from(view, offset)
+            offset += FRAMELOG_RECORD.size
+            if offset + length > end:
+                break  # The recording was cut short while this frame was being written
+            if flags & FRAMELOG_REPEAT:
+                # Repeats point at the data of the frame they repeat
+                if screen in last:
+                    index.append(last[screen][0], last[screen][1], timestamp, screen, kind | FRAME_REPEAT)
+            else:
+                index.append(offset, length, timestamp, screen, kind)
+                last[screen] = (offset, length)
+            offset += length
+        return index
+
+
+class FrameLog:
+    """A memory-mapped frame log segment.
+
+    The index is loaded from the segment's .sfi file when it's up to date and
+    rebuilt (then saved) otherwise, after that any frame can be reached in O(1)
+    without reading the rest of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self._mmap)
+        magic, self.start_time = FRAMELOG_HEADER.unpack_from(self.view, 0)
+        if magic != FRAMELOG_MAGIC:
+            self.close()
+            raise ValueError("%s is not a Snickerstream recording" % path)
+
+        index_path = os.path.splitext(path)[0] + FRAMELOG_INDEX_EXTENSION
+        self.index = FrameLogIndex.load(index_path, len(self.view))
+        if self.index is None:
+            self.index = FrameLogIndex.scan(self.view)
+            try:
+                self.index.save(index_path, len(self.view))
+            except OSError:
+                pass  # Read-only location, the index will be rebuilt next time
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, position, timestamp=None):
+        index = self.index
+        offset = index.offsets[position]
+        return Frame(index.screens[position], self.view[offset:offset + index.lengths[position]],
+                     position & 0xFF, index.kinds[position], timestamp)
+
+    def close(self):
+        try:
+            self.view.release()
+            self._mmap.close()
+        except BufferError:
+            pass  # Frames still reference the mapping, it's closed once they're gone
+
+
+class ReplaySource:
+    """Plays recorded frame logs back through a StreamPipeline as if they were a live receiver.
+
+    Segments are concatenated in time order. speed is a playback rate multiplier,
+    0 plays as fast as possible. Seeking uses binary search over the timestamp
+    index and stepping is O(1), nothing is ever scanned.
+    """
+
+    def __init__(self, paths, speed=1.0):
+        self.logs = []
+        try:
+            for path in paths:
+                log = FrameLog(path)
+                if len(log):
+                    self.logs.append(log)
+                else:
+                    log.close()
+        except Exception:
+            self.close()
+            raise
+        if not self.logs:
+            raise ValueError("The recording doesn't contain any frames")
+        self.logs.sort(key=lambda log: log.index.timestamps[0])
+        self._starts = []
+        total = 0
+        for log in self.logs:
+            self._starts.append(total)
+            total += len(log)
+        self.total = total
+        self.stats = ReceiverStats()
+        self.speed = speed
+        self.paused = False
+        self.position = 0
+        self._show_next = False
+        self._anchor = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.total
+
+    def _locate(self, position):
+        segment = bisect.bisect_right(self._starts, position) - 1
+        return self.logs[segment], position - self._starts[segment]
+
+    def timestamp(self, position):
+        log, index = self._locate(position)
+        return log.index.timestamps[index]
+
+    @property
+    def start_time(self):
+        return self.logs[0].index.timestamps[0]
+
+    @property
+    def end_time(self):
+        return self.logs[-1].index.timestamps[-1]
+
+    def seek(self, timestamp):
+        """Moves playback to the first frame recorded at or after timestamp (wall clock)"""
+        for segment, log in enumerate(self.logs):
+            if timestamp <= log.index.timestamps[-1] or segment == len(self.logs) - 1:
+                index = bisect.bisect_left(log.index.timestamps, timestamp)
+                self.seek_position(self._starts[segment] + min(index, len(log) - 1))
+                return
+
+    def seek_position(self, position):
+        with self._lock:
+            self.position = max(0, min(position, self.total - 1))
+            self._anchor = None
+            self._show_next = True
+
+    def step(self, delta):
+        """Pauses and shows the frame delta frames away from the last one shown"""
+        with self._lock:
+            self.paused = True
+            self.position = max(0, min(self.position - 1 + delta, self.total - 1))
+            self._show_next = True
+
+    def set_paused(self, paused):
+        with self._lock:
+            self.paused = paused
+            self._anchor = None
+
+    def set_speed(self, speed):
+        with self._lock:
+            self.speed = speed
+            self._anchor = None
+
+    def receive(self):
+        """Returns the next frame once it's due, raises socket.timeout while waiting like a live socket"""
+        with self._lock:
+            show_now = self._show_next
+            if self.position >= self.total or (self.paused and not show_now):
+                due = None
+            else:
+                position = self.position
+                timestamp = self.timestamp(position)
+                if self._anchor is None or show_now:
+                    self._anchor = (time.monotonic(), timestamp)
+                if show_now or self.speed <= 0:
+                    due = 0.0
+                else:
+                    due = self._anchor[0] + (timestamp - self._anchor[1]) / self.speed
+            if due is not None and due <= time.monotonic():
+                self.position = position + 1
+                self._show_next = False
+                log, index = self._locate(position)
+                frame = log.frame(index)
+                frame.frame_id = position & 0xFF
+                self.stats.frames += 1
+                self.stats.bytes += len(frame.data)
+                return frame
+        time.sleep(0.05 if due is None else min(max(due - time.monotonic(), 0.0), 0.05))
+        raise socket.timeout()
+
+    def close(self):
+        for log in self.logs:
+            log.close()
+
+
+class FrameRecorder:
+    """Records frames exactly as received into a segmented frame log.
+
+    Frames are never decoded or re-encoded: add() only queues the compressed
+    bytes and a writer thread appends them in batches. The queue is bounded, if
+    the disk can't keep up frames are dropped (and counted) instead of slowing
+    down the receiver. A new segment is started every segment_bytes bytes or
+    segment_seconds seconds. Frames flagged FRAME_REPEAT that match the last
+    frame written for their screen in the segment are stored as a data-less
+    FRAMELOG_REPEAT record.
+
+    If a segment can't be created or written to, error is set, on_error is
+    called with it from the writer thread and every frame after that is dropped.
+    """
+
+    def __init__(self, directory, prefix="capture", segment_bytes=512 * 1024 * 1024, segment_seconds=900,
+                 max_pending=256, on_error=None):
+        self.directory = os.path.expanduser(directory)
+        self.on_error = on_error
+        self.prefix = prefix
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.segments = []
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._file = None
+        self._index = None
+        self._segment_size = 0
+        self._segment_start = 0.0
+        self._last = {}
+        self.repeats = 0
+        # Frame timestamps are monotonic, records store wall clock time
+        self._clock_offset = time.time() - time.monotonic()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._writer, name="recorder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Writes whatever is still queued and closes the current segment"""
+        if self._thread is not None:
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            self._thread.join()
+            self._thread = None
+
+    def add(self, frame):
+        """Queues a frame, its data must not change afterwards (bytes)"""
+        try:
+            self._queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        try:
+            # Saving the index now means the recording can be reopened without a scan
+            self._index.save(os.path.splitext(self.segments[-1])[0] + FRAMELOG_INDEX_EXTENSION, self._segment_size)
+        except OSError:
+            pass  # The index will be rebuilt when the recording is opened
+
+    def _open_segment(self, timestamp):
+        self._close_segment()
+        name = "%s-%s-%04d%s" % (self.prefix, time.strftime("%Y%m%d-%H%M%S", time.localtime(timestamp)),
+                                 len(self.segments), FRAMELOG_EXTENSION)
+        path = os.path.join(self.directory, name)
+        self._file = open(path, "wb", buffering=1024 * 1024)
+        self._file.write(FRAMELOG_HEADER.pack(FRAMELOG_MAGIC, timestamp))
+        self._index = FrameLogIndex()
+        self._segment_size = FRAMELOG_HEADER.size
+        self._segment_start = timestamp
+        self._last = {}  # Segments don't reference each other
+        self.segments.append(path)
+
+    def _writer(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < 64:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            chunks = []
+            for position, frame in enumerate(batch):
+                if frame is None:
+                    stop = True
+                    break
+                timestamp = frame.timestamp + self._clock_offset
+                if (self._file is None or self._segment_size >= self.segment_bytes
+                        or timestamp - self._segment_start >= self.segment_seconds):
+                    self._flush(chunks)
+                    chunks = []
+                    if self.error is None:
+                        try:
+                            self._open_segment(timestamp)
+                        except OSError as e:
+                            self._failed(str(e))
+                    if self.error is not None:
+                        self._discard(batch[position:])
+                        return
+                kind = frame.kind & ~FRAME_REPEAT
+                self.frames += 1
+                last = self._last.get(frame.screen)
+                # The frame it repeats may have been dropped, so check it's really the same
+                if frame.kind & FRAME_REPEAT and last is not None and last[0] == frame.data:
+                    chunks.append(FRAMELOG_RECORD.pack(timestamp, frame.screen, kind, FRAMELOG_REPEAT, 0))
+                    self._segment_size += FRAMELOG_RECORD.size
+                    self._index.append(last[1], len(frame.data), timestamp, frame.screen, kind | FRAME_REPEAT)
+                    self.repeats += 1
+                    continue
+                chunks.append(FRAMELOG_RECORD.pack(timestamp, frame.screen, kind, 0, len(frame.data)))
+                chunks.append(frame.data)
+                self._segment_size += FRAMELOG_RECORD.size
+                self._index.append(self._segment_size, len(frame.data), timestamp, frame.screen, kind)
+                self._last[frame.screen] = (frame.data, self._segment_size)
+                self._segment_size += len(frame.data)
+                self.bytes += len(frame.data)
+            self._flush(chunks)
+            if self.error is not None:
+                if not stop:
+                    self._discard([])
+                return
+        self._close_segment()
+
+    def _flush(self, chunks):
+        if chunks:
+            try:
+                self._file.writelines(chunks)
+            except OSError as e:
+                self._failed(str(e))
 
-# Check for Pillow availability
-try:
-    from PIL import Image, ImageTk
-    PILLOW_AVAILABLE = True
-except ImportError:
-    PILLOW_AVAILABLE = False
-    print("Warning: Pillow not available, some image features may be limited")
+    def _failed(self, message):
+        self.error = message
+        try:
+            self._close_segment()
+        except OSError:
+            pass  # The buffered data can't be written either
+        self._file = None
+        if self.on_error is not None:
+            self.on_error(message)
+
+    def _discard(self, batch):
+        """Drops the rest of batch and keeps emptying the queue after an error, so add() and stop() never block"""
+        for frame in batch:
+            if frame is None:
+                return
+            self.dropped += 1
+        while self._queue.get() is not None:
+            self.dropped += 1
+
+
+class InstantReplayBuffer:
+    """Keeps the last seconds of the stream in memory, as received, to save after something happened.
+
+    add() is a pipeline listener. Frames older than seconds are evicted, and so
+    are the oldest ones while the frames take more than max_bytes. Repeated
+    frames share their data with the frame they repeat, so that data counts
+    towards max_bytes once: when the frame is evicted, its size is charged to
+    the first repeat still holding the data.
+    """
+
+    def __init__(self, seconds=30, max_bytes=64 * 1024 * 1024):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evicted = 0
+        self._frames = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def add(self, frame):
+        """Adds a frame, its data must not change afterwards (bytes)"""
+        size = 0 if frame.kind & FRAME_REPEAT else len(frame.data)
+        with self._lock:
+            self._frames.append((frame, size))
+            self.bytes += size
+            oldest = frame.timestamp - self.seconds
+            frames = self._frames
+            while len(frames) > 1 and (self.bytes > self.max_bytes or frames[0][0].timestamp < oldest):
+                evicted, size = frames.popleft()
+                self.bytes -= size
+                self.evicted += 1
+                if size:
+                    self._pass_on(evicted)
+
+    def _pass_on(self, evicted):
+        """Charges an evicted frame's data to its first repeat still kept, if any"""
+        for index, (frame, size) in enumerate(self._frames):
+            if frame.screen == evicted.screen:
+                # Only the screen's next frame can be a repeat of the evicted one
+                if frame.data is evicted.data and not size:
+                    self._frames[index] = (frame, len(frame.data))
+                    self.bytes += len(frame.data)
+                return
+
+    def frames(self):
+        """Returns the frames currently kept, oldest first"""
+        with self._lock:
+            return [frame for frame, _ in self._frames]
+
+
+def save_frame_image(frame, path, image_format="PNG"):
+    """Saves a frame upright to path plus the format's extension, returns the full path.
+
+    Plain JPEG frames saved as JPEG are written as received with an EXIF
+    orientation added, like the MJPEG server sends them, instead of being
+    decoded and encoded again.
+    """
+    if image_format == "JPEG":
+        path += ".jpg"
+        if frame.kind & (FRAME_COMPRESSION | FRAME_STRIPS | FRAME_SWAP_RB) == FRAME_JPEG:
+            with open(path, "wb") as f:
+                f.writelines((frame.data[:2], MJPEG_EXIF_UPRIGHT, frame.data[2:]))
+        else:
+            decode_frame(frame).save(path, "JPEG", quality=95)
+    else:
+        path += ".png"
+        decode_frame(frame).save(path, "PNG")
+    return path
+
+
+def save_replay(frames, directory, prefix="replay", images=False, image_format="PNG"):
+    """Writes frames from an InstantReplayBuffer to directory, returns the paths written.
+
+    The frames become a frame log clip that can be opened like any recording,
+    or with images one image file per frame in a new folder (repeats are skipped).
+    """
+    directory = os.path.expanduser(directory)
+    if not images:
+        recorder = FrameRecorder(directory, prefix=prefix, max_pending=len(frames) + 1)
+        recorder.start()
+        for frame in frames:
+            recorder.add(frame)
+        recorder.stop()
+        if recorder.error:
+            raise OSError(recorder.error)
+        return recorder.segments
+
+    directory = os.path.join(directory, "%s-%s" % (prefix, time.strftime("%Y%m%d-%H%M%S")))
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    saved = set()
+    for number, frame in enumerate(frames):
+        if frame.kind & FRAME_REPEAT and frame.screen in saved:
+            continue
+        saved.add(frame.screen)
+        name = "%05d-%s" % (number, SCREEN_NAMES[frame.screen])
+        paths.append(save_frame_image(frame, os.path.join(directory, name), image_format))
+    return paths
+
+
+class StreamSession:
+    """One console streamed by a SessionManager: its config, receiver, decoders and stats"""
+
+    def __init__(self, config, executor=None, max_decodes=1):
+        self.config = config
+        self.name = config.get("name") or config["ip"]
+        self.receiver = None
+        self.error = None
+        self.fd = None
+        self.pipeline = StreamPipeline(executor=executor, max_decodes=max_decodes)
+        self.backoff = Backoff()
+
+    @property
+    def stats(self):
+        return self.receiver.stats if self.receiver is not None else ReceiverStats()
+
+    @property
+    def stall_timeout(self):
+        return self.config["stall_timeout_ms"] / 1000 if self.config["auto_reconnect"] else None
+
+    def connect(self):
+        """Performs the blocking handshake and returns a non-blocking receiver"""
+        stats = self.receiver.stats if self.receiver is not None else None
+        self.pipeline.awaiting_frames()
+        self.receiver = open_receiver(self.config, timeout=0.0)
+        if stats is not None:
+            self.receiver.stats = stats
+        self.pipeline.receiver = self.receiver
+        self.pipeline.last_frame_at = time.monotonic()
+        return self.receiver
+
+    def disconnect(self):
+        """Closes the connection but keeps the decoders, for reconnecting"""
+        if self.receiver is not None:
+            self.receiver.close()
+
+    def close(self):
+        self.pipeline.stop()
+        self.disconnect()
+
+
+class SessionManager:
+    """Streams several consoles at once from a single selectors event loop.
+
+    Every session's socket is non-blocking and registered with one selector, so
+    adding consoles doesn't add receive threads. The handshakes (which wait on
+    the console) run on short-lived threads, and all sessions share one decoder
+    pool where each may keep at most max_decodes workers busy. NTR sessions get
+    their own UDP port (their stream_port, or the first free one if it isn't
+    set), the console's NTR must be patched to stream to it like the AutoIt
+    client's ListenPort setting.
+
+    Sessions with auto_reconnect set reconnect with an exponential backoff when
+    the handshake fails, the connection breaks or no frame arrives for
+    stall_timeout_ms.
+    """
+
+    def __init__(self, decode_workers=None, max_decodes=1):
+        self.sessions = []
+        self.max_decodes = max_decodes
+        self.running = False
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=decode_workers or os.cpu_count() or 2,
+                                            thread_name_prefix="decode")
+        self._selector = selectors.DefaultSelector()
+        self._ready = deque()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+        self._thread = None
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._loop, name="sessions", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake()
+        for session in list(self.sessions):
+            self.remove(session)
+        self._executor.shutdown(wait=False)
+
+    def next_stream_port(self):
+        return next_stream_port({session.config["stream_port"] for session in self.sessions})
+
+    def add(self, session_config):
+        """Creates a session for a console and starts connecting to it"""
+        config = copy.deepcopy(DEFAULT_CONFIG)
+        config.update(session_config)
+        if config["streaming_app"] == "HzMod":
+            config["stream_port"] = None  # HzMod streams over its TCP connection
+        elif "stream_port" not in session_config:
+            config["stream_port"] = self.next_stream_port()
+        session = StreamSession(config, self._executor, self.max_decodes)
+        self.sessions.append(session)
+        session.pipeline.start()
+        threading.Thread(target=self._connect, args=(session,), name="connect", daemon=True).start()
+        return session
+
+    def remove(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+        self._ready.append(("remove", session))
+        self._wake()
+
+    def _connect(self, session, delay=0.0):
+        while True:
+            time.sleep(delay)
+            if not self.running or session not in self.sessions:
+                return
+            try:
+                session.connect()
+                if not self.running or session not in self.sessions:
+                    # Stopped or removed during the handshake, the event loop may not be there to close it
+                    session.close()
+                    return
+                session.error = None
+                session.backoff.reset()
+                self._ready.append(("add", session))
+                break
+            except Exception as e:
+                session.error = str(e)
+                if not session.config["auto_reconnect"]:
+                    session.close()
+                    break
+                session.disconnect()
+                delay = session.backoff.delay()
+        self._wake()
+
+    def _reconnect(self, session, error):
+        """Drops a broken or stalled connection and starts connecting again, or closes the session"""
+        session.error = error
+        self._unregister(session)
+        if not session.config["auto_reconnect"] or session not in self.sessions:
+            session.close()
+            return
+        session.disconnect()
+        threading.Thread(target=self._connect, args=(session, session.backoff.delay()),
+                         name="connect", daemon=True).start()
+
+    def _wake(self):
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            pass
+
+    def _loop(self):
+        while self.running:
+            for key, _ in self._selector.select(timeout=0.5):
+                session = key.data
+                if session is None:
+                    try:
+                        self._wakeup_recv.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    session.receiver.drain(session.pipeline.submit)
+                except Exception as e:
+                    self._reconnect(session, str(e))
+            now = time.monotonic()
+            for key in list(self._selector.get_map().values()):
+                session = key.data
+                if session is None or session.stall_timeout is None:
+                    continue
+                if now - session.pipeline.last_frame_at > session.stall_timeout and now > session.pipeline.quiet_until:
+                    session.pipeline.stalls += 1
+                    self._reconnect(session, "No frame received for %d ms" % session.config["stall_timeout_ms"])
+            while self._ready:
+                action, session = self._ready.popleft()
+                if action == "add" and session in self.sessions:
+                    session.fd = session.receiver.fileno()
+                    self._selector.register(session.fd, selectors.EVENT_READ, session)
+                else:
+                    self._unregister(session)
+                    session.close()
+        for key in list(self._selector.get_map().values()):
+            if key.data is not None:
+                key.data.close()
+        self._selector.close()
+
+    def _unregister(self, session):
+        if session.fd is None:
+            return
+        try:
+            self._selector.unregister(session.fd)
+        except (KeyError, ValueError):
+            pass
+        session.fd = None
+
+
+def synthetic_frames(count=30, quality=80):
+    """Generates sideways JPEGs for both screens (a moving bar over a gradient), as (screen, data) pairs"""
+    frames = []
+    for index in range(count):
+        for screen in (SCREEN_TOP, SCREEN_BOTTOM):
+            width, height = SCREEN_SIZES[screen]
+            image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+            bar = Image.new("RGB", (40, height), (255, 64 * screen, 32))
+            image.paste(bar, ((index * width // count), 0))
+            image = image.transpose(Image.ROTATE_270)
+            output = io.BytesIO()
+            image.save(output, "JPEG", quality=quality)
+            frames.append((screen, output.getvalue()))
+    return frames
+
+
+def recorded_frames(path):
+    """Loads the JPEG frames of a recording as (screen, data) pairs.
+
+    Frames made of strips are put back together and encoded again as one JPEG.
+    """
+    log = FrameLog(path)
+    try:
+        frames = []
+        for i in range(len(log)):
+            kind = log.index.kinds[i]
+            if kind & FRAME_COMPRESSION != FRAME_JPEG:
+                continue
+            data = log.frame(i).data
+            if kind & FRAME_STRIPS:
+                output = io.BytesIO()
+                decode_strips(data).save(output, "JPEG", quality=95)
+                data = output.getvalue()
+            frames.append((log.index.screens[i], bytes(data)))
+        return frames
+    finally:
+        log.close()
+
+
+class NTREmulator:
+    """Local stand-in for a 3DS running NTR CFW.
+
+    Accepts the remoteplay handshake on TCP and then streams the given frames
+    over UDP with NTR's packet layout at fps frames per second. Like NTR,
+    streaming only starts once the client has reconnected after the remoteplay
+    command, and reconnects within startup seconds of the command are ignored as
+    remoteplay is still starting. loss is the chance of dropping a packet,
+    reorder the chance of swapping it with the next one. The send time of every
+    frame is kept in sent_at by (screen, frame ID).
+    """
+
+    def __init__(self, frames, fps=60, loss=0.0, reorder=0.0, host="127.0.0.1", stream_port=NTR_STREAM_PORT,
+                 seed=None, startup=0.0):
+        self.frames = frames
+        self.fps = fps
+        self.loss = loss
+        self.reorder = reorder
+        self.host = host
+        self.stream_port = stream_port
+        self.sent = 0
+        self.sent_at = {}
+        self.startup = startup
+        self.running = False
+        self._remoteplay_at = None
+        self._random = random.Random(seed)
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, 0))
+        self._server.listen(4)
+        self.port = self._server.getsockname()[1]
+        self._streaming = threading.Event()
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._accept_loop, name="ntr-emulator", daemon=True).start()
+        threading.Thread(target=self._stream_loop, name="ntr-emulator-stream", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self._streaming.set()
+        self._server.close()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                connection, address = self._server.accept()
+            except OSError:
+                return
+            with connection:
+                connection.settimeout(1.0)
+                try:
+                    packet = connection.recv(84)
+                except OSError:
+                    continue
+                if packet[:4] == bytes.fromhex("78563412"):
+                    self.stream_host = address[0]
+                    self._remoteplay_at = time.monotonic()
+                elif (self._remoteplay_at is not None
+                      and time.monotonic() - self._remoteplay_at >= self.startup):
+                    self._streaming.set()
+
+    def _stream_loop(self):
+        self._streaming.wait()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        frame_id = 0
+        next_frame = time.monotonic()
+        while self.running:
+            screen, data = self.frames[self.sent % len(self.frames)]
+            packets = [packet for packet in ntr_packets(frame_id, screen, data)
+                       if self._random.random() >= self.loss]
+            for index in range(len(packets) - 1):
+                if self._random.random() < self.reorder:
+                    packets[index], packets[index + 1] = packets[index + 1], packets[index]
+            self.sent_at[(screen, frame_id)] = time.monotonic()
+            for packet in packets:
+                sock.sendto(packet, (self.stream_host, self.stream_port))
+            self.sent += 1
+            frame_id = (frame_id + 1) & 0xFF
+            next_frame += 1.0 / self.fps
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_frame = time.monotonic()  # Can't keep up, don't try to catch up in a burst
+        sock.close()
+
+
+class HzModEmulator:
+    """Local stand-in for a 3DS running HzMod.
+
+    Streams the top screen frames over TCP once the start command is received,
+    interleaved with the mode and debug packets HzMod sends. Quality change
+    commands are applied to quality. TCP doesn't lose or reorder data, so only
+    the frame rate can be set. Frame IDs start at 1 like HzModReceiver's. With
+    strips above 1, each frame is sent as that many strips like HzMod can.
+    """
+
+    def __init__(self, frames, fps=60, host="127.0.0.1", strips=1):
+        self.frames = [self._split(data, strips) for screen, data in frames if screen == SCREEN_TOP]
+        self.fps = fps
+        self.quality = None
+        self.sent = 0
+        self.sent_at = {}
+        self.running = False
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._serve, name="hzmod-emulator", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self._server.close()
+
+    @staticmethod
+    def _packet(packet_type, payload):
+        size = len(payload)
+        return bytes((packet_type, size & 0xFF, (size >> 8) & 0xFF, size >> 16)) + payload
+
+    @staticmethod
+    def _split(data, strips):
+        """Cuts a sideways frame into strips along its height, one JPEG each"""
+        if strips <= 1:
+            return [data]
+        image = Image.open(io.BytesIO(data))
+        height = image.height // strips
+        parts = []
+        for i in range(strips):
+            output = io.BytesIO()
+            image.crop((0, height * i, image.width, height * (i + 1))).save(output, "JPEG", quality=90)
+            parts.append(output.getvalue())
+        return parts
+
+    def _read_commands(self, pending):
+        """Applies the complete commands in pending, returns True once streaming was requested"""
+        started = False
+        while len(pending) >= 9 and pending[0] == 0x7E:
+            command, value = pending[4], pending[8]
+            del pending[:9]
+            if command == HZMOD_COMMAND_QUALITY:
+                self.quality = value
+            elif command == HZMOD_COMMAND_START:
+                started = True
+        return started
+
+    def _serve(self):
+        try:
+            connection, _ = self._server.accept()
+        except OSError:
+            return
+        with connection:
+            pending = bytearray()
+            started = False
+            while not started and self.running:
+                data = connection.recv(64)
+                if not data:
+                    return
+                pending += data
+                started = self._read_commands(pending)
+            connection.setblocking(False)
+            connection.sendall(self._packet(HZMOD_PACKET_MODE, b"\x01\x00"))
+            next_frame = time.monotonic()
+            while self.running:
+                try:
+                    pending += connection.recv(64)
+                    self._read_commands(pending)
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    return
+                packet = self._packet(HZMOD_PACKET_DEBUG, b"") + b"".join(
+                    self._packet(HZMOD_PACKET_JPEG, bytes(HZMOD_IMAGE_HEADER_SIZE) + data)
+                    for data in self.frames[self.sent % len(self.frames)])
+                self.sent += 1
+                self.sent_at[(SCREEN_TOP, self.sent & 0xFF)] = time.monotonic()
+                connection.setblocking(True)
+                try:
+                    connection.sendall(packet)
+                except OSError:
+                    return
+                connection.setblocking(False)
+                next_frame += 1.0 / self.fps
+                delay = next_frame - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_frame = time.monotonic()
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an unsorted list, None when it's empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_benchmark(app="NTR CFW", duration=10.0, fps=60, loss=0.0, reorder=0.0, source=None, decode=True,
+                  stream_port=None, processes=False, startup=0.0):
+    """Streams from a local emulator through the receive/decode path and returns the measurements.
+
+    Latencies are in milliseconds: receive is from the emulator sending a frame
+    to the receiver completing it, decode is the decode itself and end_to_end
+    runs until the decoded frame is taken from its mailbox, like the presenter does.
+    With processes, a ProcessPipeline is measured instead of a StreamPipeline.
+    startup is how long the emulated NTR takes to start remoteplay.
+    """
+    frames = recorded_frames(source) if source else synthetic_frames()
+    if app == "HzMod":
+        emulator = HzModEmulator(frames, fps=fps)
+    else:
+        emulator = NTREmulator(frames, fps=fps, loss=loss, reorder=reorder,
+                               stream_port=stream_port or NTR_STREAM_PORT, seed=1, startup=startup)
+    emulator.start()
+
+    def open_emulator():
+        if app == "HzMod":
+            receiver = HzModReceiver("127.0.0.1", emulator.port)
+            receiver.open()
+            return receiver
+        receiver = NTRReceiver(port=emulator.stream_port)
+        receiver.open()
+        ntr_init_remoteplay("127.0.0.1", port=emulator.port, ready=receiver.wait_ready)
+        return receiver
+
+    receive_latency = []
+    decode_times = []
+    end_to_end = []
+
+    def on_frame(frame):
+        sent_at = emulator.sent_at.get((frame.screen, frame.frame_id))
+        if sent_at is not None:
+            receive_latency.append((frame.timestamp - sent_at) * 1000)
+
+    errors = []
+    if processes:
+        config = dict(DEFAULT_CONFIG, ip="127.0.0.1", port=emulator.port, streaming_app=app,
+                      stream_port=stream_port or NTR_STREAM_PORT)
+        pipeline = ProcessPipeline(functools.partial(open_receiver, config), on_frame=on_frame,
+                                   on_error=errors.append, app=app)
+    else:
+        pipeline = StreamPipeline(open_emulator, on_frame=on_frame, on_error=errors.append)
+    if not decode:
+        pipeline.set_targets({SCREEN_TOP: None, SCREEN_BOTTOM: None})
+    pipeline.start()
+    started = time.monotonic()
+    presented = 0
+    try:
+        while time.monotonic() - started < duration and not errors:
+            for mailbox in pipeline.decoded.values():
+                decoded = mailbox.take()
+                if decoded is None:
+                    continue
+                presented += 1
+                decode_times.append((decoded.decoded_at - decoded.decode_started) * 1000)
+                sent_at = emulator.sent_at.get((decoded.screen, decoded.frame_id))
+                if sent_at is not None:
+                    end_to_end.append((time.monotonic() - sent_at) * 1000)
+            time.sleep(0.001)
+    finally:
+        # Stop sending first, so frames still in flight aren't counted as dropped
+        emulator.stop()
+        elapsed = time.monotonic() - started
+        pipeline.stop()
+    if errors:
+        raise RuntimeError(errors[0])
+
+    # Rates are over the time frames were streaming, starting up is measured separately
+    startup = pipeline.time_to_first_frame or 0.0
+    elapsed = max(elapsed - startup, 1e-6)
+    stats = pipeline.receiver.stats
+    results = {
+        "app": app,
+        "duration": round(elapsed, 2),
+        "time_to_first_frame_ms": round(startup * 1000, 1),
+        "frames_sent": emulator.sent,
+        "frames_received": stats.frames,
+        "received_fps": round(stats.frames / elapsed, 1),
+        "presented_fps": round(presented / elapsed, 1),
+        "drop_rate": round(1 - stats.frames / emulator.sent, 4) if emulator.sent else 0.0,
+        "dropped": stats.dropped,
+        "incomplete": stats.incomplete,
+        "reordered": stats.reordered,
+        "skipped_before_decode": pipeline.skipped,
+        "repeated": pipeline.repeated,
+    }
+    for name, values in (("receive_ms", receive_latency), ("decode_ms", decode_times),
+                         ("end_to_end_ms", end_to_end)):
+        for label, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            value = percentile(values, fraction)
+            results["%s_%s" % (name, label)] = round(value, 2) if value is not None else None
+    return results
+
+
+def benchmark_main(args):
+    """Runs the benchmark described by the command line and prints the results"""
+    if not PILLOW_AVAILABLE:
+        print("Error: Pillow is required to run the benchmark.")
+        return 1
+    results = run_benchmark(app="HzMod" if args.app == "hzmod" else "NTR CFW", duration=args.duration,
+                            fps=args.fps, loss=args.loss, reorder=args.reorder, source=args.source,
+                            decode=not args.no_decode, stream_port=args.stream_port,
+                            processes=args.processes, startup=args.startup)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print("%-24s %s" % (key, value))
+    return 0
+
+
+def headless_pipeline(args, decode=False, processes=False):
+    """Builds a StreamPipeline for the command line modes, from a recording or from a 3DS.
+
+    With processes, a live stream gets a ProcessPipeline.
+    """
+    if getattr(args, "recording", None):
+        pipeline = StreamPipeline(lambda: ReplaySource(args.recording))
+    else:
+        config = read_config(args.config)
+        for key, value in (("ip", args.ip), ("port", args.port), ("quality", args.quality), ("qos", args.qos),
+                           ("priority_factor", args.priority_factor), ("stream_port", args.stream_port)):
+            if value is not None:
+                config[key] = value
+        if args.app is not None:
+            config["streaming_app"] = "HzMod" if args.app == "hzmod" else "NTR CFW"
+        if args.priority_screen is not None:
+            config["priority_screen"] = args.priority_screen.capitalize()
+        if not config["ip"]:
+            raise ValueError("No 3DS IP address given (--ip) or saved in " + args.config)
+        if args.no_reconnect:
+            config["auto_reconnect"] = False
+        if args.stall_timeout is not None:
+            config["stall_timeout_ms"] = args.stall_timeout
+        reconnect = config["auto_reconnect"]
+        stall_timeout = config["stall_timeout_ms"] / 1000 if reconnect else None
+        if processes:
+            pipeline = ProcessPipeline(functools.partial(open_receiver, config, timeout=5.0), reconnect=reconnect,
+                                       stall_timeout=stall_timeout, app=config["streaming_app"])
+        else:
+            pipeline = StreamPipeline(lambda: open_receiver(config, timeout=5.0), reconnect=reconnect,
+                                      stall_timeout=stall_timeout)
+        pipeline.on_reconnecting = lambda reason, delay: print(
+            "%s - reconnecting in %.1f s" % (reason, delay), file=sys.stderr, flush=True)
+    if not decode:
+        pipeline.set_targets({SCREEN_TOP: None, SCREEN_BOTTOM: None})
+    return pipeline
+
+
+def run_headless(pipeline, args):
+    """Runs a pipeline until args.duration is up, the stream ends or Ctrl+C, printing stats every second"""
+    errors = []
+    pipeline.on_error = errors.append
+    exports = []
+    if args.telemetry_log:
+        exports.append(TelemetryLogger(args.telemetry_log, pipeline.snapshot))
+    if args.metrics_port:
+        exports.append(MetricsServer(pipeline.snapshot, args.metrics_port))
+    pipeline.start()
+    for export in exports:
+        export.start()
+    deadline = time.monotonic() + args.duration if args.duration else None
+    try:
+        while pipeline.running and (deadline is None or time.monotonic() < deadline):
+            time.sleep(1.0)
+            receiver = pipeline.receiver
+            if isinstance(receiver, ReplaySource) and receiver.position >= receiver.total:
+                if not getattr(args, "loop", False):
+                    break
+                receiver.seek_position(0)
+            if receiver is None or args.quiet:
+                continue
+            snapshot = pipeline.snapshot()
+            if args.json:
+                print(json.dumps(snapshot), flush=True)
+            else:
+                stats = snapshot["receiver"]
+                print("top %5.1f fps  bottom %5.1f fps  %7d KB  dropped %d  incomplete %d  repeated %d" % (
+                    snapshot["screens"]["top"]["received_fps"], snapshot["screens"]["bottom"]["received_fps"],
+                    stats["bytes"] // 1024, stats["dropped"], stats["incomplete"], snapshot["repeated"]), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipeline.stop()
+        for export in exports:
+            export.stop()
+    if pipeline.time_to_first_frame is not None and not args.json:
+        print("time to first frame %d ms  reconnects %d  stalls %d%s" % (
+            pipeline.time_to_first_frame * 1000, pipeline.reconnects, pipeline.stalls,
+            "  last reconnect %d ms" % (pipeline.last_reconnect_time * 1000)
+            if pipeline.last_reconnect_time is not None else ""), flush=True)
+    if errors:
+        print("Error: " + errors[0], file=sys.stderr)
+        return 1
+    return 0
+
+
+def connect_main(args):
+    """Streams from a 3DS without a window, decoding only when asked to"""
+    if args.decode and not PILLOW_AVAILABLE:
+        print("Error: Pillow is required to decode the stream.")
+        return 1
+    return run_headless(headless_pipeline(args, decode=args.decode, processes=args.processes), args)
+
+
+def record_main(args):
+    """Records a 3DS stream to a frame log without decoding it"""
+    pipeline = headless_pipeline(args)
+    errors = []
+
+    def on_error(message):
+        # There's no point streaming on without a recording
+        errors.append(message)
+        print("Error: recording failed: " + message, file=sys.stderr, flush=True)
+        pipeline.stop()
+
+    recorder = FrameRecorder(args.output, prefix=args.prefix,
+                             segment_bytes=args.segment_mb * 1024 * 1024,
+                             segment_seconds=args.segment_minutes * 60, on_error=on_error)
+    recorder.start()
+    pipeline.add_listener(recorder.add)
+    try:
+        status = run_headless(pipeline, args)
+    finally:
+        recorder.stop()
+    return 1 if errors else status
+
+
+def serve_main(args):
+    """Sends a live stream or a recording on to another client in NTR's UDP format, and/or to MJPEG viewers"""
+    if args.to is None and not args.mjpeg_port:
+        print("Error: nothing to serve to, give --to and/or --mjpeg-port", file=sys.stderr)
+        return 1
+    pipeline = headless_pipeline(args)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target = (args.to, args.to_port)
+    frame_ids = {SCREEN_TOP: 0, SCREEN_BOTTOM: 0}
+
+    def send(frame):
+        # Frames are numbered per screen, NTRReceiver expects each screen's IDs in order
+        frame_ids[frame.screen] = (frame_ids[frame.screen] + 1) & 0xFF
+        for packet in ntr_packets(frame_ids[frame.screen], frame.screen, frame.data):
+            sock.sendto(packet, target)
+
+    if args.to is not None:
+        pipeline.add_listener(send)
+    mjpeg_server = None
+    if args.mjpeg_port:
+        mjpeg_server = MJPEGServer(args.mjpeg_port, host=args.mjpeg_host)
+        pipeline.add_listener(mjpeg_server.add)
+        mjpeg_server.start()
+        print("Serving MJPEG on http://%s:%d/" % (args.mjpeg_host, mjpeg_server.port), flush=True)
+    try:
+        return run_headless(pipeline, args)
+    finally:
+        sock.close()
+        if mjpeg_server is not None:
+            mjpeg_server.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Snickerstream - Nintendo 3DS Streaming Client",
+                                     epilog="Without a command the streaming window is opened.")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    connection = argparse.ArgumentParser(add_help=False)
+    group = connection.add_argument_group("connection options (default to the saved configuration)")
+    group.add_argument("--config", default=CONFIG_PATH, help="configuration file to start from")
+    group.add_argument("--ip", help="IP address of the 3DS")
+    group.add_argument("--app", choices=["ntr", "hzmod"], help="streaming app running on the 3DS")
+    group.add_argument("--port", type=int, help="TCP port of the streaming app")
+    group.add_argument("--quality", type=int, help="JPEG quality (1-100)")
+    group.add_argument("--qos", type=int, help="NTR QoS value")
+    group.add_argument("--priority-screen", choices=["top", "bottom"], help="NTR priority screen")
+    group.add_argument("--priority-factor", type=int, help="NTR priority factor")
+    group.add_argument("--stream-port", type=int, help="UDP port NTR streams to")
+    group.add_argument("--no-reconnect", action="store_true", help="stop on a connection error or stall")
+    group.add_argument("--stall-timeout", type=int, help="reconnect when no frame arrives for this many ms")
+
+    output = argparse.ArgumentParser(add_help=False)
+    group = output.add_argument_group("run options")
+    group.add_argument("--duration", type=float, default=0, help="seconds to run for (default: until Ctrl+C)")
+    group.add_argument("--json", action="store_true", help="print stats as JSON lines")
+    group.add_argument("--quiet", action="store_true", help="don't print stats every second")
+    group.add_argument("--telemetry-log", help="append telemetry as JSON lines to this file")
+    group.add_argument("--metrics-port", type=int, default=0, help="serve /metrics on this localhost port")
+
+    commands.add_parser("gui", help="open the streaming window (default)")
+
+    command = commands.add_parser("connect", parents=[connection, output],
+                                  help="stream from a 3DS without a window and print stats")
+    command.add_argument("--decode", action="store_true", help="decode the frames too, to measure decode cost")
+    command.add_argument("--processes", action="store_true",
+                         help="receive and decode in separate processes through shared memory")
+
+    command = commands.add_parser("record", parents=[connection, output], help="record a 3DS stream to disk")
+    command.add_argument("--output", default=DEFAULT_CONFIG["recording_dir"], help="folder to record to")
+    command.add_argument("--prefix", default="capture", help="file name prefix of the recording")
+    command.add_argument("--segment-mb", type=int, default=512, help="start a new file after this many MB")
+    command.add_argument("--segment-minutes", type=float, default=15, help="start a new file after this long")
+
+    command = commands.add_parser("serve", parents=[connection, output],
+                                  help="send a live stream or a recording on to another client")
+    command.add_argument("--recording", nargs="+", help="serve these recording segments instead of a 3DS")
+    command.add_argument("--loop", action="store_true", help="start the recording over when it ends")
+    command.add_argument("--to", help="address of a client to send the stream to as NTR UDP packets")
+    command.add_argument("--to-port", type=int, default=NTR_STREAM_PORT, help="UDP port of that client")
+    command.add_argument("--mjpeg-port", type=int, default=0,
+                         help="serve the stream to viewers as MJPEG over HTTP on this port")
+    command.add_argument("--mjpeg-host", default="127.0.0.1", help="address the MJPEG server listens on")
+
+    bench = commands.add_parser("benchmark",
+                                help="stream from a local NTR/HzMod emulator and report throughput and latency")
+    bench.add_argument("--app", choices=["ntr", "hzmod"], default="ntr", help="protocol to emulate")
+    bench.add_argument("--duration", type=float, default=10.0, help="seconds to stream for")
+    bench.add_argument("--fps", type=float, default=60.0, help="frames per second sent by the emulator")
+    bench.add_argument("--loss", type=float, default=0.0, help="chance of dropping each NTR packet")
+    bench.add_argument("--reorder", type=float, default=0.0, help="chance of swapping each NTR packet with the next")
+    bench.add_argument("--source", help="replay the frames of a recording instead of synthetic ones")
+    bench.add_argument("--stream-port", type=int, help="UDP port for the NTR stream (default 8001)")
+    bench.add_argument("--no-decode", action="store_true", help="only measure the receive path")
+    bench.add_argument("--startup", type=float, default=0.0,
+                       help="seconds the emulated NTR takes to start remoteplay after the command")
+    bench.add_argument("--processes", action="store_true",
+                       help="receive and decode in separate processes through shared memory")
+    bench.add_argument("--json", action="store_true", help="print the results as a JSON object")
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # Older scripts use --benchmark
+    if argv and argv[0] == "--benchmark":
+        argv[0] = "benchmark"
+    return parser.parse_args(argv)
+
+
+class ScreenRenderer:
+    """Paints decoded frames onto Tk canvases without creating Tk objects per frame.
+
+    Every shown screen gets one PhotoImage and one canvas item, made when the
+    geometry changes. Painting a frame is then a single paste() into the
+    screen's PhotoImage.
+    """
+
+    def __init__(self, canvases):
+        self.canvases = canvases
+        self.photos = {}
+        self.items = {}
+        self.sizes = {}
+
+    def configure(self, geometry):
+        """Sizes the canvases and places the screens, geometry being what layout_geometry() returns"""
+        window_sizes, screens = geometry
+        for canvas, (width, height) in zip(self.canvases, window_sizes):
+            canvas.config(width=width, height=height)
+        for screen, rect in screens.items():
+            if rect is None:
+                if screen in self.items:
+                    self.canvases[self.items[screen][0]].itemconfigure(self.items[screen][1], state="hidden")
+                self.sizes.pop(screen, None)
+                continue
+            window, x, y, width, height = rect
+            if self.sizes.get(screen) != (width, height):
+                self.photos[screen] = ImageTk.PhotoImage("RGB", (width, height))
+            if screen in self.items and self.items[screen][0] != window:
+                self.canvases[self.items[screen][0]].delete(self.items[screen][1])
+                del self.items[screen]
+            if screen in self.items:
+                item = self.items[screen][1]
+                self.canvases[window].coords(item, x, y)
+                self.canvases[window].itemconfigure(item, image=self.photos[screen], state="normal")
+            else:
+                item = self.canvases[window].create_image(x, y, anchor="nw", image=self.photos[screen])
+                self.items[screen] = (window, item)
+            self.sizes[screen] = (width, height)
+
+    def paint(self, image, screen):
+        """Blits a decoded image, returns False if it was decoded for an older geometry"""
+        if self.sizes.get(screen) != image.size:
+            return False
+        self.photos[screen].paste(image)
+        return True
 
 
 class SnickerStreamGUI:
+    # How often the Tk main loop checks the consoles grid's mailboxes, the stream follows FrameScheduler.next_poll
+    PRESENT_INTERVAL_MS = 4
+    # Pillow resampling filter used for each interpolation setting
+    INTERPOLATION_FILTERS = {"Nearest": "NEAREST", "Linear": "BILINEAR", "Cubic": "BICUBIC", "Lanczos": "LANCZOS"}
+
     def __init__(self, root):
         self.root = root
         self.root.title("Snickerstream - Nintendo 3DS Streaming Client")
         self.root.geometry("600x500")
         
         # Configuration
-        self.config = {
-            "ip": "192.168.1.100",
-            "port": 8000,
-            "streaming_app": "NTR CFW",
-            "quality": 90,
-            "layout": "Vertical",
-            "interpolation": "Linear",
-            "auto_connect": False
-        }
+        self.config = copy.deepcopy(DEFAULT_CONFIG)
         
         self.load_config()
-        self.create_widgets()
         self.streaming = False
-        self.stream_thread = None
+        self.pipeline = None
+        self.stream_windows = []
+        self.recorder = None
+        self.instant_replay = None
+        # Newest frame received of each screen, for screenshots
+        self.latest_frames = {}
+        self.capture_executor = None
+        self.screenshots = 0
+        self.telemetry_logger = None
+        self.metrics_server = None
+        self.mjpeg_server = None
+        self.quality_controller = None
+        self.scheduler = None
+        self.present_job = None
+        self.replay = None
+        self.replay_window = None
+        self.session_manager = None
+        self.grid_window = None
+        self.sessions_status_job = None
+        self.grid_job = None
+        self.grid_cells = {}
+        # The Sessions tab already reads the session state
+        self.create_widgets()
         
     def create_widgets(self):
         # Main notebook for tabs
@@ -73,6 +3613,16 @@ class SnickerStreamGUI:
         notebook.add(advanced_frame, text="Advanced")
         self.create_advanced_tab(advanced_frame)
         
+        # Telemetry tab
+        telemetry_frame = ttk.Frame(notebook)
+        notebook.add(telemetry_frame, text="Telemetry")
+        self.create_telemetry_tab(telemetry_frame)
+        
+        # Sessions tab
+        sessions_frame = ttk.Frame(notebook)
+        notebook.add(sessions_frame, text="Sessions")
+        self.create_sessions_tab(sessions_frame)
+        
     def create_connection_tab(self, parent):
         # IP Address and Port
         ip_frame = ttk.LabelFrame(parent, text="3DS Connection", padding=10)
@@ -108,6 +3658,15 @@ class SnickerStreamGUI:
         ttk.Button(button_frame, text="Screenshot", 
                   command=self.take_screenshot).pack(side="left", padx=5)
         
+        ttk.Button(button_frame, text="Save Replay",
+                   command=self.save_instant_replay).pack(side="left", padx=5)
+        
+        self.record_btn = ttk.Button(button_frame, text="Record", command=self.toggle_recording)
+        self.record_btn.pack(side="left", padx=5)
+        
+        ttk.Button(button_frame, text="Open Recording",
+                   command=self.open_recording).pack(side="left", padx=5)
+        
         ttk.Button(button_frame, text="Settings", 
                   command=self.open_settings).pack(side="left", padx=5)
         
@@ -116,12 +3675,14 @@ class SnickerStreamGUI:
         status_label = ttk.Label(button_frame, textvariable=self.status_var)
         status_label.pack(side="right", padx=5)
         
-        # Preview area
-        preview_frame = ttk.LabelFrame(parent, text="Stream Preview", padding=10)
+        # Stream status
+        preview_frame = ttk.LabelFrame(parent, text="Stream", padding=10)
         preview_frame.pack(fill="both", expand=True, padx=10, pady=5)
         
-        self.preview_label = ttk.Label(preview_frame, text="Stream will appear here")
+        self.preview_label = ttk.Label(preview_frame, text="The stream opens in its own window")
         self.preview_label.pack(expand=True)
+        # The stream itself is painted in its own windows, see open_stream_windows
+        self.renderer = ScreenRenderer([])
         
     def create_settings_tab(self, parent):
         # Quality settings
@@ -137,6 +3698,18 @@ class SnickerStreamGUI:
         quality_label = ttk.Label(quality_frame, textvariable=self.quality_var)
         quality_label.grid(row=0, column=2, padx=5)
         
+        self.adaptive_quality_var = tk.BooleanVar(value=self.config["adaptive_quality"])
+        ttk.Checkbutton(quality_frame, text="Adapt to the connection, down to:",
+                       variable=self.adaptive_quality_var).grid(row=1, column=0, columnspan=2, sticky="w")
+        self.min_quality_var = tk.IntVar(value=self.config["min_quality"])
+        ttk.Spinbox(quality_frame, from_=10, to=100, increment=5, width=5,
+                    textvariable=self.min_quality_var).grid(row=1, column=2, padx=5)
+        
+        ttk.Label(quality_frame, text="Target FPS per screen:").grid(row=2, column=0, sticky="w")
+        self.target_fps_var = tk.IntVar(value=self.config["target_fps"])
+        ttk.Spinbox(quality_frame, from_=0, to=60, increment=5, width=5,
+                    textvariable=self.target_fps_var).grid(row=2, column=2, padx=5)
+        
         # Layout settings
         layout_frame = ttk.LabelFrame(parent, text="Screen Layout", padding=10)
         layout_frame.pack(fill="x", padx=10, pady=5)
@@ -159,6 +3732,23 @@ class SnickerStreamGUI:
                                    state="readonly")
         interp_combo.pack(side="left", padx=5)
         
+        # Scaling settings
+        scaling_frame = ttk.LabelFrame(parent, text="Scaling", padding=10)
+        scaling_frame.pack(fill="x", padx=10, pady=5)
+        
+        ttk.Label(scaling_frame, text="Top screen:").grid(row=0, column=0, sticky="w", padx=5)
+        self.top_scaling_var = tk.DoubleVar(value=self.config["top_scaling"])
+        ttk.Spinbox(scaling_frame, from_=0.3, to=8.0, increment=0.1, width=6,
+                    textvariable=self.top_scaling_var).grid(row=0, column=1, padx=5)
+        
+        ttk.Label(scaling_frame, text="Bottom screen:").grid(row=0, column=2, sticky="w", padx=5)
+        self.bottom_scaling_var = tk.DoubleVar(value=self.config["bottom_scaling"])
+        ttk.Spinbox(scaling_frame, from_=0.3, to=8.0, increment=0.1, width=6,
+                    textvariable=self.bottom_scaling_var).grid(row=0, column=3, padx=5)
+        
+        for var in (self.layout_var, self.interp_var, self.top_scaling_var, self.bottom_scaling_var):
+            var.trace_add("write", lambda *args: self.apply_display_settings())
+        
     def create_advanced_tab(self, parent):
         # Auto-connect
         auto_frame = ttk.LabelFrame(parent, text="Automation", padding=10)
@@ -168,6 +3758,57 @@ class SnickerStreamGUI:
         ttk.Checkbutton(auto_frame, text="Auto-connect on startup", 
                        variable=self.auto_connect_var).pack(anchor="w")
         
+        reconnect_frame = ttk.Frame(auto_frame)
+        reconnect_frame.pack(anchor="w")
+        self.auto_reconnect_var = tk.BooleanVar(value=self.config["auto_reconnect"])
+        ttk.Checkbutton(reconnect_frame, text="Reconnect when no frame arrives for (ms):",
+                       variable=self.auto_reconnect_var).pack(side="left")
+        self.stall_timeout_var = tk.IntVar(value=self.config["stall_timeout_ms"])
+        ttk.Spinbox(reconnect_frame, from_=250, to=30000, increment=250, width=6,
+                    textvariable=self.stall_timeout_var).pack(side="left", padx=5)
+        
+        # Presentation
+        present_frame = ttk.LabelFrame(parent, text="Presentation", padding=10)
+        present_frame.pack(fill="x", padx=10, pady=5)
+        
+        ttk.Label(present_frame, text="Mode:").grid(row=0, column=0, sticky="w", padx=5)
+        self.presentation_var = tk.StringVar(value=self.config["presentation"])
+        ttk.Combobox(present_frame, textvariable=self.presentation_var, values=FrameScheduler.MODES,
+                     state="readonly", width=15).grid(row=0, column=1, sticky="w", padx=5)
+        
+        ttk.Label(present_frame, text="Priority screen:").grid(row=0, column=2, sticky="w", padx=5)
+        self.priority_screen_var = tk.StringVar(value=self.config["priority_screen"])
+        ttk.Combobox(present_frame, textvariable=self.priority_screen_var, values=["Top", "Bottom"],
+                     state="readonly", width=8).grid(row=0, column=3, sticky="w", padx=5)
+        
+        ttk.Label(present_frame, text="Frame limit (0 = off):").grid(row=1, column=0, sticky="w", padx=5)
+        self.frame_limit_var = tk.IntVar(value=self.config["frame_limit"])
+        ttk.Spinbox(present_frame, from_=0, to=240, increment=5, width=5,
+                    textvariable=self.frame_limit_var).grid(row=1, column=1, sticky="w", padx=5)
+        
+        ttk.Label(present_frame, text="Other screen limit:").grid(row=1, column=2, sticky="w", padx=5)
+        self.secondary_frame_limit_var = tk.IntVar(value=self.config["secondary_frame_limit"])
+        ttk.Spinbox(present_frame, from_=0, to=240, increment=5, width=5,
+                    textvariable=self.secondary_frame_limit_var).grid(row=1, column=3, sticky="w", padx=5)
+        
+        # Smooth paints on the display's refresh ticks
+        ttk.Label(present_frame, text="Display refresh rate (Hz):").grid(row=2, column=0, sticky="w", padx=5)
+        self.refresh_rate_var = tk.IntVar(value=self.config["refresh_rate"])
+        ttk.Spinbox(present_frame, from_=24, to=360, increment=1, width=5,
+                    textvariable=self.refresh_rate_var).grid(row=2, column=1, sticky="w", padx=5)
+        
+        for var in (self.presentation_var, self.priority_screen_var, self.frame_limit_var,
+                    self.secondary_frame_limit_var, self.refresh_rate_var):
+            var.trace_add("write", lambda *args: self.apply_presentation_settings())
+        
+        # Performance
+        performance_frame = ttk.LabelFrame(parent, text="Performance", padding=10)
+        performance_frame.pack(fill="x", padx=10, pady=5)
+        
+        self.multiprocess_var = tk.BooleanVar(value=self.config["multiprocess"])
+        ttk.Checkbutton(performance_frame, text="Receive and decode in separate processes (next connection)",
+                       variable=self.multiprocess_var).pack(anchor="w")
+        
         # Hotkeys
         hotkey_frame = ttk.LabelFrame(parent, text="Keyboard Shortcuts", padding=10)
         hotkey_frame.pack(fill="x", padx=10, pady=5)
@@ -177,6 +3818,7 @@ class SnickerStreamGUI:
             ("UP/DOWN", "Increase/Decrease scaling"),
             ("LEFT/RIGHT", "Change interpolation"),
             ("S", "Take screenshot"),
+            ("R", "Save instant replay"),
             ("ENTER", "Return to connection window"),
             ("SPACE", "Pop up other screen (fullscreen modes)"),
         ]
@@ -185,6 +3827,39 @@ class SnickerStreamGUI:
             ttk.Label(hotkey_frame, text=f"{key}:").grid(row=i, column=0, sticky="w", padx=5)
             ttk.Label(hotkey_frame, text=desc).grid(row=i, column=1, sticky="w", padx=5)
         
+        # Recording
+        record_frame = ttk.LabelFrame(parent, text="Recording", padding=10)
+        record_frame.pack(fill="x", padx=10, pady=5)
+        
+        ttk.Label(record_frame, text="Folder:").pack(side="left", padx=5)
+        self.recording_dir_var = tk.StringVar(value=self.config["recording_dir"])
+        ttk.Entry(record_frame, textvariable=self.recording_dir_var, width=35).pack(side="left", padx=5)
+        ttk.Button(record_frame, text="Browse...", command=self.browse_recording_dir).pack(side="left")
+        
+        # Instant replay and screenshots
+        instant_frame = ttk.LabelFrame(parent, text="Instant Replay", padding=10)
+        instant_frame.pack(fill="x", padx=10, pady=5)
+        
+        ttk.Label(instant_frame, text="Keep last (s, 0 = off):").grid(row=0, column=0, sticky="w", padx=5)
+        self.replay_seconds_var = tk.IntVar(value=self.config["replay_seconds"])
+        ttk.Spinbox(instant_frame, from_=0, to=600, increment=10, width=5,
+                    textvariable=self.replay_seconds_var).grid(row=0, column=1, sticky="w", padx=5)
+        
+        ttk.Label(instant_frame, text="Up to (MB):").grid(row=0, column=2, sticky="w", padx=5)
+        self.replay_megabytes_var = tk.IntVar(value=self.config["replay_megabytes"])
+        ttk.Spinbox(instant_frame, from_=8, to=4096, increment=16, width=5,
+                    textvariable=self.replay_megabytes_var).grid(row=0, column=3, sticky="w", padx=5)
+        
+        ttk.Label(instant_frame, text="Save as:").grid(row=1, column=0, sticky="w", padx=5)
+        self.replay_format_var = tk.StringVar(value=self.config["replay_format"])
+        ttk.Combobox(instant_frame, textvariable=self.replay_format_var, values=["Clip", "Images"],
+                     state="readonly", width=8).grid(row=1, column=1, sticky="w", padx=5)
+        
+        ttk.Label(instant_frame, text="Image format:").grid(row=1, column=2, sticky="w", padx=5)
+        self.screenshot_format_var = tk.StringVar(value=self.config["screenshot_format"])
+        ttk.Combobox(instant_frame, textvariable=self.screenshot_format_var, values=["PNG", "JPEG"],
+                     state="readonly", width=8).grid(row=1, column=3, sticky="w", padx=5)
+        
         # Save/Load config
         config_frame = ttk.Frame(parent)
         config_frame.pack(fill="x", padx=10, pady=10)
@@ -196,6 +3871,265 @@ class SnickerStreamGUI:
         ttk.Button(config_frame, text="Reset to Defaults", 
                   command=self.reset_config).pack(side="left", padx=5)
         
+    def create_telemetry_tab(self, parent):
+        # Live stats
+        stats_frame = ttk.LabelFrame(parent, text="Live Stats", padding=10)
+        stats_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        
+        self.telemetry_var = tk.StringVar(value="Not streaming")
+        ttk.Label(stats_frame, textvariable=self.telemetry_var, font=("TkFixedFont", 9),
+                  justify="left").pack(anchor="nw")
+        
+        # Export
+        export_frame = ttk.LabelFrame(parent, text="Export", padding=10)
+        export_frame.pack(fill="x", padx=10, pady=5)
+        
+        ttk.Label(export_frame, text="JSON lines file:").grid(row=0, column=0, sticky="w", padx=5)
+        self.telemetry_log_var = tk.StringVar(value=self.config["telemetry_log"])
+        ttk.Entry(export_frame, textvariable=self.telemetry_log_var, width=35).grid(row=0, column=1, padx=5)
+        
+        ttk.Label(export_frame, text="Metrics port (0 = off):").grid(row=1, column=0, sticky="w", padx=5)
+        self.metrics_port_var = tk.StringVar(value=str(self.config["metrics_port"]))
+        ttk.Entry(export_frame, textvariable=self.metrics_port_var, width=8).grid(row=1, column=1, sticky="w", padx=5)
+        
+        ttk.Label(export_frame, text="MJPEG viewer port (0 = off):").grid(row=2, column=0, sticky="w", padx=5)
+        self.mjpeg_port_var = tk.StringVar(value=str(self.config["mjpeg_port"]))
+        ttk.Entry(export_frame, textvariable=self.mjpeg_port_var, width=8).grid(row=2, column=1, sticky="w", padx=5)
+        
+    def create_sessions_tab(self, parent):
+        # Console list
+        list_frame = ttk.LabelFrame(parent, text="Consoles", padding=10)
+        list_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        
+        self.sessions_tree = ttk.Treeview(list_frame, columns=("ip", "app", "port", "status"), height=6)
+        self.sessions_tree.heading("#0", text="Name")
+        self.sessions_tree.heading("ip", text="IP Address")
+        self.sessions_tree.heading("app", text="App")
+        self.sessions_tree.heading("port", text="UDP Port")
+        self.sessions_tree.heading("status", text="Status")
+        for column, width in (("#0", 110), ("ip", 110), ("app", 70), ("port", 70), ("status", 120)):
+            self.sessions_tree.column(column, width=width)
+        self.sessions_tree.pack(fill="both", expand=True)
+        
+        # New console
+        add_frame = ttk.Frame(parent)
+        add_frame.pack(fill="x", padx=10, pady=5)
+        
+        ttk.Label(add_frame, text="Name:").pack(side="left", padx=5)
+        self.session_name_var = tk.StringVar()
+        ttk.Entry(add_frame, textvariable=self.session_name_var, width=12).pack(side="left")
+        ttk.Label(add_frame, text="IP:").pack(side="left", padx=5)
+        self.session_ip_var = tk.StringVar()
+        ttk.Entry(add_frame, textvariable=self.session_ip_var, width=15).pack(side="left")
+        self.session_app_var = tk.StringVar(value="NTR CFW")
+        ttk.Combobox(add_frame, textvariable=self.session_app_var, values=["NTR CFW", "HzMod"],
+                     state="readonly", width=8).pack(side="left", padx=5)
+        # The port the console's NTR is patched to stream to, empty for the first free one
+        ttk.Label(add_frame, text="UDP Port:").pack(side="left")
+        self.session_port_var = tk.StringVar()
+        ttk.Entry(add_frame, textvariable=self.session_port_var, width=6).pack(side="left", padx=5)
+        ttk.Button(add_frame, text="Add / Update", command=self.add_session).pack(side="left", padx=5)
+        ttk.Button(add_frame, text="Remove", command=self.remove_session).pack(side="left")
+        self.sessions_tree.bind("<<TreeviewSelect>>", lambda e: self.select_session())
+        
+        # Control buttons
+        button_frame = ttk.Frame(parent)
+        button_frame.pack(fill="x", padx=10, pady=10)
+        
+        ttk.Button(button_frame, text="Start All", command=self.start_sessions).pack(side="left", padx=5)
+        ttk.Button(button_frame, text="Stop All", command=self.stop_sessions).pack(side="left", padx=5)
+        ttk.Button(button_frame, text="Open Grid", command=self.open_grid).pack(side="left", padx=5)
+        
+        self.refresh_sessions()
+        
+    def refresh_sessions(self):
+        """Shows the configured consoles and the state of their sessions"""
+        self.assign_stream_ports()
+        live = {}
+        if self.session_manager is not None:
+            live = {session.config.get("name") or session.config["ip"]: session
+                    for session in self.session_manager.sessions}
+        self.sessions_tree.delete(*self.sessions_tree.get_children())
+        for entry in self.config["sessions"]:
+            name = entry.get("name") or entry["ip"]
+            session = live.get(name)
+            port = entry.get("stream_port", "-")
+            if session is None:
+                status = "Stopped"
+            elif session.error:
+                status = "Error: " + session.error
+            elif session.receiver is None:
+                status = "Connecting..."
+            else:
+                status = "%d frames" % session.stats.frames
+            self.sessions_tree.insert("", "end", text=name,
+                                      values=(entry["ip"], entry.get("streaming_app", "NTR CFW"), port, status))
+        
+    def assign_stream_ports(self):
+        """Gives every NTR console without a UDP port the first free one, so it's known before connecting"""
+        entries = [entry for entry in self.config["sessions"] if entry.get("streaming_app", "NTR CFW") != "HzMod"]
+        used = {entry["stream_port"] for entry in entries if entry.get("stream_port")}
+        for entry in entries:
+            if not entry.get("stream_port"):
+                entry["stream_port"] = next_stream_port(used)
+                used.add(entry["stream_port"])
+        
+    def select_session(self):
+        """Fills the console fields with the selected console, to edit it"""
+        selection = self.sessions_tree.selection()
+        if not selection:
+            return
+        name = self.sessions_tree.item(selection[0], "text")
+        for entry in self.config["sessions"]:
+            if (entry.get("name") or entry["ip"]) == name:
+                self.session_name_var.set(name)
+                self.session_ip_var.set(entry["ip"])
+                self.session_app_var.set(entry.get("streaming_app", "NTR CFW"))
+                self.session_port_var.set(str(entry.get("stream_port", "")))
+                return
+        
+    def add_session(self):
+        """Adds a console, or updates the one with the same name (restarting its session if it's running)"""
+        ip = self.session_ip_var.get().strip()
+        if not ip:
+            messagebox.showwarning("Missing IP", "Enter the console's IP address")
+            return
+        entry = {"name": self.session_name_var.get().strip() or ip, "ip": ip,
+                 "streaming_app": self.session_app_var.get()}
+        names = [existing.get("name") or existing["ip"] for existing in self.config["sessions"]]
+        others = [existing for name, existing in zip(names, self.config["sessions"]) if name != entry["name"]]
+        port = self.session_port_var.get().strip()
+        if entry["streaming_app"] != "HzMod" and port:
+            try:
+                entry["stream_port"] = int(port)
+            except ValueError:
+                entry["stream_port"] = 0
+            if not 1024 <= entry["stream_port"] <= 65535 or not ntr_port_usable(entry["stream_port"]):
+                messagebox.showwarning("Invalid Port", "NTR can't be patched to stream to UDP port %s" % port)
+                return
+            if any(existing.get("stream_port") == entry["stream_port"] for existing in others):
+                messagebox.showwarning("Port In Use", "Another console already streams to UDP port %s" % port)
+                return
+        if entry["name"] in names:
+            self.config["sessions"][names.index(entry["name"])] = entry
+        else:
+            self.config["sessions"].append(entry)
+        self.assign_stream_ports()
+        if self.session_manager is not None:
+            for session in list(self.session_manager.sessions):
+                if session.name == entry["name"]:
+                    self.session_manager.remove(session)
+            self.session_manager.add(self.session_config(entry))
+            self.rebuild_grid()
+        self.session_port_var.set("")
+        self.refresh_sessions()
+        
+    def session_config(self, entry):
+        """Settings a console of the session list is streamed with: the shared quality settings, then its own"""
+        config = {key: self.config[key] for key in ("quality", "priority_screen", "priority_factor", "qos")}
+        config.update(entry)
+        return config
+        
+    def remove_session(self):
+        names = [self.sessions_tree.item(item, "text") for item in self.sessions_tree.selection()]
+        self.config["sessions"] = [entry for entry in self.config["sessions"]
+                                   if (entry.get("name") or entry["ip"]) not in names]
+        if self.session_manager is not None:
+            for session in list(self.session_manager.sessions):
+                if session.name in names:
+                    self.session_manager.remove(session)
+            self.rebuild_grid()
+        self.refresh_sessions()
+        
+    def start_sessions(self):
+        if self.session_manager is not None:
+            return
+        if not PILLOW_AVAILABLE:
+            messagebox.showerror("Missing Pillow", "Pillow is required to display the stream")
+            return
+        self.update_config()
+        self.session_manager = SessionManager()
+        self.session_manager.start()
+        for entry in self.config["sessions"]:
+            self.session_manager.add(self.session_config(entry))
+        self.open_grid()
+        self.sessions_status_job = self.root.after(1000, self.update_sessions_status)
+        
+    def stop_sessions(self):
+        if self.sessions_status_job is not None:
+            self.root.after_cancel(self.sessions_status_job)
+            self.sessions_status_job = None
+        if self.session_manager is not None:
+            self.session_manager.stop()
+            self.session_manager = None
+        self.close_grid()
+        self.refresh_sessions()
+        
+    def update_sessions_status(self):
+        if self.session_manager is None:
+            return
+        self.refresh_sessions()
+        for session in self.session_manager.sessions:
+            cell = self.grid_cells.get(session)
+            if cell is not None:
+                frames = session.stats.frames
+                cell["frame"].config(text="%s - %d fps" % (session.name, frames - cell["last_frames"]))
+                cell["last_frames"] = frames
+        self.sessions_status_job = self.root.after(1000, self.update_sessions_status)
+        
+    def open_grid(self):
+        """Opens a window that tiles every live session"""
+        if self.session_manager is None:
+            messagebox.showwarning("No Sessions", "Start the sessions first")
+            return
+        if self.grid_window is None:
+            self.grid_window = tk.Toplevel(self.root)
+            self.grid_window.title("Snickerstream - Consoles")
+            self.grid_window.protocol("WM_DELETE_WINDOW", self.close_grid)
+            self.rebuild_grid()
+            self.grid_job = self.root.after(self.PRESENT_INTERVAL_MS, self.present_grid)
+        self.grid_window.lift()
+        
+    def close_grid(self):
+        if self.grid_job is not None:
+            self.root.after_cancel(self.grid_job)
+            self.grid_job = None
+        if self.grid_window is not None:
+            self.grid_window.destroy()
+            self.grid_window = None
+        
+    def rebuild_grid(self):
+        if self.grid_window is None or self.session_manager is None:
+            return
+        for cell in self.grid_cells.values():
+            cell["frame"].destroy()
+        self.grid_cells = {}
+        sessions = self.session_manager.sessions
+        columns = max(1, int(len(sessions) ** 0.5 + 0.999))
+        scaling = self.config["grid_scaling"]
+        for index, session in enumerate(sessions):
+            frame = ttk.LabelFrame(self.grid_window, text=session.name, padding=2)
+            frame.grid(row=index // columns, column=index % columns, padx=2, pady=2, sticky="n")
+            canvas = tk.Canvas(frame, width=0, height=0, background="#303030", highlightthickness=0)
+            canvas.pack()
+            renderer = ScreenRenderer([canvas])
+            renderer.configure(layout_geometry("Vertical", scaling, scaling))
+            self.grid_cells[session] = {"frame": frame, "renderer": renderer, "last_frames": 0}
+            session.pipeline.set_targets(screen_targets("Vertical", scaling, scaling))
+        
+    def present_grid(self):
+        """Paints the latest decoded frame of every session in the grid"""
+        if self.grid_window is None or self.session_manager is None:
+            return
+        for session, cell in self.grid_cells.items():
+            for screen, mailbox in session.pipeline.decoded.items():
+                decoded = mailbox.take()
+                if decoded is None:
+                    continue
+                if cell["renderer"].paint(decoded.image, screen):
+                    session.pipeline.telemetry.record_presented(decoded)
+        self.grid_job = self.root.after(self.PRESENT_INTERVAL_MS, self.present_grid)
+        
     def toggle_streaming(self):
         if not self.streaming:
             self.start_streaming()
@@ -204,14 +4138,16 @@ class SnickerStreamGUI:
     
     def start_streaming(self):
         try:
+            if not PILLOW_AVAILABLE:
+                raise RuntimeError("Pillow is required to display the stream")
             self.update_config()
-            self.streaming = True
-            self.connect_btn.config(text="Disconnect")
             self.status_var.set(f"Connecting to {self.config['ip']}:{self.config['port']}...")
-            
-            # Start streaming thread
-            self.stream_thread = threading.Thread(target=self.stream_worker, daemon=True)
-            self.stream_thread.start()
+            if self.config["multiprocess"]:
+                # The receiver process gets its own copy of the settings
+                self.start_pipeline(functools.partial(open_receiver, copy.deepcopy(self.config)),
+                                    live=True, processes=True)
+            else:
+                self.start_pipeline(self.open_receiver, live=True)
             
         except Exception as e:
             messagebox.showerror("Connection Error", f"Failed to start streaming: {str(e)}")
@@ -219,38 +4155,451 @@ class SnickerStreamGUI:
             self.connect_btn.config(text="Connect")
             self.status_var.set("Connection failed")
     
+    def start_pipeline(self, open_receiver, live=False, processes=False):
+        """Starts the receive/decode pipeline, frames are presented from the Tk main loop.
+
+        Live streams reconnect on their own when auto_reconnect is set. With
+        processes, open_receiver must be picklable, see ProcessPipeline.
+        """
+        self.streaming = True
+        self.connect_btn.config(text="Disconnect")
+        reconnect = live and self.config["auto_reconnect"]
+        stall_timeout = self.config["stall_timeout_ms"] / 1000 if reconnect else None
+        if processes:
+            self.pipeline = ProcessPipeline(open_receiver,
+                                            on_connected=self.on_stream_connected,
+                                            on_error=self.on_stream_error,
+                                            reconnect=reconnect, stall_timeout=stall_timeout,
+                                            app=self.config["streaming_app"],
+                                            max_image_size=(self.root.winfo_screenwidth(),
+                                                            self.root.winfo_screenheight()))
+        else:
+            self.pipeline = StreamPipeline(open_receiver,
+                                           on_connected=self.on_stream_connected,
+                                           on_error=self.on_stream_error,
+                                           reconnect=reconnect, stall_timeout=stall_timeout)
+        self.pipeline.on_reconnecting = self.on_stream_reconnecting
+        self.latest_frames = {}
+        self.pipeline.add_listener(self.keep_latest_frame)
+        # Kept after the stream stops, so what led up to a disconnect can still be saved
+        if self.config["replay_seconds"]:
+            self.instant_replay = InstantReplayBuffer(self.config["replay_seconds"],
+                                                      self.config["replay_megabytes"] * 1024 * 1024)
+            self.pipeline.add_listener(self.instant_replay.add)
+        else:
+            self.instant_replay = None
+        self.preview_label.config(text="Streaming in the stream window")
+        self.apply_display_settings()
+        self.apply_presentation_settings()
+        self.pipeline.start()
+        self.last_report = time.monotonic()
+        self.start_telemetry_export()
+        self.present_job = self.root.after(0, self.present_frames)
+
+    
+    def pipeline_snapshot(self):
+        pipeline = self.pipeline
+        return pipeline.snapshot() if pipeline is not None else None
+    
+    def start_telemetry_export(self):
+        """Starts the JSON lines log and the metrics endpoint if they're enabled"""
+        try:
+            if self.config["telemetry_log"] and self.telemetry_logger is None:
+                self.telemetry_logger = TelemetryLogger(self.config["telemetry_log"], self.pipeline_snapshot)
+                self.telemetry_logger.start()
+            if self.config["metrics_port"] and self.metrics_server is None:
+                self.metrics_server = MetricsServer(self.pipeline_snapshot, self.config["metrics_port"])
+                self.metrics_server.start()
+            if self.config["mjpeg_port"] and self.mjpeg_server is None:
+                self.mjpeg_server = MJPEGServer(self.config["mjpeg_port"])
+                self.pipeline.add_listener(self.mjpeg_server.add)
+                self.mjpeg_server.start()
+        except OSError as e:
+            messagebox.showwarning("Telemetry", f"Failed to start telemetry export: {str(e)}")
+    
+    def stop_telemetry_export(self):
+        if self.telemetry_logger is not None:
+            self.telemetry_logger.stop()
+            self.telemetry_logger = None
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.mjpeg_server is not None:
+            if self.pipeline is not None:
+                self.pipeline.remove_listener(self.mjpeg_server.add)
+            self.mjpeg_server.stop()
+            self.mjpeg_server = None
+    
     def stop_streaming(self):
         self.streaming = False
+        if self.present_job is not None:
+            self.root.after_cancel(self.present_job)
+            self.present_job = None
+        self.stop_recording()
+        self.stop_telemetry_export()
+        if self.quality_controller is not None:
+            self.quality_controller.stop()
+            self.quality_controller = None
+        self.root.title("Snickerstream - Nintendo 3DS Streaming Client")
+        self.open_stream_windows([])
+        self.preview_label.config(text="The stream opens in its own window")
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+        if self.replay_window is not None:
+            self.replay_window.destroy()
+            self.replay_window = None
+        self.replay = None
         self.connect_btn.config(text="Connect")
         self.status_var.set("Disconnected")
+    
+    def open_recording(self):
+        paths = filedialog.askopenfilenames(
+            title="Open Recording",
+            initialdir=os.path.expanduser(self.config["recording_dir"]),
+            filetypes=[("Snickerstream recordings", "*" + FRAMELOG_EXTENSION), ("All files", "*.*")]
+        )
+        if not paths:
+            return
+        if not PILLOW_AVAILABLE:
+            messagebox.showerror("Missing Pillow", "Pillow is required to display the stream")
+            return
+        if self.streaming:
+            self.stop_streaming()
+        try:
+            self.replay = ReplaySource(paths)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Open Error", f"Failed to open recording: {str(e)}")
+            return
+        self.start_pipeline(lambda: self.replay)
+        self.open_replay_controls()
+    
+    def open_replay_controls(self):
+        """Opens the play/pause, step, speed and seek controls of the current replay"""
+        replay = self.replay
+        self.replay_window = tk.Toplevel(self.root)
+        self.replay_window.title("Snickerstream - Replay")
+        self.replay_window.protocol("WM_DELETE_WINDOW", self.stop_streaming)
+        
+        button_frame = ttk.Frame(self.replay_window, padding=10)
+        button_frame.pack(fill="x")
+        ttk.Button(button_frame, text="<", width=3, command=lambda: replay.step(-1)).pack(side="left")
+        self.replay_play_btn = ttk.Button(button_frame, text="Pause", command=self.toggle_replay_pause)
+        self.replay_play_btn.pack(side="left", padx=5)
+        ttk.Button(button_frame, text=">", width=3, command=lambda: replay.step(1)).pack(side="left")
+        
+        speeds = {"0.5x": 0.5, "1x": 1.0, "2x": 2.0, "4x": 4.0, "Max": 0}
+        speed_var = tk.StringVar(value="1x")
+        speed_combo = ttk.Combobox(button_frame, textvariable=speed_var, values=list(speeds),
+                                   state="readonly", width=5)
+        speed_combo.pack(side="left", padx=10)
+        speed_combo.bind("<<ComboboxSelected>>", lambda e: replay.set_speed(speeds[speed_var.get()]))
         
-    def stream_worker(self):
-        """Simplified streaming worker - would need actual NTR/HzMod protocol implementation"""
+        self.replay_time_var = tk.StringVar()
+        ttk.Label(button_frame, textvariable=self.replay_time_var).pack(side="right")
+        
+        self.replay_seek_var = tk.DoubleVar(value=0)
+        seek_scale = ttk.Scale(self.replay_window, from_=0, to=max(replay.end_time - replay.start_time, 0.001),
+                               variable=self.replay_seek_var, orient="horizontal", length=400)
+        seek_scale.pack(fill="x", padx=10, pady=(0, 10))
+        seek_scale.bind("<ButtonRelease-1>",
+                        lambda e: replay.seek(replay.start_time + self.replay_seek_var.get()))
+        self.root.after(250, self.update_replay_controls)
+    
+    def toggle_replay_pause(self):
+        if self.replay is None:
+            return
+        self.replay.set_paused(not self.replay.paused)
+        self.replay_play_btn.config(text="Play" if self.replay.paused else "Pause")
+    
+    def update_replay_controls(self):
+        replay = self.replay
+        if replay is None or self.replay_window is None:
+            return
+        position = min(replay.position, len(replay) - 1)
+        elapsed = replay.timestamp(position) - replay.start_time
+        duration = replay.end_time - replay.start_time
+        self.replay_time_var.set("%s / %s" % (time.strftime("%H:%M:%S", time.gmtime(elapsed)),
+                                              time.strftime("%H:%M:%S", time.gmtime(duration))))
+        self.replay_seek_var.set(elapsed)
+        self.replay_play_btn.config(text="Play" if replay.paused else "Pause")
+        self.root.after(250, self.update_replay_controls)
+        
+    def apply_display_settings(self):
+        """Matches the decode size of each screen to the current layout and scaling"""
+        if self.pipeline is None:
+            return
         try:
-            # This is a placeholder for the actual streaming implementation
-            self.status_var.set("Connected - Streaming...")
-            
-            # Simulate streaming loop
-            while self.streaming:
-                # In real implementation, this would:
-                # 1. Receive image data from 3DS
-                # 2. Process and display frames
-                # 3. Handle scaling and interpolation
-                
-                # For now, just keep the connection alive
-                threading.Event().wait(0.1)
-                
-        except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Streaming Error", str(e)))
-        finally:
-            self.root.after(0, lambda: self.stop_streaming())
+            top_scaling = max(0.3, float(self.top_scaling_var.get()))
+            bottom_scaling = max(0.3, float(self.bottom_scaling_var.get()))
+        except (tk.TclError, ValueError):
+            return  # The spinbox is being edited
+        display_size = (self.root.winfo_screenwidth(), self.root.winfo_screenheight())
+        layout = self.layout_var.get()
+        geometry = layout_geometry(layout, top_scaling, bottom_scaling, display_size)
+        self.open_stream_windows(geometry[0], fullscreen=layout in ("Fullscreen Top", "Fullscreen Bottom"))
+        self.renderer.configure(geometry)
+        resample = getattr(Image, self.INTERPOLATION_FILTERS.get(self.interp_var.get(), "BILINEAR"))
+        self.pipeline.set_targets({screen: rect[3:] if rect is not None else None
+                                   for screen, rect in geometry[1].items()}, resample)
     
-    def take_screenshot(self):
-        if self.streaming:
-            # Placeholder for screenshot functionality
-            messagebox.showinfo("Screenshot", "Screenshot saved to: screenshot.png")
+    def apply_presentation_settings(self):
+        """Sets up frame pacing from the Presentation settings"""
+        try:
+            priority = SCREEN_TOP if self.priority_screen_var.get() == "Top" else SCREEN_BOTTOM
+            limit = max(0, int(self.frame_limit_var.get()))
+            secondary_limit = max(0, int(self.secondary_frame_limit_var.get()))
+            refresh_rate = max(24, int(self.refresh_rate_var.get()))
+        except (tk.TclError, ValueError):
+            return  # The spinbox is being edited
+        other = SCREEN_BOTTOM if priority == SCREEN_TOP else SCREEN_TOP
+        self.scheduler = FrameScheduler(self.presentation_var.get(), {priority: limit, other: secondary_limit},
+                                        priority, refresh_rate)
+    
+    def open_stream_windows(self, window_sizes, fullscreen=False):
+        """Opens, sizes or closes the stream windows, one for each size in window_sizes.
+
+        Like the AutoIt client, the stream isn't shown in the settings window: the
+        first window holds the layout and covers the display in the fullscreen
+        layouts, only "Separate Windows" uses a second one for the bottom screen.
+        """
+        while len(self.stream_windows) > len(window_sizes):
+            # Screens placed on the window's canvas go with it
+            index = len(self.stream_windows) - 1
+            for screen, (window, item) in list(self.renderer.items.items()):
+                if window == index:
+                    del self.renderer.items[screen]
+                    self.renderer.sizes.pop(screen, None)
+            del self.renderer.canvases[index]
+            self.stream_windows.pop().destroy()
+        while len(self.stream_windows) < len(window_sizes):
+            window = tk.Toplevel(self.root)
+            if self.stream_windows:
+                window.title("Snickerstream - Bottom Screen")
+                window.protocol("WM_DELETE_WINDOW", lambda: self.layout_var.set("Top Only"))
+            else:
+                window.title("Snickerstream - Stream")
+                window.protocol("WM_DELETE_WINDOW", self.stop_streaming)
+            # The hotkeys work from the stream windows too, there Escape and Enter return to the main window
+            for sequence in self.root.bind():
+                window.bind(sequence, self.root.bind(sequence))
+            window.bind("<Escape>", lambda e: self.stop_streaming())
+            window.bind("<Return>", lambda e: self.stop_streaming())
+            canvas = tk.Canvas(window, width=0, height=0, background="#000000", highlightthickness=0)
+            canvas.pack(expand=True)
+            self.renderer.canvases.append(canvas)
+            self.stream_windows.append(window)
+        for index, (window, (width, height)) in enumerate(zip(self.stream_windows, window_sizes)):
+            if index == 0 and fullscreen:
+                window.attributes("-fullscreen", True)
+            else:
+                window.attributes("-fullscreen", False)
+                window.geometry("%dx%d" % (width, height))
+    
+    def on_stream_connected(self):
+        # Runs on the receive thread, replays are left alone as the controller only knows live receivers
+        pipeline = self.pipeline
+        if self.config["adaptive_quality"] and pipeline is not None and self.quality_controller is None:
+            self.quality_controller = QualityController(pipeline, self.config)
+            self.quality_controller.start()
+        self.root.after(0, lambda: self.status_var.set("Connected - Streaming..."))
+    
+    def on_stream_reconnecting(self, reason, delay):
+        # Runs on the receive thread, the window, recorder and stats stay as they are
+        message = "%s - reconnecting in %.1f s..." % (reason, delay)
+        self.root.after(0, lambda: self.status_var.set(message))
+    
+    def on_stream_error(self, message):
+        def show_error():
+            messagebox.showerror("Streaming Error", message)
+            self.stop_streaming()
+        self.root.after(0, show_error)
+    
+    def present_frames(self):
+        """Paints the latest decoded frame of each screen, runs on the Tk main loop"""
+        pipeline = self.pipeline
+        if not self.streaming or pipeline is None:
+            return
+        scheduler = self.scheduler
+        for mailbox in pipeline.decoded.values():
+            decoded = mailbox.take()
+            if decoded is not None:
+                scheduler.add(decoded)
+        now = time.monotonic()
+        for decoded in scheduler.due(now):
+            if self.renderer.paint(decoded.image, decoded.screen):
+                pipeline.telemetry.record_presented(decoded, now)
+        
+        if now - self.last_report >= 1.0 and pipeline.receiver is not None:
+            self.update_telemetry(pipeline.snapshot())
+            self.last_report = now
+        # Sleep until the scheduler can paint again, at the cadence of the stream and the display
+        wait = scheduler.next_poll(time.monotonic())
+        self.present_job = self.root.after(max(1, int(wait * 1000)), self.present_frames)
+    
+    def update_telemetry(self, snapshot):
+        """Shows a telemetry snapshot in the status bar, window title and Telemetry tab"""
+        top, bottom = snapshot["screens"]["top"], snapshot["screens"]["bottom"]
+        fps = top["received_fps"] + bottom["received_fps"]
+        if not self.pipeline.reconnecting:
+            self.status_var.set("Streaming - %d fps" % round(fps))
+        self.root.title("Snickerstream - %d FPS" % round(fps))
+        if self.stream_windows:
+            self.stream_windows[0].title("Snickerstream - %d FPS" % round(fps))
+        
+        lines = ["%-8s %10s %10s %10s %12s %12s" % ("Screen", "Received", "Decoded", "Presented",
+                                                   "Decode p95", "Total p95")]
+        for name, values in snapshot["screens"].items():
+            lines.append("%-8s %10.1f %10.1f %10.1f %9s ms %9s ms" % (
+                name, values["received_fps"], values["decoded_fps"], values["presented_fps"],
+                values["decode_ms"]["p95"], values["total_ms"]["p95"]))
+        receiver = snapshot.get("receiver", {})
+        lines.append("")
+        lines.append("Packets: %d   Dropped: %d   Incomplete: %d   Late: %d   Reordered: %d" % (
+            receiver.get("packets", 0), receiver.get("dropped", 0), receiver.get("incomplete", 0),
+            receiver.get("late", 0), receiver.get("reordered", 0)))
+        lines.append("Skipped before decode: %d   Repeated (not decoded): %d   Decode errors: %d" % (
+            snapshot["skipped"], snapshot["repeated"], snapshot["decode_errors"]))
+        if snapshot["time_to_first_frame_ms"] is not None:
+            lines.append("Time to first frame: %d ms   Reconnects: %d (last took %s ms)   Stalls: %d" % (
+                snapshot["time_to_first_frame_ms"], snapshot["reconnects"],
+                snapshot["last_reconnect_ms"] if snapshot["last_reconnect_ms"] is not None else "-",
+                snapshot["stalls"]))
+        mjpeg_server = self.mjpeg_server
+        if mjpeg_server is not None:
+            for client in mjpeg_server.stats():
+                lines.append("Viewer %s (%s): %.1f fps  %.0f kbps  dropped %d" % (
+                    client["address"], client["screen"], client["fps"], client["kbps"], client["dropped"]))
+        scheduler = self.scheduler
+        if scheduler is not None and scheduler.smooth:
+            lines.append("Smooth pacing - buffered top: %d  bottom: %d   Dropped: %d   Underruns: %d" % (
+                scheduler.depth(SCREEN_TOP), scheduler.depth(SCREEN_BOTTOM), scheduler.dropped,
+                scheduler.underruns))
+        controller = self.quality_controller
+        if controller is not None:
+            lines.append("Adaptive quality: %d   QoS: %d   %d KB/frame   Changes: %d %s" % (
+                controller.quality, controller.qos, controller.bytes_per_frame // 1024, controller.changes,
+                "(%s)" % controller.last_reason if controller.last_reason else ""))
+        self.telemetry_var.set("\n".join(lines))
+    
+    def open_receiver(self):
+        """Starts the stream on the 3DS and returns the matching receiver"""
+        return open_receiver(self.config)
+
+    def toggle_recording(self):
+        if self.recorder is None:
+            self.start_recording()
         else:
+            self.stop_recording()
+    
+    def start_recording(self):
+        if not self.streaming or self.pipeline is None:
+            messagebox.showwarning("Not Streaming", "Cannot record while not streaming")
+            return
+        self.update_config()
+        try:
+            # Stopping reports the error
+            self.recorder = FrameRecorder(self.config["recording_dir"],
+                                          on_error=lambda message: self.root.after(0, self.stop_recording))
+            self.recorder.start()
+        except OSError as e:
+            self.recorder = None
+            messagebox.showerror("Recording Error", f"Failed to start recording: {str(e)}")
+            return
+        self.pipeline.add_listener(self.recorder.add)
+        self.record_btn.config(text="Stop Recording")
+    
+    def stop_recording(self):
+        if self.recorder is None:
+            return
+        if self.pipeline is not None:
+            self.pipeline.remove_listener(self.recorder.add)
+        self.recorder.stop()
+        if self.recorder.error:
+            messagebox.showerror("Recording Error", self.recorder.error)
+        elif self.recorder.dropped:
+            messagebox.showwarning("Recording", "%d frames could not be written in time" % self.recorder.dropped)
+        self.recorder = None
+        self.record_btn.config(text="Record")
+    
+    def browse_recording_dir(self):
+        directory = filedialog.askdirectory(title="Recording Folder",
+                                            initialdir=os.path.expanduser(self.recording_dir_var.get()))
+        if directory:
+            self.recording_dir_var.set(directory)
+    
+    def keep_latest_frame(self, frame):
+        # A pipeline listener, runs on the receive thread
+        self.latest_frames[frame.screen] = frame
+    
+    def take_screenshot(self):
+        """Saves the newest frame of each shown screen, the files are written off the Tk thread"""
+        pipeline = self.pipeline
+        if not self.streaming or pipeline is None:
             messagebox.showwarning("Not Streaming", "Cannot take screenshot while not streaming")
+            return
+        try:
+            self.update_config()
+        except ValueError as e:
+            self.status_var.set("Screenshot not taken: %s" % e)
+            return
+        frames = [self.latest_frames.get(screen) for screen, target in pipeline.targets.items()
+                  if target is not None]
+        frames = [frame for frame in frames if frame is not None]
+        if not frames:
+            self.status_var.set("No frame to take a screenshot of yet")
+            return
+        directory = os.path.expanduser(self.config["recording_dir"])
+        image_format = self.config["screenshot_format"]
+        # The count keeps the names of a burst of screenshots apart
+        self.screenshots += 1
+        stamp = "%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), self.screenshots)
+        
+        def save():
+            os.makedirs(directory, exist_ok=True)
+            return [save_frame_image(frame, os.path.join(directory, "screenshot-%s-%s" % (
+                stamp, SCREEN_NAMES[frame.screen])), image_format) for frame in frames]
+        self.run_capture(save, "Screenshot")
+    
+    def save_instant_replay(self):
+        """Saves the instant replay kept in memory, still possible right after the stream stopped"""
+        instant_replay = self.instant_replay
+        frames = instant_replay.frames() if instant_replay is not None else []
+        if not frames:
+            messagebox.showwarning("Instant Replay", "There is nothing to save yet, keep the last "
+                                   "seconds of the stream in the Advanced tab")
+            return
+        try:
+            self.update_config()
+        except ValueError as e:
+            self.status_var.set("Instant replay not saved: %s" % e)
+            return
+        directory = self.config["recording_dir"]
+        images = self.config["replay_format"] == "Images"
+        image_format = self.config["screenshot_format"]
+        self.status_var.set("Saving the last %.0f seconds..." % (frames[-1].timestamp - frames[0].timestamp))
+        self.run_capture(lambda: save_replay(frames, directory, images=images, image_format=image_format),
+                         "Instant replay")
+    
+    def run_capture(self, save, name):
+        """Runs save (returning the paths written) on the capture thread and reports how it went"""
+        if self.capture_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            # A single thread keeps a burst of captures in order
+            self.capture_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+        
+        def done(future):
+            def report():
+                try:
+                    paths = future.result()
+                except Exception as e:
+                    messagebox.showerror("Save Error", f"{name} failed: {str(e)}")
+                    return
+                # Several files always share a folder
+                self.status_var.set("%s saved to %s" % (name, paths[0] if len(paths) == 1
+                                                         else os.path.dirname(paths[0])))
+            self.root.after(0, report)
+        self.capture_executor.submit(save).add_done_callback(done)
     
     def open_settings(self):
         # Settings are already in the Settings tab
@@ -267,7 +4616,34 @@ class SnickerStreamGUI:
             self.config["quality"] = self.quality_var.get()
             self.config["layout"] = self.layout_var.get()
             self.config["interpolation"] = self.interp_var.get()
+            self.config["adaptive_quality"] = self.adaptive_quality_var.get()
+            self.config["min_quality"] = max(10, min(int(self.min_quality_var.get()), 100))
+            self.config["target_fps"] = max(0, int(self.target_fps_var.get()))
+            self.config["top_scaling"] = max(0.3, float(self.top_scaling_var.get()))
+            self.config["bottom_scaling"] = max(0.3, float(self.bottom_scaling_var.get()))
             self.config["auto_connect"] = self.auto_connect_var.get()
+            self.config["auto_reconnect"] = self.auto_reconnect_var.get()
+            self.config["stall_timeout_ms"] = max(250, int(self.stall_timeout_var.get()))
+            self.config["multiprocess"] = self.multiprocess_var.get()
+            self.config["replay_seconds"] = max(0, int(self.replay_seconds_var.get()))
+            self.config["replay_megabytes"] = max(8, int(self.replay_megabytes_var.get()))
+            self.config["replay_format"] = self.replay_format_var.get()
+            self.config["screenshot_format"] = self.screenshot_format_var.get()
+            self.config["presentation"] = self.presentation_var.get()
+            self.config["priority_screen"] = self.priority_screen_var.get()
+            self.config["frame_limit"] = max(0, int(self.frame_limit_var.get()))
+            self.config["secondary_frame_limit"] = max(0, int(self.secondary_frame_limit_var.get()))
+            self.config["refresh_rate"] = max(24, int(self.refresh_rate_var.get()))
+            self.config["recording_dir"] = self.recording_dir_var.get().strip() or DEFAULT_CONFIG["recording_dir"]
+            self.config["telemetry_log"] = self.telemetry_log_var.get().strip()
+            metrics_port = self.metrics_port_var.get().strip() or "0"
+            if not metrics_port.isdigit() or int(metrics_port) > 65535:
+                raise ValueError("Metrics port must be a number between 0 and 65535")
+            self.config["metrics_port"] = int(metrics_port)
+            mjpeg_port = self.mjpeg_port_var.get().strip() or "0"
+            if not mjpeg_port.isdigit() or int(mjpeg_port) > 65535:
+                raise ValueError("MJPEG port must be a number between 0 and 65535")
+            self.config["mjpeg_port"] = int(mjpeg_port)
         except ValueError as e:
             raise ValueError(f"Invalid configuration: {str(e)}")
         except Exception as e:
@@ -275,7 +4651,7 @@ class SnickerStreamGUI:
     
     def save_config(self):
         self.update_config()
-        config_path = os.path.expanduser("~/.snickerstream_config.json")
+        config_path = CONFIG_PATH
         try:
             with open(config_path, 'w') as f:
                 json.dump(self.config, f, indent=2)
@@ -284,13 +4660,7 @@ class SnickerStreamGUI:
             messagebox.showerror("Save Error", f"Failed to save config: {str(e)}")
     
     def load_config(self):
-        config_path = os.path.expanduser("~/.snickerstream_config.json")
-        try:
-            if os.path.exists(config_path):
-                with open(config_path, 'r') as f:
-                    self.config.update(json.load(f))
-        except Exception:
-            pass  # Use defaults if config loading fails
+        self.config = read_config()
     
     def load_config_file(self):
         filename = filedialog.askopenfilename(
@@ -307,15 +4677,7 @@ class SnickerStreamGUI:
                 messagebox.showerror("Load Error", f"Failed to load config: {str(e)}")
     
     def reset_config(self):
-        self.config = {
-            "ip": "192.168.1.100",
-            "port": 8000,
-            "streaming_app": "NTR CFW",
-            "quality": 90,
-            "layout": "Vertical",
-            "interpolation": "Linear",
-            "auto_connect": False
-        }
+        self.config = copy.deepcopy(DEFAULT_CONFIG)
         self.refresh_ui()
         messagebox.showinfo("Config Reset", "Configuration reset to defaults")
     
@@ -327,10 +4689,45 @@ class SnickerStreamGUI:
         self.quality_var.set(self.config["quality"])
         self.layout_var.set(self.config["layout"])
         self.interp_var.set(self.config["interpolation"])
+        self.adaptive_quality_var.set(self.config["adaptive_quality"])
+        self.presentation_var.set(self.config["presentation"])
+        self.priority_screen_var.set(self.config["priority_screen"])
+        self.frame_limit_var.set(self.config["frame_limit"])
+        self.secondary_frame_limit_var.set(self.config["secondary_frame_limit"])
+        self.refresh_rate_var.set(self.config["refresh_rate"])
+        self.min_quality_var.set(self.config["min_quality"])
+        self.target_fps_var.set(self.config["target_fps"])
+        self.top_scaling_var.set(self.config["top_scaling"])
+        self.bottom_scaling_var.set(self.config["bottom_scaling"])
         self.auto_connect_var.set(self.config["auto_connect"])
+        self.auto_reconnect_var.set(self.config["auto_reconnect"])
+        self.stall_timeout_var.set(self.config["stall_timeout_ms"])
+        self.multiprocess_var.set(self.config["multiprocess"])
+        self.replay_seconds_var.set(self.config["replay_seconds"])
+        self.replay_megabytes_var.set(self.config["replay_megabytes"])
+        self.replay_format_var.set(self.config["replay_format"])
+        self.screenshot_format_var.set(self.config["screenshot_format"])
+        self.recording_dir_var.set(self.config["recording_dir"])
+        self.telemetry_log_var.set(self.config["telemetry_log"])
+        self.metrics_port_var.set(str(self.config["metrics_port"]))
+        self.mjpeg_port_var.set(str(self.config["mjpeg_port"]))
+        self.refresh_sessions()
 
 
 def main():
+    args = parse_args()
+    commands = {"connect": connect_main, "record": record_main, "serve": serve_main, "benchmark": benchmark_main}
+    if args.command in commands:
+        try:
+            sys.exit(commands[args.command](args))
+        except (OSError, ValueError) as e:
+            print(f"Error: {str(e)}", file=sys.stderr)
+            sys.exit(1)
+    
+    if not import_gui():
+        print("Error: tkinter not available. This is required for the GUI.")
+        sys.exit(1)
+    
     try:
         # Set up tkinter with better theming
         root = tk.Tk()
@@ -355,6 +4752,7 @@ def main():
             try:
                 if app.streaming:
                     app.stop_streaming()
+                app.stop_sessions()
                 root.destroy()
             except Exception:
                 pass  # Ignore errors during shutdown
@@ -363,7 +4761,15 @@ def main():
         
         # Bind hotkeys
         root.bind('<Escape>', lambda e: on_closing())
-        root.bind('<KeyPress-s>', lambda e: app.take_screenshot())
+        def hotkey(action):
+            def on_key(event):
+                # Typing an S or an R in a text field isn't a hotkey
+                if event.widget.winfo_class() not in ("Entry", "TEntry", "TSpinbox", "TCombobox"):
+                    action()
+            return on_key
+        
+        root.bind('<KeyPress-s>', hotkey(app.take_screenshot))
+        root.bind('<KeyPress-r>', hotkey(app.save_instant_replay))
         
         # Start the GUI
         root.mainloop()
@@ -0,0 +1,1052 @@
+"""Tests for snickerstream.py, run with pytest"""
+
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+
+import snickerstream
+from snickerstream import (Backoff, DecodedFrame, Frame, FrameLog, FrameLogIndex, FrameRecorder, FrameRing,
+                           FrameScheduler, HzModReceiver, InstantReplayBuffer, NTRReceiver, QualityController,
+                           ReplaySource, StreamTelemetry, FRAMELOG_HEADER, FRAMELOG_INDEX_EXTENSION, FRAMELOG_RECORD,
+                           FRAME_REPEAT, FRAME_STRIPS, HZMOD_IMAGE_HEADER_SIZE, HZMOD_PACKET_DEBUG, HZMOD_PACKET_JPEG,
+                           HZMOD_PACKET_MODE, NTR_PAYLOAD_SIZE, SCREEN_BOTTOM, SCREEN_TOP, layout_geometry, ntr_packets,
+                           save_replay, screen_targets, telemetry_to_prometheus)
+
+
+def fake_jpeg(size, fill=0):
+    """Bytes that pass the receivers' FFD8/FFD9 sanity checks"""
+    return b"\xff\xd8" + bytes([fill]) * (size - 4) + b"\xff\xd9"
+
+
+def feed(receiver, packet):
+    """Hands a datagram to an NTRReceiver as if recv_into had just read it"""
+    receiver._packet[:len(packet)] = packet
+    frame = receiver.handle_packet(len(packet))
+    # Frames view the receiver's slots, keep a copy of what was emitted
+    return None if frame is None else (frame.screen, frame.frame_id, bytes(frame.data))
+
+
+def hzmod_packet(packet_type, payload):
+    size = len(payload)
+    return bytes((packet_type, size & 0xFF, (size >> 8) & 0xFF, size >> 16)) + payload
+
+
+def hzmod_image(data):
+    return hzmod_packet(HZMOD_PACKET_JPEG, bytes(HZMOD_IMAGE_HEADER_SIZE) + data)
+
+
+# NTRReceiver
+
+def test_ntr_frame_in_order():
+    receiver = NTRReceiver()
+    data = fake_jpeg(3 * NTR_PAYLOAD_SIZE - 100)
+    packets = list(ntr_packets(1, SCREEN_TOP, data))
+    assert [feed(receiver, packet) for packet in packets[:-1]] == [None, None]
+    assert feed(receiver, packets[-1]) == (SCREEN_TOP, 1, data)
+    assert receiver.stats.frames == 1
+    assert receiver.stats.reordered == 0
+
+
+def test_ntr_incomplete_jpeg():
+    receiver = NTRReceiver()
+    assert feed(receiver, next(ntr_packets(1, SCREEN_TOP, b"\xff\xd8" + bytes(100)))) is None
+    assert receiver.stats.incomplete == 1
+
+
+def test_ntr_packets_past_the_last_one_dont_complete_a_frame():
+    receiver = NTRReceiver()
+    data = fake_jpeg(3 * NTR_PAYLOAD_SIZE - 100)
+    first, middle, last = ntr_packets(1, SCREEN_TOP, data)
+    stray = bytes((1, SCREEN_TOP, 2, 5)) + bytes(NTR_PAYLOAD_SIZE)
+    assert feed(receiver, first) is None
+    assert feed(receiver, stray) is None
+    # Three packets are in, but the middle one is still missing
+    assert feed(receiver, last) is None
+    assert feed(receiver, middle) == (SCREEN_TOP, 1, data)
+
+
+# NTRReceiver reorder window
+
+def test_ntr_reordered_packets():
+    receiver = NTRReceiver()
+    data = fake_jpeg(3 * NTR_PAYLOAD_SIZE - 100)
+    first, middle, last = ntr_packets(1, SCREEN_TOP, data)
+    assert feed(receiver, first) is None
+    assert feed(receiver, last) is None
+    assert feed(receiver, middle) == (SCREEN_TOP, 1, data)
+    assert receiver.stats.reordered == 1
+
+
+def test_ntr_newer_frame_completing_first_drops_the_older_one():
+    receiver = NTRReceiver()
+    old = list(ntr_packets(1, SCREEN_TOP, fake_jpeg(2 * NTR_PAYLOAD_SIZE, 1)))
+    new_data = fake_jpeg(NTR_PAYLOAD_SIZE, 2)
+    assert feed(receiver, old[0]) is None
+    assert feed(receiver, next(ntr_packets(2, SCREEN_TOP, new_data))) == (SCREEN_TOP, 2, new_data)
+    assert receiver.stats.dropped == 1
+    # The rest of the dropped frame is late by now
+    assert feed(receiver, old[1]) is None
+    assert receiver.stats.late == 1
+
+
+def test_ntr_duplicate_packets():
+    receiver = NTRReceiver()
+    data = fake_jpeg(2 * NTR_PAYLOAD_SIZE)
+    first, last = ntr_packets(1, SCREEN_BOTTOM, data)
+    assert feed(receiver, first) is None
+    assert feed(receiver, first) is None
+    assert receiver.stats.invalid == 1
+    assert feed(receiver, last) == (SCREEN_BOTTOM, 1, data)
+    # A duplicate of a frame that was already emitted isn't emitted again
+    assert feed(receiver, last) is None
+    assert receiver.stats.late == 1
+    assert receiver.stats.frames == 1
+
+
+def test_ntr_frame_ids_wrap_around():
+    receiver = NTRReceiver()
+    emitted = []
+    for frame_id in (254, 255, 0, 1):
+        data = fake_jpeg(100, frame_id)
+        emitted.append(feed(receiver, next(ntr_packets(frame_id, SCREEN_TOP, data))))
+    assert [frame[1] for frame in emitted] == [254, 255, 0, 1]
+    # 255 is behind 1 once the counter has wrapped
+    assert feed(receiver, next(ntr_packets(255, SCREEN_TOP, fake_jpeg(100)))) is None
+    assert receiver.stats.late == 1
+
+
+def test_ntr_screens_are_reassembled_separately():
+    receiver = NTRReceiver()
+    top = list(ntr_packets(5, SCREEN_TOP, fake_jpeg(2 * NTR_PAYLOAD_SIZE, 1)))
+    bottom = list(ntr_packets(5, SCREEN_BOTTOM, fake_jpeg(2 * NTR_PAYLOAD_SIZE, 2)))
+    assert feed(receiver, top[0]) is None
+    assert feed(receiver, bottom[0]) is None
+    assert feed(receiver, bottom[1])[0] == SCREEN_BOTTOM
+    assert feed(receiver, top[1])[0] == SCREEN_TOP
+    assert receiver.stats.dropped == 0
+
+
+# HzModReceiver
+
+@pytest.fixture
+def hzmod():
+    """An HzModReceiver reading from one end of a socket pair, and the other end"""
+    ours, theirs = socket.socketpair()
+    receiver = HzModReceiver("127.0.0.1", buffer_size=64)
+    receiver._sock = ours
+    yield receiver, theirs
+    receiver.close()
+    theirs.close()
+
+
+def test_hzmod_split_reads(hzmod):
+    receiver, sender = hzmod
+    data = fake_jpeg(40, 7)
+    stream = hzmod_packet(HZMOD_PACKET_MODE, b"\x01\x00") + hzmod_packet(HZMOD_PACKET_DEBUG, b"") + hzmod_image(data)
+    frame = None
+    for i in range(0, len(stream), 5):
+        assert frame is None
+        sender.sendall(stream[i:i + 5])
+        receiver.fill()
+        frame = receiver.next_frame()
+    assert frame is not None
+    assert bytes(frame.data) == data
+    assert frame.screen == SCREEN_TOP
+    assert receiver.stats.packets == 3
+    assert receiver.stats.frames == 1
+
+
+def test_hzmod_grows_for_large_packets(hzmod):
+    receiver, sender = hzmod
+    frames = [fake_jpeg(300, 1), fake_jpeg(1000, 2)]
+    stream = b"".join(hzmod_image(data) for data in frames)
+    received = []
+    for i in range(0, len(stream), 48):
+        sender.sendall(stream[i:i + 48])
+        receiver.fill()
+        frame = receiver.next_frame()
+        while frame is not None:
+            received.append(bytes(frame.data))
+            frame = receiver.next_frame()
+    assert received == frames
+    assert len(receiver._buffer) >= 1000 + HZMOD_IMAGE_HEADER_SIZE
+
+
+def test_hzmod_skips_broken_images(hzmod):
+    receiver, sender = hzmod
+    sender.sendall(hzmod_image(b"\xff\xd8" + bytes(10)) + hzmod_image(fake_jpeg(20)))
+    receiver.fill()
+    frame = receiver.next_frame()
+    assert frame is not None and receiver.stats.incomplete == 1
+
+
+@pytest.mark.skipif(not snickerstream.PILLOW_AVAILABLE, reason="needs Pillow")
+def test_hzmod_strips_make_one_frame(hzmod):
+    from PIL import Image
+    receiver, sender = hzmod
+    # HzMod frames are sideways, the strips split the 400 pixels side
+    strips = []
+    for i in range(4):
+        output = io.BytesIO()
+        Image.new("RGB", (240, 100), (i * 60, 0, 0)).save(output, "JPEG")
+        strips.append(output.getvalue())
+    sender.sendall(b"".join(hzmod_image(strip) for strip in strips))
+    frame = receiver.receive()
+    assert frame.kind & FRAME_STRIPS
+    assert snickerstream.split_strips(frame.data) == strips
+    assert receiver.stats.frames == 1
+    image = snickerstream.decode_frame(frame)
+    assert image.size == (400, 240)
+
+
+# Decoding
+
+@pytest.fixture
+def top_frame():
+    if not snickerstream.PILLOW_AVAILABLE:
+        pytest.skip("needs Pillow")
+    data = next(data for screen, data in snickerstream.synthetic_frames(1) if screen == SCREEN_TOP)
+    return Frame(SCREEN_TOP, data)
+
+
+def test_decode_frame_upright(top_frame):
+    assert snickerstream.decode_frame(top_frame).size == (400, 240)
+
+
+def test_decode_frame_scales_while_decoding(top_frame, monkeypatch):
+    from PIL import Image
+    # Half size is exactly what the JPEG decoder can scale to, so nothing is resized afterwards
+    def resize(*args, **kwargs):
+        raise AssertionError("decoded at full size and resized")
+    monkeypatch.setattr(Image.Image, "resize", resize)
+    assert snickerstream.decode_frame(top_frame, (200, 120)).size == (200, 120)
+
+
+def test_decode_frame_resizes_what_draft_cannot(top_frame):
+    assert snickerstream.decode_frame(top_frame, (150, 90)).size == (150, 90)
+    assert snickerstream.decode_frame(top_frame, (800, 480)).size == (800, 480)
+
+
+def test_decode_frame_swaps_red_and_blue_while_rotating():
+    if not snickerstream.PILLOW_AVAILABLE:
+        pytest.skip("needs Pillow")
+    from PIL import Image
+    # Sideways like the 3DS sends it: red along the top, green along the bottom
+    sideways = Image.new("RGB", (240, 400), (255, 0, 0))
+    sideways.paste((0, 255, 0), (0, 200, 240, 400))
+    data = io.BytesIO()
+    sideways.save(data, "JPEG", quality=95)
+    image = snickerstream.decode_frame(Frame(SCREEN_TOP, data.getvalue(), kind=snickerstream.FRAME_SWAP_RB))
+    assert image.size == (400, 240)
+    left, right = image.getpixel((50, 120)), image.getpixel((350, 120))
+    assert left[2] > 200 and left[0] < 50
+    assert right[1] > 200 and right[0] < 50 and right[2] < 50
+
+
+# SessionManager
+
+def test_only_ntr_sessions_get_stream_ports():
+    manager = snickerstream.SessionManager(decode_workers=1)
+    try:
+        first = manager.add({"ip": "10.0.0.1"})
+        fixed = manager.add({"ip": "10.0.0.2", "stream_port": 8002})
+        hzmod = manager.add({"ip": "10.0.0.3", "streaming_app": "HzMod"})
+        third = manager.add({"ip": "10.0.0.4"})
+        assert [session.config["stream_port"] for session in (first, fixed, hzmod, third)] == [8001, 8002, None, 8003]
+    finally:
+        manager.stop()
+
+
+def test_next_stream_port_skips_ports_ntr_cant_use():
+    assert snickerstream.next_stream_port({8001}) == 8002
+    assert not snickerstream.ntr_port_usable(8161)
+    assert snickerstream.next_stream_port(set(range(8001, 8161))) == 8162
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_session_streams_from_an_emulator():
+    emulator = snickerstream.HzModEmulator(snickerstream.synthetic_frames(4), fps=60)
+    emulator.start()
+    manager = snickerstream.SessionManager(decode_workers=1)
+    manager.start()
+    try:
+        session = manager.add({"ip": "127.0.0.1", "port": emulator.port, "streaming_app": "HzMod"})
+        assert wait_for(lambda: session.stats.frames >= 5)
+        assert wait_for(lambda: session.pipeline.decoded[SCREEN_TOP].take() is not None)
+    finally:
+        manager.stop()
+        emulator.stop()
+
+
+def test_handshake_finishing_after_stop_closes_the_receiver(monkeypatch):
+    connecting, closed = threading.Event(), threading.Event()
+
+    class SlowReceiver:
+        stats = snickerstream.ReceiverStats()
+
+        def close(self):
+            closed.set()
+
+    def open_receiver(config, timeout=0.5):
+        connecting.set()
+        time.sleep(0.2)
+        return SlowReceiver()
+    monkeypatch.setattr(snickerstream, "open_receiver", open_receiver)
+    manager = snickerstream.SessionManager(decode_workers=1)
+    manager.start()
+    manager.add({"ip": "10.0.0.1", "streaming_app": "HzMod"})
+    assert connecting.wait(2.0)
+    manager.stop()
+    assert closed.wait(2.0)
+
+
+# Recording
+
+def test_recorder_writes_repeats_without_data(tmp_path):
+    recorder = FrameRecorder(str(tmp_path))
+    recorder.start()
+    top = fake_jpeg(500, 1)
+    recorder.add(Frame(SCREEN_TOP, top, 1, timestamp=1.0))
+    recorder.add(Frame(SCREEN_TOP, top, 2, FRAME_REPEAT, timestamp=1.1))
+    recorder.add(Frame(SCREEN_BOTTOM, fake_jpeg(300, 2), 1, timestamp=1.2))
+    recorder.stop()
+    assert recorder.error is None
+    assert (recorder.frames, recorder.repeats, recorder.dropped) == (3, 1, 0)
+    assert len(recorder.segments) == 1
+    assert os.path.getsize(recorder.segments[0]) == FRAMELOG_HEADER.size + 3 * FRAMELOG_RECORD.size + 800
+
+
+def test_recorder_starts_new_segments(tmp_path):
+    recorder = FrameRecorder(str(tmp_path), segment_bytes=500)
+    recorder.start()
+    for i in range(4):
+        recorder.add(Frame(SCREEN_TOP, fake_jpeg(600, i), i, timestamp=1.0 + i))
+    recorder.stop()
+    assert len(recorder.segments) == 4
+
+
+def test_recorder_keeps_draining_after_an_error(tmp_path):
+    directory = tmp_path / "recording"
+    errors = []
+    recorder = FrameRecorder(str(directory), max_pending=4, on_error=errors.append)
+    recorder.start()
+    # The segment can't be created once the directory is gone
+    directory.rmdir()
+    directory.write_bytes(b"")
+    for i in range(20):
+        recorder.add(Frame(SCREEN_TOP, fake_jpeg(100), i))
+    recorder.stop()
+    assert recorder.error is not None
+    assert errors == [recorder.error]
+    assert recorder.frames == 0
+    assert recorder.dropped == 20
+
+
+def test_listeners_can_change_while_frames_are_handed_out():
+    pipeline = snickerstream.StreamPipeline()
+    pipeline.set_targets({SCREEN_TOP: None, SCREEN_BOTTOM: None})
+    seen = []
+
+    def remove_self(frame):
+        seen.append("first")
+        pipeline.remove_listener(remove_self)
+
+    pipeline.add_listener(remove_self)
+    pipeline.add_listener(lambda frame: seen.append("second"))
+    pipeline.submit(Frame(SCREEN_TOP, fake_jpeg(100, 1)))
+    pipeline.submit(Frame(SCREEN_TOP, fake_jpeg(100, 2)))
+    # The removal doesn't make the running hand-out skip the next listener
+    assert seen == ["first", "second", "second"]
+
+
+# Frame log index and replay
+
+def test_scan_matches_the_recorders_index(tmp_path):
+    recorder = FrameRecorder(str(tmp_path))
+    recorder.start()
+    top, bottom = fake_jpeg(500, 1), fake_jpeg(300, 2)
+    recorder.add(Frame(SCREEN_TOP, top, 1, timestamp=1.0))
+    recorder.add(Frame(SCREEN_BOTTOM, bottom, 1, timestamp=1.1))
+    recorder.add(Frame(SCREEN_TOP, top, 2, FRAME_REPEAT, timestamp=1.2))
+    recorder.add(Frame(SCREEN_TOP, fake_jpeg(400, 3), 3, timestamp=1.3))
+    recorder.add(Frame(SCREEN_BOTTOM, bottom, 2, FRAME_REPEAT, timestamp=1.4))
+    recorder.stop()
+    assert recorder.error is None
+    assert len(recorder.segments) == 1
+    assert recorder.repeats == 2
+
+    path = recorder.segments[0]
+    saved = FrameLogIndex.load(os.path.splitext(path)[0] + FRAMELOG_INDEX_EXTENSION, os.path.getsize(path))
+    assert saved is not None
+    with open(path, "rb") as f:
+        scanned = FrameLogIndex.scan(memoryview(f.read()))
+    assert len(scanned) == 5
+    for values, expected in zip(scanned._arrays(), saved._arrays()):
+        assert values == expected
+
+    log = FrameLog(path)
+    try:
+        assert bytes(log.frame(2).data) == top
+        assert log.index.kinds[2] & FRAME_REPEAT
+        assert bytes(log.frame(4).data) == bottom
+    finally:
+        log.close()
+
+
+def test_stale_index_is_rebuilt(tmp_path):
+    recorder = FrameRecorder(str(tmp_path))
+    recorder.start()
+    recorder.add(Frame(SCREEN_TOP, fake_jpeg(100), 1, timestamp=1.0))
+    recorder.stop()
+    path = recorder.segments[0]
+    # A frame appended after the index was saved makes it stale
+    with open(path, "ab") as f:
+        f.write(snickerstream.FRAMELOG_RECORD.pack(0.0, SCREEN_BOTTOM, 0, 0, 50) + fake_jpeg(50))
+    log = FrameLog(path)
+    try:
+        assert len(log) == 2
+        assert bytes(log.frame(1).data) == fake_jpeg(50)
+    finally:
+        log.close()
+
+
+def record(directory, count, segment_bytes=512 * 1024 * 1024):
+    """Records count top screen frames one second apart, frame i filled with i, returns the segments"""
+    recorder = FrameRecorder(str(directory), segment_bytes=segment_bytes)
+    recorder.start()
+    for i in range(count):
+        recorder.add(Frame(SCREEN_TOP, fake_jpeg(200, i), i, timestamp=1.0 + i))
+    recorder.stop()
+    return recorder.segments
+
+
+def shown(source):
+    """The fill value of the next frame the replay shows"""
+    return bytes(source.receive().data)[2]
+
+
+def test_replay_seek_and_step_across_segments(tmp_path):
+    segments = record(tmp_path, 10, segment_bytes=600)
+    assert len(segments) > 1
+    source = ReplaySource(segments)
+    try:
+        assert len(source) == 10
+        assert shown(source) == 0
+        source.seek(source.start_time + 2.5)
+        assert shown(source) == 3
+        source.step(-1)
+        assert source.paused
+        assert shown(source) == 2
+        source.step(5)
+        assert shown(source) == 7
+        source.seek_position(100)
+        assert shown(source) == 9
+        source.seek(source.start_time - 10)
+        assert shown(source) == 0
+    finally:
+        source.close()
+
+
+def test_paused_replay_waits_like_a_socket(tmp_path):
+    source = ReplaySource(record(tmp_path, 3), speed=0)
+    try:
+        assert shown(source) == 0
+        source.set_paused(True)
+        with pytest.raises(socket.timeout):
+            source.receive()
+        source.set_paused(False)
+        assert shown(source) == 1
+    finally:
+        source.close()
+
+
+# Telemetry
+
+
+def test_telemetry_counts_stages_and_latencies():
+    telemetry = StreamTelemetry()
+    telemetry.record_received(Frame(SCREEN_TOP, b"", 1))
+    telemetry.record_received(Frame(SCREEN_TOP, b"", 1, kind=FRAME_REPEAT))
+    decoded = DecodedFrame(SCREEN_TOP, None, 1, 10.0, 10.001, 10.005)
+    telemetry.record_decoded(decoded)
+    telemetry.record_presented(decoded, presented_at=10.015)
+    snapshot = telemetry.snapshot(skipped=2)
+    top = snapshot["screens"]["top"]
+    assert (top["received"], top["repeated"], top["decoded"], top["presented"]) == (2, 1, 1, 1)
+    assert top["decode_ms"]["p50"] == 8
+    assert top["present_ms"]["p50"] == 16
+    assert top["total_ms"]["p50"] == 16
+    assert snapshot["screens"]["bottom"]["decode_ms"]["p50"] is None
+    assert snapshot["skipped"] == 2
+
+
+def test_telemetry_snapshots_from_many_threads():
+    telemetry = StreamTelemetry()
+    errors = []
+
+    def take():
+        try:
+            for _ in range(2000):
+                telemetry.snapshot()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=take) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_prometheus_families_and_counters():
+    telemetry = StreamTelemetry()
+    telemetry.record_received(Frame(SCREEN_TOP, b"", 1))
+    text = telemetry_to_prometheus(telemetry.snapshot(skipped=3, stalls=1, time_to_first_frame_ms=None,
+                                                      last_reconnect_ms=250, connected=True,
+                                                      replaced={"top": 0, "bottom": 0}))
+    lines = text.splitlines()
+    assert 'snickerstream_frames_total{screen="top",stage="received"} 1' in lines
+    assert "snickerstream_skipped_total 3" in lines
+    assert "snickerstream_stalls_total 1" in lines
+    assert "snickerstream_last_reconnect_ms 250" in lines
+    assert "snickerstream_connected 1" in lines
+    # Each family's TYPE line comes right before its samples
+    types = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+    assert len(types) == len(set(types))
+    for line in lines:
+        if not line.startswith("#"):
+            name = line.split("{")[0].split()[0]
+            family = [t for t in types if name == t or name.startswith(t + "_")]
+            assert family, line
+    assert "# TYPE snickerstream_skipped_total counter" in lines
+    assert "# TYPE snickerstream_last_reconnect_ms gauge" in lines
+    # Without a receiver there are no receiver samples, so no TYPE line either
+    assert "# TYPE snickerstream_receiver_total counter" not in lines
+    assert "time_to_first_frame" not in text
+
+
+# Adaptive quality
+
+
+class FakeQualityReceiver:
+    """Stands in for a receiver: counters to steer the controller, set_quality calls recorded"""
+
+    def __init__(self, app):
+        self.app = app
+        self.stats = snickerstream.ReceiverStats()
+        self.qualities = []
+
+    def set_quality(self, quality):
+        self.qualities.append(quality)
+
+
+class FakeQualityPipeline:
+    def __init__(self, app):
+        self.receiver = FakeQualityReceiver(app)
+        self.telemetry = StreamTelemetry()
+        self.quiet_until = 0.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(snickerstream.time, "monotonic", lambda: now[0])
+    return now
+
+
+def quality_tick(controller, clock, frames, lost=0, seconds=1.0):
+    """Advances the clock and the counters by one tick of frames top screen frames"""
+    pipeline = controller.pipeline
+    clock[0] += seconds
+    pipeline.receiver.stats.frames += frames
+    pipeline.receiver.stats.dropped += lost
+    pipeline.receiver.stats.bytes += frames * 10000
+    pipeline.telemetry.screens[SCREEN_TOP].received += frames
+    controller.tick()
+
+
+def test_quality_steps_down_on_loss_and_back_up_when_clean(clock):
+    config = dict(snickerstream.DEFAULT_CONFIG, streaming_app="HzMod", quality=80, min_quality=60, target_fps=30)
+    pipeline = FakeQualityPipeline("HzMod")
+    controller = QualityController(pipeline, config, down_after=2, up_after=3)
+    controller.tick()
+    quality_tick(controller, clock, 30, lost=10)
+    assert pipeline.receiver.qualities == []
+    quality_tick(controller, clock, 30, lost=10)
+    assert pipeline.receiver.qualities == [70]
+    assert "lost" in controller.last_reason
+    for _ in range(2):
+        quality_tick(controller, clock, 30, lost=10)
+    # Never below min_quality
+    for _ in range(4):
+        quality_tick(controller, clock, 30, lost=10)
+    assert controller.quality == 60
+    assert pipeline.receiver.qualities == [70, 60]
+    assert controller.bytes_per_frame == 10000
+    # A tick that's neither congested nor clean holds
+    for _ in range(2):
+        quality_tick(controller, clock, 30)
+    quality_tick(controller, clock, 28)
+    for _ in range(2):
+        quality_tick(controller, clock, 30)
+    assert controller.quality == 60
+    quality_tick(controller, clock, 30)
+    assert controller.quality == 65
+    # Never above the configured quality
+    for _ in range(12):
+        quality_tick(controller, clock, 30)
+    assert pipeline.receiver.qualities == [70, 60, 65, 70, 75, 80]
+
+
+def test_quality_counts_a_low_frame_rate_as_congestion(clock):
+    config = dict(snickerstream.DEFAULT_CONFIG, streaming_app="HzMod", quality=80, target_fps=30)
+    pipeline = FakeQualityPipeline("HzMod")
+    controller = QualityController(pipeline, config, down_after=2)
+    controller.tick()
+    for _ in range(2):
+        quality_tick(controller, clock, 20)
+    assert pipeline.receiver.qualities == [70]
+    assert controller.last_reason == "20 fps"
+
+
+def test_ntr_quality_uses_cooldown_and_qos(clock, monkeypatch):
+    calls = []
+    monkeypatch.setattr(snickerstream, "ntr_init_remoteplay", lambda ip, **kwargs: calls.append(kwargs))
+    config = dict(snickerstream.DEFAULT_CONFIG, quality=60, min_quality=45, qos=20, target_fps=0)
+    pipeline = FakeQualityPipeline("NTR CFW")
+    controller = QualityController(pipeline, config, down_after=1)
+    controller.tick()
+    # Still within the cooldown after starting
+    quality_tick(controller, clock, 30, lost=10)
+    assert calls == []
+    clock[0] += QualityController.NTR_COOLDOWN
+    quality_tick(controller, clock, 30, lost=10)
+    assert (calls[-1]["quality"], calls[-1]["qos"]) == (45, 20)
+    assert pipeline.quiet_until > clock[0]
+    clock[0] += QualityController.NTR_COOLDOWN
+    quality_tick(controller, clock, 30, lost=10)
+    # Already at min_quality, so QoS goes down instead
+    assert (calls[-1]["quality"], calls[-1]["qos"]) == (45, 15)
+    assert controller.changes == 2
+
+
+# Layouts
+
+
+def test_layout_vertical_centers_the_bottom_screen():
+    windows, screens = layout_geometry("Vertical")
+    assert windows == [(400, 480)]
+    assert screens == {SCREEN_TOP: (0, 0, 0, 400, 240), SCREEN_BOTTOM: (0, 40, 240, 320, 240)}
+
+
+def test_layout_horizontal_with_scaling():
+    windows, screens = layout_geometry("Horizontal", top_scaling=2.0, bottom_scaling=1.0)
+    assert windows == [(1120, 480)]
+    assert screens == {SCREEN_TOP: (0, 0, 0, 800, 480), SCREEN_BOTTOM: (0, 800, 120, 320, 240)}
+
+
+def test_layout_single_screens_and_separate_windows():
+    assert layout_geometry("Top Only") == ([(400, 240)], {SCREEN_TOP: (0, 0, 0, 400, 240), SCREEN_BOTTOM: None})
+    assert layout_geometry("Bottom Only", bottom_scaling=1.5) == (
+        [(480, 360)], {SCREEN_TOP: None, SCREEN_BOTTOM: (0, 0, 0, 480, 360)})
+    windows, screens = layout_geometry("Separate Windows", bottom_scaling=0.5)
+    assert windows == [(400, 240), (160, 120)]
+    assert screens == {SCREEN_TOP: (0, 0, 0, 400, 240), SCREEN_BOTTOM: (1, 0, 0, 160, 120)}
+
+
+def test_layout_fullscreen_fits_and_centers():
+    windows, screens = layout_geometry("Fullscreen Top", display_size=(1920, 1080))
+    assert windows == [(1920, 1080)]
+    assert screens == {SCREEN_TOP: (0, 60, 0, 1800, 1080), SCREEN_BOTTOM: None}
+    windows, screens = layout_geometry("Fullscreen Bottom", display_size=(1280, 1024))
+    assert screens == {SCREEN_TOP: None, SCREEN_BOTTOM: (0, 0, 32, 1280, 960)}
+    assert screen_targets("Fullscreen Bottom", display_size=(1280, 1024)) == {SCREEN_TOP: None,
+                                                                              SCREEN_BOTTOM: (1280, 960)}
+
+
+# FrameScheduler
+
+def decoded(screen, decoded_at, frame_id=0):
+    return DecodedFrame(screen, None, frame_id, decoded_at, decoded_at, decoded_at)
+
+
+def test_lowest_latency_paints_the_latest_frame_priority_first():
+    scheduler = FrameScheduler(priority_screen=SCREEN_BOTTOM)
+    scheduler.add(decoded(SCREEN_TOP, 0.0, 1))
+    scheduler.add(decoded(SCREEN_TOP, 0.01, 2))
+    scheduler.add(decoded(SCREEN_BOTTOM, 0.01, 3))
+    assert [frame.frame_id for frame in scheduler.due(0.02)] == [3, 2]
+    assert scheduler.dropped == 1
+    assert scheduler.due(0.03) == []
+
+
+def test_frame_limit():
+    scheduler = FrameScheduler(limits={SCREEN_TOP: 10})
+    scheduler.add(decoded(SCREEN_TOP, 0.0, 1))
+    assert len(scheduler.due(0.0)) == 1
+    scheduler.add(decoded(SCREEN_TOP, 0.05, 2))
+    assert scheduler.due(0.05) == []
+    assert [frame.frame_id for frame in scheduler.due(0.1)] == [2]
+
+
+def test_smooth_buffers_before_painting():
+    scheduler = FrameScheduler("Smooth", refresh_rate=1000)
+    # Regular arrivals need no more than one frame of buffer
+    for i in range(5):
+        scheduler.add(decoded(SCREEN_TOP, i / 30))
+        scheduler.screens[SCREEN_TOP].queue.clear()
+    assert scheduler.depth(SCREEN_TOP) == 1
+    scheduler.add(decoded(SCREEN_TOP, 5 / 30, 1))
+    # Paints are moved onto the next refresh tick
+    assert scheduler.due(0.1666) == []
+    assert [frame.frame_id for frame in scheduler.due(0.167)] == [1]
+
+
+def test_smooth_buffers_irregular_arrivals():
+    scheduler = FrameScheduler("Smooth", refresh_rate=1000)
+    for at in (0.0, 0.01, 0.07, 0.08, 0.14, 0.15, 0.21, 0.22):
+        scheduler.add(decoded(SCREEN_TOP, at))
+        scheduler.screens[SCREEN_TOP].queue.clear()
+    depth = scheduler.depth(SCREEN_TOP)
+    assert 1 < depth <= FrameScheduler.MAX_DEPTH
+    for i in range(depth - 1):
+        scheduler.add(decoded(SCREEN_TOP, 0.3 + i / 100, i))
+        assert scheduler.due(1.0) == []
+    scheduler.add(decoded(SCREEN_TOP, 0.4, depth))
+    assert [frame.frame_id for frame in scheduler.due(1.0)] == [0]
+
+
+def test_next_poll_follows_the_frame_rate():
+    scheduler = FrameScheduler(refresh_rate=60)
+    # Nothing to pace by yet
+    assert scheduler.next_poll(0.0) == pytest.approx(1 / 60)
+    for i in range(3):
+        scheduler.add(decoded(SCREEN_TOP, i / 30))
+    assert scheduler.next_poll(0.1) == pytest.approx(1 / 120)
+    limited = FrameScheduler(limits={SCREEN_TOP: 10}, refresh_rate=1000)
+    limited.add(decoded(SCREEN_TOP, 0.0))
+    limited.add(decoded(SCREEN_TOP, 0.001))
+    limited.due(0.001)
+    assert limited.next_poll(0.002) == pytest.approx(0.099)
+
+
+def test_smooth_polls_on_the_next_refresh_tick():
+    scheduler = FrameScheduler("Smooth", refresh_rate=60)
+    for i in range(6):
+        scheduler.add(decoded(SCREEN_TOP, i / 30, i))
+    while not scheduler.due(0.2):
+        pass
+    scheduler.add(decoded(SCREEN_TOP, 0.2, 6))
+    wait = scheduler.next_poll(0.2)
+    assert wait > FrameScheduler.MIN_POLL
+    assert round((0.2 + wait) * 60, 6) == round((0.2 + wait) * 60)
+    assert scheduler.due(0.2 + wait - 0.001) == []
+    assert len(scheduler.due(0.2 + wait)) == 1
+
+
+# Command line
+
+
+def test_benchmark_flag_still_works():
+    args = snickerstream.parse_args(["--benchmark", "--app", "hzmod"])
+    assert (args.command, args.app, args.duration) == ("benchmark", "hzmod", 10.0)
+    assert snickerstream.parse_args([]).command is None
+
+
+def test_headless_commands_dont_import_the_gui():
+    script = ("import sys, snickerstream; snickerstream.parse_args(['connect']); "
+              "print([name for name in ('tkinter', 'PIL.ImageTk') if name in sys.modules])")
+    result = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
+
+
+def test_record_command_records_an_emulator(tmp_path):
+    emulator = snickerstream.HzModEmulator(snickerstream.synthetic_frames(4), fps=30)
+    emulator.start()
+    try:
+        args = snickerstream.parse_args(["record", "--config", str(tmp_path / "missing.json"), "--ip", "127.0.0.1",
+                                         "--app", "hzmod", "--port", str(emulator.port), "--duration", "1.5",
+                                         "--quiet", "--output", str(tmp_path), "--prefix", "cli"])
+        assert snickerstream.record_main(args) == 0
+    finally:
+        emulator.stop()
+    segments = sorted(str(path) for path in tmp_path.glob("cli*" + snickerstream.FRAMELOG_EXTENSION))
+    assert segments
+    log = FrameLog(segments[0])
+    try:
+        assert len(log) > 0
+        assert bytes(log.frame(0).data)[:2] == b"\xff\xd8"
+    finally:
+        log.close()
+
+
+def test_serve_command_sends_a_recording_as_ntr_packets(tmp_path):
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(("127.0.0.1", 0))
+    client.settimeout(5.0)
+    try:
+        args = snickerstream.parse_args(["serve", "--recording"] + record(tmp_path, 2) +
+                                        ["--to", "127.0.0.1", "--to-port", str(client.getsockname()[1]),
+                                         "--duration", "1", "--quiet"])
+        assert snickerstream.serve_main(args) == 0
+        packet = client.recv(NTR_PAYLOAD_SIZE + 4)
+    finally:
+        client.close()
+    # The first packet of the top screen's first frame
+    assert packet[0] == 1 and packet[1] & 0x0F == SCREEN_TOP
+    assert packet[4:6] == b"\xff\xd8"
+
+
+# Repeated frames
+
+
+def test_identical_frames_are_flagged_as_repeats():
+    received = []
+    pipeline = snickerstream.StreamPipeline(on_frame=received.append)
+    pipeline.set_targets({SCREEN_TOP: None, SCREEN_BOTTOM: None})
+    buffer = bytearray(fake_jpeg(100, 1))
+    # Receivers hand out views of buffers they reuse
+    pipeline.submit(Frame(SCREEN_TOP, memoryview(buffer), 1))
+    pipeline.submit(Frame(SCREEN_TOP, memoryview(buffer), 2))
+    pipeline.submit(Frame(SCREEN_BOTTOM, memoryview(buffer), 1))
+    buffer[2:-2] = bytes(96)
+    pipeline.submit(Frame(SCREEN_TOP, memoryview(buffer), 3))
+    assert [(frame.frame_id, bool(frame.kind & FRAME_REPEAT)) for frame in received] == [
+        (1, False), (2, True), (1, False), (3, False)]
+    assert received[1].data is received[0].data
+    assert bytes(received[3].data) == fake_jpeg(100, 0) and bytes(received[0].data) == fake_jpeg(100, 1)
+    assert pipeline.repeated == 1
+    assert pipeline.telemetry.screens[SCREEN_TOP].repeated == 1
+    # A new decode size needs a new decode, even of the same frame
+    pipeline.set_targets({SCREEN_TOP: None, SCREEN_BOTTOM: None})
+    pipeline.submit(Frame(SCREEN_TOP, memoryview(buffer), 4))
+    assert not received[-1].kind & FRAME_REPEAT
+
+
+def test_repeats_are_not_decoded(monkeypatch):
+    decodes = []
+    monkeypatch.setattr(snickerstream, "decode_frame", lambda frame, size=None, resample=None: decodes.append(frame))
+    pipeline = snickerstream.StreamPipeline(decode_workers=1)
+    pipeline.start()
+    try:
+        for frame_id in range(1, 4):
+            pipeline.submit(Frame(SCREEN_TOP, fake_jpeg(100), frame_id))
+            assert wait_for(lambda: pipeline.telemetry.screens[SCREEN_TOP].decoded >= 1)
+    finally:
+        pipeline.stop()
+    assert [frame.frame_id for frame in decodes] == [1]
+    assert pipeline.repeated == 2
+
+
+# MJPEG server
+
+
+def test_slow_mjpeg_viewer_keeps_only_the_newest_frames():
+    client = snickerstream.MJPEGClient(("127.0.0.1", 1234), SCREEN_TOP, max_pending=2)
+    for part in (b"1", b"2", b"3"):
+        client.put(part)
+    assert list(client.queue) == [b"2", b"3"]
+    assert client.dropped == 1
+
+
+def read_until(sock, marker, data=b""):
+    while marker not in data:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def test_mjpeg_server_streams_upright_jpegs():
+    server = snickerstream.MJPEGServer(0)
+    server.start()
+    viewer = socket.create_connection(("127.0.0.1", server.port), timeout=5.0)
+    try:
+        viewer.sendall(b"GET /top.mjpg HTTP/1.0\r\n\r\n")
+        assert wait_for(lambda: server.clients)
+        server.add(Frame(SCREEN_BOTTOM, fake_jpeg(50), 1))
+        server.add(Frame(SCREEN_TOP, fake_jpeg(100, 7), 1))
+        data = read_until(viewer, b"\xff\xd9\r\n")
+        headers, _, body = data.partition(b"\r\n\r\n")
+        assert b"multipart/x-mixed-replace; boundary=" + snickerstream.MJPEG_BOUNDARY.encode() in headers
+        part_headers, _, jpeg = body.partition(b"\r\n\r\n")
+        assert part_headers.startswith(b"--" + snickerstream.MJPEG_BOUNDARY.encode())
+        assert b"Content-Length: %d" % (100 + len(snickerstream.MJPEG_EXIF_UPRIGHT)) in part_headers
+        # Forwarded as received, with the orientation tag right after the start of image marker
+        assert jpeg == (b"\xff\xd8" + snickerstream.MJPEG_EXIF_UPRIGHT + fake_jpeg(100, 7)[2:] + b"\r\n")
+        with urllib.request.urlopen("http://127.0.0.1:%d/stats" % server.port, timeout=5.0) as response:
+            stats = json.load(response)
+        assert [(client["screen"], client["frames"]) for client in stats] == [("top", 1)]
+    finally:
+        viewer.close()
+        server.stop()
+
+
+# Reconnecting
+
+
+def test_backoff_doubles_up_to_the_limit():
+    backoff = Backoff(base=1.0, limit=4.0)
+    for ceiling in (1.0, 2.0, 4.0, 4.0):
+        assert ceiling / 2 <= backoff.delay() <= ceiling
+    backoff.reset()
+    assert backoff.delay() <= 1.0
+
+
+def test_stalled_stream_reconnects():
+    opened, reasons = [], []
+
+    class SilentReceiver:
+        stats = snickerstream.ReceiverStats()
+
+        def settimeout(self, timeout):
+            self.timeout = timeout
+
+        def receive(self):
+            time.sleep(self.timeout)
+            raise socket.timeout()
+
+        def close(self):
+            pass
+
+    def open_receiver():
+        opened.append(SilentReceiver())
+        return opened[-1]
+
+    pipeline = snickerstream.StreamPipeline(open_receiver, reconnect=True, stall_timeout=0.1)
+    pipeline.on_reconnecting = lambda reason, delay: reasons.append(reason)
+    pipeline.start()
+    try:
+        assert wait_for(lambda: len(opened) >= 2)
+    finally:
+        pipeline.stop()
+    assert reasons[0] == "No frame received for 100 ms"
+    assert pipeline.stalls >= 1
+    assert not pipeline.reconnecting  # No frame ever arrived
+
+
+# Shared-memory pipeline
+
+def test_frame_ring_overwrites_the_oldest_frame():
+    ring = FrameRing(slots=2, slot_size=64)
+    try:
+        first = ring.write(Frame(SCREEN_TOP, b"one", 1, timestamp=1.0))
+        second = ring.write(Frame(SCREEN_BOTTOM, b"two", 2, FRAME_REPEAT, timestamp=2.0))
+        frame = ring.read(second)
+        assert (frame.screen, bytes(frame.data), frame.frame_id, frame.kind, frame.timestamp) == \
+            (SCREEN_BOTTOM, b"two", 2, FRAME_REPEAT, 2.0)
+        frame = None
+        assert ring.valid(first)
+        ring.write(Frame(SCREEN_TOP, b"three", 3))
+        assert not ring.valid(first)
+        assert ring.read(first) is None
+        assert ring.write(Frame(SCREEN_TOP, bytes(65))) is None
+    finally:
+        ring.close()
+
+
+def test_frame_ring_is_shared_between_handles():
+    ring = FrameRing(slots=4, slot_size=64)
+    other = FrameRing(ring.name)
+    try:
+        seq = ring.write(Frame(SCREEN_TOP, b"shared", 9))
+        assert bytes(other.read(seq).data) == b"shared"
+        stats = snickerstream.ReceiverStats()
+        stats.frames = 42
+        ring.set_stats(stats)
+        assert other.get_stats().frames == 42
+    finally:
+        other.close()
+        ring.close()
+
+
+def test_lost_image_slot_counts_as_skipped():
+    pipeline = snickerstream.ProcessPipeline(None, max_decodes=1)
+    pipeline._images = FrameRing(slots=1, slot_size=64)
+    pipeline._results = snickerstream.queue.Queue()
+    try:
+        pipeline._images.put(0, 5, SCREEN_TOP, bytes(12))
+        pipeline._busy.add(SCREEN_TOP)
+        # Frame 4's image was expected in slot 0, but that holds frame 5's
+        pipeline._decoding[0] = (SCREEN_TOP, 4, 1, 0.0)
+        pipeline._results.put((0, (2, 2), 0.0, 0.0))
+        pipeline.running = True
+        thread = threading.Thread(target=pipeline._result_loop)
+        thread.start()
+        assert wait_for(lambda: pipeline._free_slots == [0])
+        pipeline.running = False
+        thread.join()
+        assert pipeline.skipped == 1
+        assert pipeline.decoded[SCREEN_TOP].take() is None
+        assert SCREEN_TOP not in pipeline._busy
+    finally:
+        pipeline._images.close()
+
+
+# Instant replay
+
+
+def replay_frame(screen, timestamp, data, repeat=False):
+    return Frame(screen, data, 0, FRAME_REPEAT if repeat else 0, timestamp)
+
+
+def test_instant_replay_keeps_the_last_seconds():
+    buffer = InstantReplayBuffer(seconds=2)
+    for i in range(6):
+        buffer.add(replay_frame(SCREEN_TOP, float(i), fake_jpeg(100, i)))
+    assert [frame.timestamp for frame in buffer.frames()] == [3.0, 4.0, 5.0]
+    assert (buffer.evicted, buffer.bytes) == (3, 300)
+
+
+def test_instant_replay_counts_shared_data_once():
+    buffer = InstantReplayBuffer(seconds=60, max_bytes=250)
+    data = fake_jpeg(100)
+    buffer.add(replay_frame(SCREEN_TOP, 0.0, data))
+    buffer.add(replay_frame(SCREEN_BOTTOM, 0.1, fake_jpeg(100, 1)))
+    for i in range(1, 4):
+        buffer.add(replay_frame(SCREEN_TOP, float(i), data, repeat=True))
+    assert buffer.bytes == 200
+    # Evicting the repeated frame leaves its data with the first repeat
+    buffer.add(replay_frame(SCREEN_BOTTOM, 4.0, fake_jpeg(100, 2)))
+    assert [frame.timestamp for frame in buffer.frames()] == [1.0, 2.0, 3.0, 4.0]
+    assert buffer.bytes == 200
+    # Until the last frame holding it is gone
+    buffer.add(replay_frame(SCREEN_TOP, 5.0, fake_jpeg(100, 3)))
+    assert [frame.timestamp for frame in buffer.frames()] == [4.0, 5.0]
+    assert buffer.bytes == 200
+
+
+def test_save_replay_as_a_clip_and_as_images(tmp_path):
+    data = fake_jpeg(100, 5)
+    frames = [replay_frame(SCREEN_TOP, 1.0, data), replay_frame(SCREEN_TOP, 2.0, data, repeat=True),
+              replay_frame(SCREEN_BOTTOM, 2.5, fake_jpeg(80, 6))]
+    segments = save_replay(frames, str(tmp_path / "clip"))
+    source = ReplaySource(segments, speed=0)
+    try:
+        assert len(source) == 3
+        assert [bytes(source.receive().data) for _ in range(3)] == [data, data, fake_jpeg(80, 6)]
+    finally:
+        source.close()
+    paths = save_replay(frames, str(tmp_path / "images"), images=True, image_format="JPEG")
+    assert [os.path.basename(path) for path in paths] == ["00000-top.jpg", "00002-bottom.jpg"]
+    with open(paths[0], "rb") as f:
+        assert f.read() == b"\xff\xd8" + snickerstream.MJPEG_EXIF_UPRIGHT + data[2:]